@@ -1,18 +1,29 @@
 import jwt
 import time
+import asyncio
 import random
 import secrets
+import hashlib
 import logging
+import threading
 from datetime import datetime, timedelta
+from collections import OrderedDict
 from typing import Dict, Optional, List, Union
-from fastapi import Depends, HTTPException, status, Security, Response, Form
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import Depends, HTTPException, status, Security, Request, Response, Form
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
 from passlib.context import CryptContext
 
-from models import StudentUser, CounselorUser
+from models import StudentUser, CounselorUser, IdCounter
+from principals import principal_exists, get_account
 from config import Config
+from metrics import metrics
+from rate_limiter import rate_limiter
 
 # --- Password Hashing ---
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -23,6 +34,62 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+class PasswordWorkPool:
+    """
+    Runs bcrypt hashing/verification on a dedicated, size-limited thread pool so a
+    login burst can't freeze the event loop (bcrypt releases the GIL while hashing).
+
+    At most `workers + max_queue` jobs may be pending; beyond that callers get an
+    immediate 503 instead of piling up behind the pool. Queue wait and run times
+    are recorded in the metrics registry.
+    """
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.capacity = workers + max_queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._pending = 0  # Only touched from the event loop
+        self._queue_wait = metrics.histogram("password_pool.queue_wait_seconds")
+        self._run_time = metrics.histogram("password_pool.run_seconds")
+        self._rejected = metrics.counter("password_pool.rejected")
+        metrics.gauge("password_pool.pending", lambda: self._pending)
+
+    async def run(self, func, *args):
+        if self._pending >= self.capacity:
+            self._rejected.inc()
+            logging.warning(f"Password pool full ({self._pending} pending), rejecting request")
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server busy, please retry shortly.",
+                headers={"Retry-After": "1"},
+            )
+
+        enqueued_at = time.perf_counter()
+
+        def timed():
+            started_at = time.perf_counter()
+            self._queue_wait.observe(started_at - enqueued_at)
+            try:
+                return func(*args)
+            finally:
+                self._run_time.observe(time.perf_counter() - started_at)
+
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, timed)
+        finally:
+            self._pending -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+password_pool = PasswordWorkPool(workers=Config.PASSWORD_POOL_WORKERS, max_queue=Config.PASSWORD_POOL_MAX_QUEUE)
+
+async def verify_password_async(plain_password, hashed_password):
+    return await password_pool.run(verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    return await password_pool.run(get_password_hash, password)
+
 # JWT settings
 JWT_SECRET = "your-secret-key-change-in-production"  # Should be in Config class in real app
 JWT_ALGORITHM = "HS256"
@@ -31,12 +98,6 @@ JWT_EXPIRATION = 24  # hours
 # Security setup for JWT tokens
 security = HTTPBearer()
 
-# Simple rate limiting in-memory storage
-rate_limit_store: Dict[str, Dict[str, int]] = {}
-# Limits: 5 requests per 10 seconds per user
-RATE_LIMIT = 5
-RATE_LIMIT_WINDOW = 10  # seconds
-
 # List of animals for user ID generation
 ANIMALS = [
     "DOG", "CAT", "LION", "TIGER", "ELEPHANT", "GIRAFFE", "ZEBRA", "MONKEY", 
@@ -98,12 +159,70 @@ def create_jwt_token(user_id: str, role: str = "Student", is_paid: bool = False)
     
     return token, expires_delta.total_seconds()
 
+class TokenCache:
+    """
+    Bounded LRU of verified JWT payloads, keyed by the SHA-256 of the token so raw
+    tokens are never kept in memory. An entry is only served until the token's
+    `exp` claim, so a cached token expires exactly when jwt.decode would reject it.
+    Only successfully verified tokens are cached.
+    """
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[bytes, dict] = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = metrics.counter("token_cache.hits")
+        self._misses = metrics.counter("token_cache.misses")
+        metrics.gauge("token_cache.size", lambda: len(self._entries))
+        metrics.gauge("token_cache.hit_rate", self.hit_rate)
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, token: str) -> Optional[dict]:
+        key = self._key(token)
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None and payload["exp"] <= time.time():
+                del self._entries[key]
+                payload = None
+            if payload is None:
+                self._misses.inc()
+                return None
+            self._entries.move_to_end(key)
+        self._hits.inc()
+        return payload
+
+    def put(self, token: str, payload: dict):
+        if self.max_entries <= 0 or "exp" not in payload:
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = payload
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def evict(self, token: str):
+        with self._lock:
+            self._entries.pop(self._key(token), None)
+
+    def hit_rate(self) -> float:
+        hits, misses = self._hits.snapshot(), self._misses.snapshot()
+        return round(hits / (hits + misses), 4) if hits + misses else 0.0
+
+token_cache = TokenCache(max_entries=Config.TOKEN_CACHE_MAX_ENTRIES)
+
 def verify_jwt_token(token: str):
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return payload
     except jwt.PyJWTError:
         return None
+    token_cache.put(token, payload)
+    return payload
 
 # JWT validation dependency
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Security(security)):
@@ -117,24 +236,11 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Security(
         )
     return payload["sub"]  # Return the username from the token
 
-# Rate limiting dependency
-async def check_rate_limit(user_id: str = Depends(get_current_user)):
-    current_time = int(time.time())
-    
-    # Initialize rate limiting for user if not exists
-    if user_id not in rate_limit_store:
-        rate_limit_store[user_id] = {"count": 0, "reset_at": current_time + RATE_LIMIT_WINDOW}
-    
-    # Check if window has expired and reset if needed
-    if current_time > rate_limit_store[user_id]["reset_at"]:
-        rate_limit_store[user_id] = {"count": 0, "reset_at": current_time + RATE_LIMIT_WINDOW}
-    
-    # Increment request count
-    rate_limit_store[user_id]["count"] += 1
-    
-    # Check if limit exceeded
-    if rate_limit_store[user_id]["count"] > RATE_LIMIT:
-        wait_time = rate_limit_store[user_id]["reset_at"] - current_time
+# Rate limiting dependency (limits per route are set in Config.RATE_LIMIT_*)
+async def check_rate_limit(request: Request, user_id: str = Depends(get_current_user)):
+    route = request.scope.get("route")
+    wait_time = await rate_limiter.check(route.path if route else request.url.path, user_id)
+    if wait_time is not None:
         raise HTTPException(
             status_code=status.HTTP_429_TOO_MANY_REQUESTS,
             detail=f"Rate limit exceeded. Try again in {wait_time} seconds.",
@@ -144,23 +250,23 @@ async def check_rate_limit(user_id: str = Depends(get_current_user)):
     return user_id
 
 # --- Authentication Route Logic ---
-async def create_student_account(user_data: UserCreate, db: Session):
+async def create_student_account(user_data: UserCreate, db: AsyncSession):
     generated_user_id = secrets.token_urlsafe(16)
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await get_password_hash_async(user_data.password)
 
     db_user = StudentUser(id=generated_user_id, password_hash=hashed_password, campus_id="", cardano_did=None)
     db.add(db_user)
     try:
-        db.commit()
-        db.refresh(db_user)
+        await db.commit()
+        await db.refresh(db_user)
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Account creation failed: {e}")
     return {"user_id": db_user.id, "message": "Account created successfully. Please proceed to campus affiliation."}
 
-async def student_login(user_data: UserLogin, db: Session):
-    db_user = db.query(StudentUser).filter(StudentUser.id == user_data.user_id).first()
-    if not db_user or not verify_password(user_data.password, db_user.password_hash):
+async def student_login(user_data: UserLogin, db: AsyncSession):
+    db_user = await db.scalar(select(StudentUser).where(StudentUser.id == user_data.user_id))
+    if not db_user or not await verify_password_async(user_data.password, db_user.password_hash):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
     
     return {
@@ -171,9 +277,9 @@ async def student_login(user_data: UserLogin, db: Session):
         "message": "Login successful"
     }
 
-async def counselor_login(user_data: UserLogin, db: Session):
-    db_counselor = db.query(CounselorUser).filter(CounselorUser.id == user_data.user_id).first()
-    if not db_counselor or not verify_password(user_data.password, db_counselor.password_hash):
+async def counselor_login(user_data: UserLogin, db: AsyncSession):
+    db_counselor = await db.scalar(select(CounselorUser).where(CounselorUser.id == user_data.user_id))
+    if not db_counselor or not await verify_password_async(user_data.password, db_counselor.password_hash):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
     
     return {
@@ -184,13 +290,14 @@ async def counselor_login(user_data: UserLogin, db: Session):
         "message": "Login successful"
     }
 
-async def universal_login(user_data: UserLogin, response: Response, db: Session):
+async def universal_login(user_data: UserLogin, response: Response, db: AsyncSession):
     """Universal login endpoint for both students and counselors"""
-    # Try student login first
-    student = db.query(StudentUser).filter(StudentUser.id == user_data.user_id).first()
-    if student and verify_password(user_data.password, student.password_hash):
-        # Generate JWT token, including paid status
-        token, expires_in = create_jwt_token(student.id, student.role, is_paid=student.is_paid)
+    # One lookup through the principals index finds the account in either table
+    account = await get_account(db, user_data.user_id)
+    if account and await verify_password_async(user_data.password, account.password_hash):
+        # Generate JWT token, including paid status (counselors are not 'paid')
+        is_paid = bool(account.is_paid) if isinstance(account, StudentUser) else False
+        token, expires_in = create_jwt_token(account.id, account.role, is_paid=is_paid)
         
         # Set cookie for web clients
         response.set_cookie(
@@ -205,35 +312,10 @@ async def universal_login(user_data: UserLogin, response: Response, db: Session)
         return TokenResponse(
             access_token=token,
             token_type="bearer",
-            user_id=student.id,
-            role=student.role,
+            user_id=account.id,
+            role=account.role,
             expires_in=int(expires_in),
-            is_paid=student.is_paid
-        )
-    
-    # Try counselor login
-    counselor = db.query(CounselorUser).filter(CounselorUser.id == user_data.user_id).first()
-    if counselor and verify_password(user_data.password, counselor.password_hash):
-        # Generate JWT token (counselors are not 'paid')
-        token, expires_in = create_jwt_token(counselor.id, counselor.role, is_paid=False)
-        
-        # Set cookie for web clients
-        response.set_cookie(
-            key="session_token",
-            value=token,
-            httponly=True,
-            max_age=int(expires_in),
-            samesite="lax",
-            secure=True  # Set to False for development without HTTPS
-        )
-        
-        return TokenResponse(
-            access_token=token,
-            token_type="bearer",
-            user_id=counselor.id,
-            role=counselor.role,
-            expires_in=int(expires_in),
-            is_paid=False
+            is_paid=is_paid
         )
     
     # If no user found or password incorrect
@@ -243,36 +325,52 @@ async def universal_login(user_data: UserLogin, response: Response, db: Session)
         headers={"WWW-Authenticate": "Bearer"},
     )
 
-async def register_user(user_data: UserRegistration, db: Session, response: Response = None):
+# Dialect-specific INSERT ... ON CONFLICT DO UPDATE ... RETURNING
+UPSERT_INSERTS = {
+    "sqlite": sqlite_insert,
+    "postgresql": postgresql_insert,
+}
+
+async def _next_counter_value(db: AsyncSession, animal: str, year: str) -> int:
+    """Atomically increment the (animal, year) counter and return its new value."""
+    dialect = db.get_bind().dialect.name
+    if dialect not in UPSERT_INSERTS:
+        raise ValueError(f"User ID allocation is not supported on database backend '{dialect}'")
+    insert = UPSERT_INSERTS[dialect](IdCounter).values(animal=animal, year=year, value=0)
+    statement = insert.on_conflict_do_update(
+        index_elements=[IdCounter.animal, IdCounter.year],
+        set_={"value": IdCounter.value + 1},
+    ).returning(IdCounter.value)
+    value = await db.scalar(statement)
+    # Commit straight away: a gap from a failed registration is harmless, and the
+    # row lock isn't held while the password is hashed
+    await db.commit()
+    return value
+
+async def allocate_user_id(db: AsyncSession, animal: str) -> str:
+    """
+    Hand out the next free ID for an animal, e.g. CAT_25, then CAT_25_1, CAT_25_2...
+    The counter is incremented in a single upsert, so concurrent registrations in
+    any number of workers never get the same ID. IDs issued before the counter
+    existed are skipped over once.
+    """
+    year = str(datetime.now().year)[-2:]  # Last two digits
+    base_user_id = f"{animal}_{year}"
+    while True:
+        value = await _next_counter_value(db, animal, year)
+        user_id = base_user_id if value == 0 else f"{base_user_id}_{value}"
+        if not await principal_exists(db, user_id):
+            return user_id
+        logging.info(f"Skipping legacy user ID {user_id}")
+
+async def register_user(user_data: UserRegistration, db: AsyncSession, response: Response = None):
     """Register a new user with auto-generated animal-based ID and return JWT token"""
-    # Get current year (last two digits)
-    current_year = str(datetime.now().year)[-2:]
-    
-    # Select random animal
+    # Select random animal and allocate the next ID for it this year
     animal = random.choice(ANIMALS)
-    
-    # Generate a unique ID
-    base_user_id = f"{animal}_{current_year}"
-    generated_user_id = base_user_id
-    
-    # Check if ID already exists and add suffix if needed
-    suffix = 1
-    while (
-        db.query(StudentUser).filter(StudentUser.id == generated_user_id).first() or
-        db.query(CounselorUser).filter(CounselorUser.id == generated_user_id).first()
-    ):
-        generated_user_id = f"{base_user_id}_{suffix}"
-        suffix += 1
-        
-        # Prevent infinite loop
-        if suffix > 100:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to generate a unique user ID. Please try again."
-            )
+    generated_user_id = await allocate_user_id(db, animal)
     
     # Hash the password
-    hashed_password = get_password_hash(user_data.password)
+    hashed_password = await get_password_hash_async(user_data.password)
     
     # Create new user
     new_user = StudentUser(
@@ -284,8 +382,8 @@ async def register_user(user_data: UserRegistration, db: Session, response: Resp
     
     db.add(new_user)
     try:
-        db.commit()
-        db.refresh(new_user)
+        await db.commit()
+        await db.refresh(new_user)
         
         # Generate JWT token for the new user (starts as not paid)
         token, expires_in = create_jwt_token(generated_user_id, "Student", is_paid=False)
@@ -313,7 +411,7 @@ async def register_user(user_data: UserRegistration, db: Session, response: Resp
             is_paid=False
         )
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Registration failed: {e}"
@@ -323,13 +421,21 @@ async def get_available_animals():
     """Return the list of available animals for user ID generation"""
     return {"animals": ANIMALS}
 
-async def logout(response: Response):
+async def logout(response: Response, request: Request = None):
     """Logout endpoint to clear session"""
+    if request is not None:
+        # Drop the caller's token from the verified-token cache
+        token = request.cookies.get("session_token")
+        authorization = request.headers.get("Authorization", "")
+        if authorization.startswith("Bearer "):
+            token = authorization[len("Bearer "):]
+        if token:
+            token_cache.evict(token)
     response.delete_cookie(key="session_token")
     return {"message": "Successfully logged out"}
 
-async def update_counselor_did(update_data: CounselorAffiliationUpdate, db: Session):
-    db_counselor = db.query(CounselorUser).filter(CounselorUser.id == update_data.user_id).first()
+async def update_counselor_did(update_data: CounselorAffiliationUpdate, db: AsyncSession):
+    db_counselor = await db.scalar(select(CounselorUser).where(CounselorUser.id == update_data.user_id))
     if not db_counselor:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Counselor user not found")
     
@@ -338,16 +444,16 @@ async def update_counselor_did(update_data: CounselorAffiliationUpdate, db: Sess
     
     db_counselor.cardano_did = update_data.cardano_did
     try:
-        db.commit()
-        db.refresh(db_counselor)
+        await db.commit()
+        await db.refresh(db_counselor)
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Failed to update DID: {e}")
     
     return {"user_id": db_counselor.id, "message": "Counselor Cardano DID updated successfully."}
 
-async def affiliate_student_account(affiliation_data: CampusAffiliation, db: Session):
-    db_user = db.query(StudentUser).filter(StudentUser.id == affiliation_data.user_id).first()
+async def affiliate_student_account(affiliation_data: CampusAffiliation, db: AsyncSession):
+    db_user = await db.scalar(select(StudentUser).where(StudentUser.id == affiliation_data.user_id))
     if not db_user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Student user not found")
 
@@ -357,10 +463,10 @@ async def affiliate_student_account(affiliation_data: CampusAffiliation, db: Ses
     db_user.campus_id = affiliation_data.campus_id
     db_user.cardano_did = affiliation_data.cardano_did
     try:
-        db.commit()
-        db.refresh(db_user)
+        await db.commit()
+        await db.refresh(db_user)
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Affiliation failed: {e}")
     
     return {
@@ -369,11 +475,11 @@ async def affiliate_student_account(affiliation_data: CampusAffiliation, db: Ses
         "message": "Account affiliated successfully."
     }
 
-async def counselor_email_login(login_data: CounselorEmailLogin, response: Response, db: Session):
+async def counselor_email_login(login_data: CounselorEmailLogin, response: Response, db: AsyncSession):
     """Login endpoint for counselors using email and password"""
     # Find counselor by email
-    counselor = db.query(CounselorUser).filter(CounselorUser.email == login_data.email).first()
-    if not counselor or not verify_password(login_data.password, counselor.password_hash):
+    counselor = await db.scalar(select(CounselorUser).where(CounselorUser.email == login_data.email))
+    if not counselor or not await verify_password_async(login_data.password, counselor.password_hash):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid email or password",
@@ -0,0 +1,344 @@
+import os
+import json
+import socket
+import asyncio
+import logging
+import contextlib
+from typing import Awaitable, Callable, Optional
+
+from config import Config
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# --- Transports ---
+# A transport moves opaque frames (bytes) between workers:
+#   start(worker_id, on_frame)  begin receiving; on_frame is awaited for each frame
+#   peers()                     IDs of the other workers it can currently reach
+#   send(peer, frame)           deliver one frame; raises PeerGone if the peer no longer
+#                               exists, ConnectionError if the send failed but it may still
+#   close()
+
+class PeerGone(ConnectionError):
+    """The peer worker has exited (its socket is missing or refuses connections)."""
+
+class LocalTransport:
+    """
+    In-process hub: transports sharing a hub name see each other. Stands in for a
+    broker when there is a single worker, and lets several backplanes run in one
+    process.
+    """
+    _hubs: dict[str, dict[str, "LocalTransport"]] = {}
+
+    def __init__(self, hub: str = "default"):
+        self.hub = self._hubs.setdefault(hub, {})
+        self.worker_id = None
+        self._on_frame = None
+
+    async def start(self, worker_id: str, on_frame: Callable[[bytes], Awaitable[None]]):
+        self.worker_id = worker_id
+        self._on_frame = on_frame
+        self.hub[worker_id] = self
+
+    def peers(self) -> list[str]:
+        return [worker_id for worker_id in self.hub if worker_id != self.worker_id]
+
+    async def send(self, peer: str, frame: bytes):
+        transport = self.hub.get(peer)
+        if transport is None:
+            raise PeerGone(f"Worker {peer} is not on the hub")
+        await transport._on_frame(frame)
+
+    async def close(self):
+        self.hub.pop(self.worker_id, None)
+
+class UnixSocketTransport:
+    """
+    One Unix stream socket per worker in a shared directory; peers are discovered
+    by listing it. Frames are newline-delimited (JSON never contains a raw newline).
+    Sockets left behind by a worker that died are removed on the first refused connect.
+    """
+    MAX_FRAME_BYTES = 4 * 1024 * 1024
+
+    def __init__(self, socket_dir: str):
+        self.socket_dir = socket_dir
+        self.worker_id = None
+        self._server = None
+        self._writers: dict[str, asyncio.StreamWriter] = {}
+
+    def _path(self, worker_id: str) -> str:
+        return os.path.join(self.socket_dir, f"{worker_id}.sock")
+
+    async def start(self, worker_id: str, on_frame: Callable[[bytes], Awaitable[None]]):
+        self.worker_id = worker_id
+        self._on_frame = on_frame
+        os.makedirs(self.socket_dir, exist_ok=True)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self._path(worker_id))
+        self._server = await asyncio.start_unix_server(self._serve, path=self._path(worker_id), limit=self.MAX_FRAME_BYTES)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                await self._on_frame(line)  # Handles its own errors, one frame at a time
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as e:
+            # readline() raises ValueError for a frame over MAX_FRAME_BYTES; the sender reconnects and resyncs
+            logging.warning(f"Backplane peer connection dropped: {e!r}")
+        finally:
+            writer.close()
+
+    def peers(self) -> list[str]:
+        return [
+            name[:-len(".sock")] for name in os.listdir(self.socket_dir)
+            if name.endswith(".sock") and name[:-len(".sock")] != self.worker_id
+        ]
+
+    async def send(self, peer: str, frame: bytes):
+        writer = self._writers.get(peer)
+        if writer is None or writer.is_closing():
+            try:
+                _, writer = await asyncio.open_unix_connection(self._path(peer))
+            except ConnectionRefusedError:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(self._path(peer))
+                raise PeerGone(f"Worker {peer} is gone")
+            except FileNotFoundError:
+                raise PeerGone(f"Worker {peer} is gone")
+            except OSError as e:
+                raise ConnectionError(f"Could not connect to worker {peer}: {e!r}")
+            self._writers[peer] = writer
+        try:
+            writer.write(frame + b"\n")
+            await writer.drain()
+        except (ConnectionError, OSError):
+            self._writers.pop(peer, None)
+            raise ConnectionError(f"Lost connection to worker {peer}")
+
+    async def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+        if self._server is not None:
+            self._server.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self._path(self.worker_id))
+
+def build_transport(name: str):
+    if name == "local":
+        return LocalTransport()
+    if name == "unix":
+        return UnixSocketTransport(Config.BACKPLANE_SOCKET_DIR)
+    raise ValueError(f"Unknown BACKPLANE_TRANSPORT '{name}', expected 'local' or 'unix'")
+
+# --- Backplane ---
+class Backplane:
+    """
+    Routes WebSocket messages and presence between uvicorn workers.
+
+    Every worker announces its users coming and going (presence frames), so each
+    one knows which worker owns every connected user. A message for a user on
+    another worker is sent straight to that worker, which delivers it on its own
+    socket. A starting worker says hello and the others reply with their users.
+
+    A peer is forgotten only when it says bye or its transport reports it gone.
+    After a transient send failure the frame is retried once on a new connection,
+    and the next successful send to that peer starts with a resync, since
+    presence frames may have been lost in between.
+
+    Outgoing frames go through a bounded outbox drained by one task, so callers
+    never wait on a peer. A message that can't be queued makes deliver() return
+    False; one that is queued but can't be sent is handed back to the manager's
+    `on_undelivered`, so it is stored rather than lost.
+    """
+    def __init__(self, transport, worker_id: Optional[str] = None):
+        self.transport = transport
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.remote_presence: dict[str, tuple[str, float]] = {}  # user_id -> (worker_id, connected_since)
+        self._outbox: Optional[asyncio.Queue] = None
+        self._pump: Optional[asyncio.Task] = None
+        self._manager = None
+        self._needs_resync: set[str] = set()  # Peers we may have lost frames to
+        self._tasks: set[asyncio.Task] = set()  # Flushes requested by peers, still running
+        self._sending: Optional[tuple] = None  # The delivery the pump is sending right now
+
+    async def ensure_started(self, manager):
+        """Start on first use (needs the running event loop); `manager` delivers to local sockets."""
+        if self._pump is not None:
+            return
+        self._manager = manager
+        self._outbox = asyncio.Queue(maxsize=Config.BACKPLANE_OUTBOX_SIZE)
+        self._pump = asyncio.create_task(self._run_pump())
+        await self.transport.start(self.worker_id, self._on_frame)
+        self._publish(None, {"op": "hello"})
+        logging.info(f"Backplane started for worker {self.worker_id} ({type(self.transport).__name__})")
+
+    # --- Outgoing ---
+    def _publish(self, peer: Optional[str], frame: dict, delivery: Optional[tuple] = None) -> bool:
+        """Queue a frame for one peer, or for every peer when `peer` is None. Returns False if it was dropped."""
+        if self._outbox is None:
+            return False
+        frame["from"] = self.worker_id
+        try:
+            self._outbox.put_nowait((peer, json.dumps(frame).encode("utf-8"), delivery))
+        except asyncio.QueueFull:
+            logging.error(f"Backplane outbox full, dropping {frame['op']} frame")
+            return False
+        return True
+
+    async def _run_pump(self):
+        while True:
+            peer, data, delivery = await self._outbox.get()
+            try:
+                targets = [peer] if peer else self.transport.peers()
+            except OSError as e:
+                logging.error(f"Backplane: could not list peers: {e!r}")
+                targets = []
+            sent = False
+            self._sending = delivery
+            for target in targets:
+                sent = await self._send_to(target, data)
+            self._sending = None
+            if delivery is not None:
+                await self._settle(delivery, sent)
+            self._outbox.task_done()
+
+    async def _settle(self, delivery: tuple, sent: bool):
+        """After a deliver frame: confirm it to the caller, or hand the message back to be stored."""
+        user_id, message, critical, on_sent = delivery
+        try:
+            if sent:
+                if on_sent is not None:
+                    await on_sent()
+            elif self._manager.on_undelivered is not None:
+                await self._manager.on_undelivered(user_id, message, critical)
+        except Exception:
+            logging.exception(f"Backplane: could not settle a message for {user_id}")
+
+    def _resync_frame(self) -> bytes:
+        return json.dumps({"op": "resync", "from": self.worker_id, "users": self._manager.local_presence()}).encode("utf-8")
+
+    async def _send_to(self, target: str, data: bytes) -> bool:
+        """Send one frame to one peer, retrying once on a new connection. Returns whether it was sent; never raises."""
+        for attempt in (1, 2):
+            try:
+                if target in self._needs_resync:
+                    await self.transport.send(target, self._resync_frame())
+                    self._needs_resync.discard(target)
+                await self.transport.send(target, data)
+                return True
+            except PeerGone as e:
+                logging.warning(f"Backplane: {e}")
+                self._needs_resync.discard(target)
+                self._forget_worker(target)
+                return False
+            except Exception as e:  # Transient: keep what we know about the peer and resync once it answers
+                self._needs_resync.add(target)
+                if attempt == 2:
+                    logging.error(f"Backplane: dropping frame for worker {target}: {e!r}")
+        return False
+
+    def publish_presence(self, user_id: str, online: bool, since: float):
+        self._publish(None, {"op": "presence", "user_id": user_id, "online": online, "since": since})
+
+    def owner_of(self, user_id: str) -> Optional[str]:
+        owner = self.remote_presence.get(user_id)
+        return owner[0] if owner else None
+
+    def deliver(self, user_id: str, message: str, critical: bool = False,
+                on_sent: Optional[Callable[[], Awaitable[None]]] = None) -> bool:
+        """
+        Forward a message to the worker that owns `user_id`. Returns False if no
+        worker does or it could not be queued. Once the owner has the frame,
+        `on_sent` is awaited; if it can't be sent the manager's `on_undelivered` gets it.
+        """
+        owner = self.owner_of(user_id)
+        if owner is None:
+            return False
+        frame = {"op": "deliver", "user_id": user_id, "message": message, "critical": critical}
+        return self._publish(owner, frame, (user_id, message, critical, on_sent))
+
+    def request_flush(self, user_id: str):
+        """Ask the worker that owns `user_id` to flush their stored messages."""
+        owner = self.owner_of(user_id)
+        if owner is not None:
+            self._publish(owner, {"op": "flush", "user_id": user_id})
+
+    # --- Incoming ---
+    def _forget_worker(self, worker_id: str):
+        for user_id in [u for u, (owner, _) in self.remote_presence.items() if owner == worker_id]:
+            del self.remote_presence[user_id]
+
+    def _mark_online(self, user_id: str, worker_id: str, since: float):
+        current = self.remote_presence.get(user_id)
+        if current is None or current[1] <= since:
+            self.remote_presence[user_id] = (worker_id, since)
+
+    def _sync_from(self, worker_id: str, users: list):
+        """Replace what we know about a peer's users with its full list."""
+        self._forget_worker(worker_id)
+        for user_id, since in users:
+            self._mark_online(user_id, worker_id, since)
+
+    async def _on_frame(self, raw: bytes):
+        """Handle one frame; a bad frame or a failing handler is logged and never breaks the connection."""
+        try:
+            frame = json.loads(raw)
+            await self._handle(frame["op"], frame["from"], frame)
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Backplane: ignoring malformed frame: {e!r}")
+        except Exception:
+            logging.exception("Backplane: error handling frame")
+
+    async def _handle(self, op: str, sender: str, frame: dict):
+        if op == "deliver":
+            await self._manager.deliver_local(frame["user_id"], frame["message"], frame.get("critical", False))
+        elif op == "presence":
+            user_id = frame["user_id"]
+            if frame["online"]:
+                self._mark_online(user_id, sender, frame["since"])
+                # The same user connected on another worker more recently: drop our older socket
+                await self._manager.displace(user_id, frame["since"])
+            elif self.owner_of(user_id) == sender:
+                del self.remote_presence[user_id]
+        elif op == "hello":
+            self._forget_worker(sender)  # A restarted worker has no connections yet
+            self._publish(sender, {"op": "sync", "users": self._manager.local_presence()})
+        elif op == "sync":
+            self._sync_from(sender, frame["users"])
+        elif op == "resync":
+            # The peer may have missed our frames (and we theirs): exchange full lists
+            self._sync_from(sender, frame["users"])
+            self._publish(sender, {"op": "sync", "users": self._manager.local_presence()})
+        elif op == "flush":
+            # Reads the database: run it beside the link rather than holding up the frames behind it
+            task = asyncio.create_task(self._flush_requested(frame["user_id"]))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        elif op == "bye":
+            self._forget_worker(sender)
+
+    async def _flush_requested(self, user_id: str):
+        try:
+            if self._manager.on_flush_request is not None:
+                await self._manager.on_flush_request(user_id)
+        except Exception:
+            logging.exception(f"Backplane: flush requested for {user_id} failed")
+
+    async def stop(self):
+        if self._pump is None:
+            return
+        self._publish(None, {"op": "bye"})
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self._outbox.join(), timeout=1.0)
+        self._pump.cancel()
+        await asyncio.gather(self._pump, return_exceptions=True)
+        # Messages still waiting for a peer (or cut off mid-send) are stored rather than dropped
+        if self._sending is not None:
+            await self._settle(self._sending, False)
+            self._sending = None
+        while not self._outbox.empty():
+            _, _, delivery = self._outbox.get_nowait()
+            if delivery is not None:
+                await self._settle(delivery, False)
+        self._pump = None
+        self._outbox = None
+        await self.transport.close()
@@ -0,0 +1,140 @@
+"""
+Requests per second for a school lookup served through the old blocking
+Session path and through the AsyncSession path, under concurrent load.
+
+Each mode serves the same two-query lookup as /api/school/{school_id} from a
+temporary SQLite database, with engines built by database.py for the chosen
+SQLITE_PROFILE (the app's setting by default). While the load runs, a probe keeps calling a route
+that does no DB work, to show how long the event loop stalls for everyone else.
+
+Usage (from BACKEND/):
+    python benchmarks/bench_async_db.py [--concurrency 64] [--duration 5] [--schools 200] [--profile production]
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import uvicorn
+from fastapi import FastAPI
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from config import Config
+from models import Base, School, CounselorUser
+from database import build_engine, build_async_engine
+
+def seed(url: str, profile: str, schools: int):
+    engine = build_engine(url, profile)
+    Base.metadata.create_all(bind=engine)
+    with sessionmaker(bind=engine)() as db:
+        for i in range(schools):
+            db.add(School(id=f"S{i}", name=f"School {i}", location="Campus"))
+            for j in range(5):
+                db.add(CounselorUser(id=f"C{i}_{j}", name=f"Counselor {j}", campus_id=f"S{i}", password_hash="x"))
+        db.commit()
+    engine.dispose()
+
+def build_app(db_path: str, profile: str) -> FastAPI:
+    app = FastAPI()
+    # The same engine setup (pool, pragmas) and session options as database.py
+    sync_engine = build_engine(f"sqlite:///{db_path}", profile)
+    SyncSession = sessionmaker(autocommit=False, autoflush=False, bind=sync_engine)
+    async_engine = build_async_engine(f"sqlite+aiosqlite:///{db_path}", profile)
+    AsyncSession = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+    @app.get("/sync/school/{school_id}")
+    async def sync_school(school_id: str):
+        # The pre-async pattern: a blocking Session used from an async route
+        with SyncSession() as db:
+            school = db.query(School).filter(School.id == school_id).first()
+            counselors = db.query(CounselorUser).filter(CounselorUser.campus_id == school_id).all()
+            return {"name": school.name, "counselors": [{"id": c.id, "name": c.name} for c in counselors]}
+
+    @app.get("/async/school/{school_id}")
+    async def async_school(school_id: str):
+        async with AsyncSession() as db:
+            school = await db.scalar(select(School).where(School.id == school_id))
+            counselors = (await db.scalars(select(CounselorUser).where(CounselorUser.campus_id == school_id))).all()
+            return {"name": school.name, "counselors": [{"id": c.id, "name": c.name} for c in counselors]}
+
+    @app.get("/ping")
+    async def ping():
+        return {"ok": True}
+
+    return app
+
+async def load(base_url: str, mode: str, concurrency: int, duration: float, schools: int) -> dict:
+    deadline = time.perf_counter() + duration
+    latencies = []
+    probe_latencies = []
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+        async def worker(n: int):
+            i = n
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                response = await client.get(f"/{mode}/school/S{i % schools}")
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+                i += concurrency
+
+        async def probe():
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                await client.get("/ping")
+                probe_latencies.append(time.perf_counter() - start)
+                await asyncio.sleep(0.01)
+
+        started = time.perf_counter()
+        await asyncio.gather(probe(), *(worker(n) for n in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    probe_latencies.sort()
+    return {
+        "rps": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "probe_p99_ms": probe_latencies[int(len(probe_latencies) * 0.99) - 1] * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--schools", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--profile", choices=("default", "production"), default=Config.SQLITE_PROFILE)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        seed(f"sqlite:///{db_path}", args.profile, args.schools)
+
+        server = uvicorn.Server(uvicorn.Config(build_app(db_path, args.profile), port=args.port, log_level="warning"))
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        while not server.started:
+            time.sleep(0.05)
+
+        base_url = f"http://127.0.0.1:{args.port}"
+        print(f"concurrency={args.concurrency} duration={args.duration}s schools={args.schools} profile={args.profile}")
+        print(f"{'mode':<8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'ping p99 ms':>14}")
+        for mode in ("sync", "async"):
+            result = asyncio.run(load(base_url, mode, args.concurrency, args.duration, args.schools))
+            print(f"{mode:<8}{result['rps']:>10.0f}{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}{result['probe_p99_ms']:>14.1f}")
+
+        server.should_exit = True
+        thread.join()
+
+if __name__ == "__main__":
+    main()
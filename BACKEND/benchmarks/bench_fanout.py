@@ -0,0 +1,76 @@
+"""
+Broadcast fan-out benchmark.
+
+Simulated sockets take 0.2-2 ms per send and 1% of them are slow mobile clients
+(200 ms). 0.5% fail outright. The benchmark broadcasts one JSON frame to 1k and
+10k of them in two ways: the old loop, which serializes per socket and awaits
+send_text one after the other, and fanout.fan_out, which serializes once and
+sends concurrently with bounded workers.
+
+Usage (from BACKEND/):
+    python benchmarks/bench_fanout.py [--sizes 1000 10000] [--concurrency 256]
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fanout import fan_out
+
+class SimulatedSocket:
+    def __init__(self, rng: random.Random):
+        roll = rng.random()
+        self.delay = 0.2 if roll < 0.01 else rng.uniform(0.0002, 0.002)
+        self.broken = 0.01 <= roll < 0.015
+
+    async def send(self, message: dict):
+        await asyncio.sleep(self.delay)
+        if self.broken:
+            raise RuntimeError("socket closed")
+
+    async def send_text(self, data: str):
+        await self.send({"type": "websocket.send", "text": data})
+
+PAYLOAD = {"type": "announcement", "message": "Counselling hours extended this week", "campus_id": "UGN-MAIN", "recipients": list(range(50))}
+
+async def serial(sockets) -> int:
+    failed = 0
+    for connection in sockets.values():
+        try:
+            await connection.send_text(json.dumps(PAYLOAD))
+        except RuntimeError:
+            failed += 1
+    return failed
+
+async def concurrent(sockets, concurrency: int) -> int:
+    result = await fan_out(sockets.items(), PAYLOAD, concurrency=concurrency, send_timeout=5.0)
+    return len(result.failed)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--concurrency", type=int, default=256)
+    parser.add_argument("--skip-serial-above", type=int, default=1000, help="The serial loop takes ~4 s per 1k sockets")
+    args = parser.parse_args()
+
+    print(f"{'sockets':>8}{'mode':>12}{'seconds':>10}{'failed':>8}")
+    for size in args.sizes:
+        rng = random.Random(size)
+        sockets = {f"client_{i}": SimulatedSocket(rng) for i in range(size)}
+        modes = [("fan_out", lambda: concurrent(sockets, args.concurrency))]
+        if size <= args.skip_serial_above:
+            modes.insert(0, ("serial", lambda: serial(sockets)))
+        for name, run in modes:
+            started = time.perf_counter()
+            failed = asyncio.run(run())
+            print(f"{size:>8}{name:>12}{time.perf_counter() - started:>10.3f}{failed:>8}")
+
+if __name__ == "__main__":
+    import logging
+    logging.disable(logging.WARNING)
+    main()
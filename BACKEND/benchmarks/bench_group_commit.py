@@ -0,0 +1,85 @@
+"""
+Throughput of persistent message writes: one commit per message versus the
+group-commit writer used by /chat/send-persistent.
+
+Both modes insert the same ChatMessage rows into a temporary SQLite database
+from `--concurrency` concurrent senders. Every insert is acknowledged only
+after its commit returns in both modes. Inserts that fail (e.g. SQLite's
+"database is locked" when many writers contend) are counted, not retried.
+
+Usage (from BACKEND/):
+    python benchmarks/bench_group_commit.py [--messages 2000] [--concurrency 50]
+"""
+import os
+import sys
+import time
+import uuid
+import asyncio
+import argparse
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TMP = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(TMP, 'bench.db')}"
+
+import logging
+
+from config import Config
+from database import AsyncSessionLocal, engine
+from models import Base, ChatMessage
+from group_commit import GroupCommitWriter
+
+def new_message(i: int) -> ChatMessage:
+    return ChatMessage(
+        message_id=str(uuid.uuid4()),
+        sender_id="BENCH_SENDER",
+        recipient_id="BENCH_RECIPIENT",
+        ipfs_hash=f"Qm_bench_{i}",
+        conversation_id="conv_BENCH_RECIPIENT_BENCH_SENDER",
+        timestamp=datetime.utcnow(),
+    )
+
+async def commit_each(i: int):
+    async with AsyncSessionLocal() as db:
+        db.add(new_message(i))
+        await db.commit()
+
+async def run(insert, messages: int, concurrency: int) -> tuple[float, int]:
+    counter = iter(range(messages))
+    failed = 0
+
+    async def sender():
+        nonlocal failed
+        for i in counter:
+            try:
+                await insert(i)
+            except Exception:
+                failed += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender() for _ in range(concurrency)))
+    return time.perf_counter() - started, failed
+
+async def main_(args):
+    writer = GroupCommitWriter(AsyncSessionLocal, window=Config.GROUP_COMMIT_WINDOW_MS / 1000, max_batch=Config.GROUP_COMMIT_MAX_BATCH)
+
+    async def group_commit(i: int):
+        await writer.submit(new_message(i))
+
+    print(f"messages={args.messages} concurrency={args.concurrency} window={Config.GROUP_COMMIT_WINDOW_MS} ms")
+    print(f"{'mode':<14}{'seconds':>9}{'msgs/s':>10}{'failed':>8}")
+    for name, insert in (("commit each", commit_each), ("group commit", group_commit)):
+        seconds, failed = await run(insert, args.messages, args.concurrency)
+        print(f"{name:<14}{seconds:>9.2f}{(args.messages - failed) / seconds:>10.0f}{failed:>8}")
+    await writer.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    Base.metadata.create_all(bind=engine)
+    asyncio.run(main_(args))
@@ -0,0 +1,80 @@
+"""
+Page latency for conversation history: OFFSET vs keyset cursors.
+
+Seeds one conversation with --messages rows (plus noise in other conversations)
+into a temporary SQLite database with the composite index from models.py.
+It then times fetching a 50-row page at increasing depths, first with
+ORDER BY ... OFFSET and then with the (timestamp, id) keyset predicate that
+/chat/history uses.
+
+Usage (from BACKEND/):
+    python benchmarks/bench_history.py [--messages 200000] [--page 50]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, insert, select, tuple_
+from sqlalchemy.orm import Session
+
+from models import Base, ChatMessage
+
+CONVERSATION = "conv_BENCH_A_BENCH_B"
+
+def seed(engine, messages: int):
+    Base.metadata.create_all(bind=engine)
+    start = datetime(2025, 1, 1)
+    rows = []
+    for i in range(messages):
+        rows.append({"conversation_id": CONVERSATION, "sender_id": "BENCH_A", "recipient_id": "BENCH_B",
+                     "ipfs_hash": f"h{i}", "message_id": f"m{i}", "timestamp": start + timedelta(seconds=i)})
+        rows.append({"conversation_id": f"conv_noise_{i % 1000}", "sender_id": "X", "recipient_id": "Y",
+                     "ipfs_hash": f"n{i}", "message_id": f"n{i}", "timestamp": start + timedelta(seconds=i)})
+    with engine.begin() as conn:
+        for i in range(0, len(rows), 10000):
+            conn.execute(insert(ChatMessage), rows[i:i + 10000])
+
+def newest_first():
+    return (select(ChatMessage).where(ChatMessage.conversation_id == CONVERSATION)
+            .order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc()))
+
+def timed(db: Session, query, repeat: int = 20) -> tuple[float, list]:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        rows = db.scalars(query).all()
+        db.expunge_all()
+    return (time.perf_counter() - started) / repeat * 1000, rows
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--page", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        seed(engine, args.messages)
+        print(f"messages in conversation={args.messages} page={args.page}")
+        print(f"{'depth':>8}{'offset ms':>12}{'keyset ms':>12}")
+        with Session(engine) as db:
+            for depth in (0, 1000, 10000, 100000, args.messages - args.page):
+                if depth > args.messages - args.page:
+                    continue
+                offset_ms, offset_rows = timed(db, newest_first().offset(depth).limit(args.page))
+                # The cursor a client would hold after reading `depth` rows
+                cursor = db.execute(newest_first().with_only_columns(ChatMessage.timestamp, ChatMessage.id).offset(depth - 1).limit(1)).one() if depth else None
+                keyset = newest_first()
+                if cursor:
+                    keyset = keyset.where(tuple_(ChatMessage.timestamp, ChatMessage.id) < tuple_(*cursor))
+                keyset_ms, keyset_rows = timed(db, keyset.limit(args.page))
+                assert [r.id for r in offset_rows] == [r.id for r in keyset_rows]
+                print(f"{depth:>8}{offset_ms:>12.2f}{keyset_ms:>12.2f}")
+        engine.dispose()
+
+if __name__ == "__main__":
+    main()
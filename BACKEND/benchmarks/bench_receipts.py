@@ -0,0 +1,107 @@
+"""
+Frames and write syscalls saved by delivery receipt coalescing.
+
+Runs the real app under uvicorn on a temporary SQLite database, connects a
+student and a counselor over /ws/{user_id}, and has the student send messages
+at a fixed interval (a fast typer). It counts the frames the student receives
+until every message has a receipt, with plain receipts and then with
+?receipts=batched. It also counts the process's write syscalls from
+/proc/self/io; the server and client share the process, and the client's
+writes are the same in both runs.
+
+Usage (from BACKEND/):
+    python benchmarks/bench_receipts.py [--messages 200] [--interval-ms 20]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TMP = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(TMP, 'bench.db')}"
+os.environ.setdefault("BACKPLANE_TRANSPORT", "local")
+os.makedirs(os.path.join(TMP, "static"))
+os.chdir(TMP)  # Keep static/ and QR output of the app out of the source tree
+
+import logging
+import uvicorn
+import websockets
+from fastapi.testclient import TestClient
+
+import main
+
+def write_syscalls() -> int:
+    with open("/proc/self/io") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith("syscw"))
+
+def seed() -> tuple[str, str]:
+    client = TestClient(main.app)
+    client.post("/admin/schools/create", json={"name": "Bench", "school_id": "BENCH"})
+    counselor = client.post("/admin/counselors/create", json={"name": "Bench Counselor", "email": "c@bench", "password": "pw", "campus_id": "BENCH"}).json()
+    student = client.post("/auth/register", json={"password": "pw"}).json()
+    client.post("/auth/student/affiliate", json={"campus_id": "BENCH", "user_id": student["user_id"], "cardano_did": "did", "password": "pw"})
+    return student["user_id"], counselor["user_id"]
+
+async def run(port: int, student: str, counselor: str, batched: bool, messages: int, interval: float) -> dict:
+    query = "?receipts=batched" if batched else ""
+    async with websockets.connect(f"ws://127.0.0.1:{port}/ws/{student}{query}") as ws_s, \
+               websockets.connect(f"ws://127.0.0.1:{port}/ws/{counselor}") as ws_c:
+        async def drain_counselor():
+            for _ in range(messages):
+                await ws_c.recv()
+
+        counselor_task = asyncio.create_task(drain_counselor())
+        syscalls_before = write_syscalls()
+        started = time.perf_counter()
+
+        async def type_messages():
+            for i in range(messages):
+                await ws_s.send(json.dumps({"recipient_user_id": counselor, "message": f"message {i}", "message_id": f"{batched}-{i}"}))
+                await asyncio.sleep(interval)
+
+        typer = asyncio.create_task(type_messages())
+        frames = receipts = 0
+        while receipts < messages:
+            frame = json.loads(await ws_s.recv())
+            frames += 1
+            receipts += len(frame["receipts"]) if frame.get("type") == "delivery_receipts" else 1
+        await typer
+        await counselor_task
+        return {
+            "frames": frames,
+            "write_syscalls": write_syscalls() - syscalls_before,
+            "seconds": time.perf_counter() - started,
+        }
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--interval-ms", type=float, default=20)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    student, counselor = seed()
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="error"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+    print(f"messages={args.messages} interval={args.interval_ms} ms window={main.Config.RECEIPT_COALESCE_MS} ms")
+    print(f"{'receipts':<10}{'frames':>8}{'write syscalls':>16}{'seconds':>9}")
+    for batched in (False, True):
+        result = asyncio.run(run(port, student, counselor, batched, args.messages, args.interval_ms / 1000))
+        print(f"{'batched' if batched else 'plain':<10}{result['frames']:>8}{result['write_syscalls']:>16}{result['seconds']:>9.2f}")
+    server.should_exit = True
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,80 @@
+"""
+Write-contention benchmark for the SQLite profiles in database.py.
+
+Many concurrent async writers each insert ChatMessage rows and commit one
+row per transaction, the pattern of /chat/send-persistent. The same load
+runs against a fresh database file with the default profile and then with
+the production profile (WAL, busy_timeout, mmap, pooled connections).
+A concurrent reader runs at the same time to show whether readers are
+blocked by the writers.
+
+Usage (from BACKEND/):
+    python benchmarks/bench_sqlite_profile.py [--writers 32] [--rows 100]
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from models import Base, ChatMessage
+from database import build_async_engine
+
+async def run(db_path: str, profile: str, writers: int, rows: int) -> dict:
+    engine = build_async_engine(f"sqlite+aiosqlite:///{db_path}", profile)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    Session = async_sessionmaker(engine, expire_on_commit=False)
+    errors = 0
+    reads = 0
+    done = asyncio.Event()
+
+    async def writer(n: int):
+        nonlocal errors
+        for i in range(rows):
+            async with Session() as db:
+                db.add(ChatMessage(conversation_id=f"conv_{n % 8}", sender_id=f"s{n}", recipient_id="r", ipfs_hash=f"h{n}_{i}"))
+                try:
+                    await db.commit()
+                except OperationalError:
+                    errors += 1
+                    await db.rollback()
+
+    async def reader():
+        nonlocal reads
+        while not done.is_set():
+            async with Session() as db:
+                await db.scalar(select(func.count()).select_from(ChatMessage).where(ChatMessage.conversation_id == "conv_0"))
+            reads += 1
+
+    reader_task = asyncio.create_task(reader())
+    started = time.perf_counter()
+    await asyncio.gather(*(writer(n) for n in range(writers)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await reader_task
+    await engine.dispose()
+    return {"commits_per_s": (writers * rows - errors) / elapsed, "errors": errors, "reads_per_s": reads / elapsed, "seconds": elapsed}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=32)
+    parser.add_argument("--rows", type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"writers={args.writers} rows/writer={args.rows}")
+    print(f"{'profile':<12}{'commits/s':>12}{'reads/s':>10}{'locked':>8}{'seconds':>9}")
+    for profile in ("default", "production"):
+        with tempfile.TemporaryDirectory() as tmp:
+            result = asyncio.run(run(os.path.join(tmp, "bench.db"), profile, args.writers, args.rows))
+        print(f"{profile:<12}{result['commits_per_s']:>12.0f}{result['reads_per_s']:>10.0f}{result['errors']:>8}{result['seconds']:>9.2f}")
+
+if __name__ == "__main__":
+    main()
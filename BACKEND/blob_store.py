@@ -0,0 +1,185 @@
+import os
+import mmap
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from typing import Iterable, Optional
+
+from config import Config
+from metrics import metrics
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Message content is stored by its content hash (sha256, hex). A backend only
+# needs put_many() -> digests and get_many() -> {digest: bytes}; an IPFS client
+# can implement the same two calls and be selected in build_blob_store().
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+class SegmentBlobStore:
+    """
+    Blobs packed back to back into append-only segment files under `root`,
+    with a small SQLite index (digest -> segment, offset, length) next to them.
+
+    Identical content is stored once. Writes from every worker process on the
+    host are serialized by an IMMEDIATE transaction on the index: the bytes are
+    appended (and fsynced) first and indexed second, so a crash can leave unused
+    bytes at the end of a segment but never an index entry without its data.
+    Reads slice memory-mapped segments; a segment is remapped only when it has
+    grown past the end of its current mapping.
+    """
+    INDEX_CHUNK = 500  # Digests per IN (...) lookup, well under SQLite's variable limit
+
+    def __init__(self, root: str, segment_max_bytes: int, fsync: bool = True):
+        self.root = root
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync = fsync
+        os.makedirs(root, exist_ok=True)
+        self._local = threading.local()
+        self._maps: dict[int, mmap.mmap] = {}
+        self._maps_lock = threading.Lock()
+        self._waiting: list[tuple[bytes, asyncio.Future]] = []
+        self._flusher: Optional[asyncio.Task] = None
+        self._bytes_written = metrics.counter("blob_store.bytes_written")
+        self._dedup_hits = metrics.counter("blob_store.dedup_hits")
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                "digest TEXT PRIMARY KEY, segment INTEGER NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.root, "index.db"), timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.root, f"segment-{segment:06d}.dat")
+
+    def _lookup(self, conn: sqlite3.Connection, digests: list[str]) -> dict[str, tuple[int, int, int]]:
+        found = {}
+        for i in range(0, len(digests), self.INDEX_CHUNK):
+            chunk = digests[i:i + self.INDEX_CHUNK]
+            rows = conn.execute(
+                f"SELECT digest, segment, offset, length FROM blobs WHERE digest IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for digest, segment, offset, length in rows:
+                found[digest] = (segment, offset, length)
+        return found
+
+    # --- Writes ---
+    def _put_many(self, blobs: list[bytes]) -> list[str]:
+        digests = [content_hash(data) for data in blobs]
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            known = self._lookup(conn, list(set(digests)))
+            new = {}
+            for digest, data in zip(digests, blobs):
+                if digest in known or digest in new:
+                    self._dedup_hits.inc()
+                else:
+                    new[digest] = data
+            if new:
+                conn.executemany("INSERT INTO blobs (digest, segment, offset, length) VALUES (?, ?, ?, ?)", self._append(conn, new))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return digests
+
+    def _append(self, conn: sqlite3.Connection, new: dict[str, bytes]) -> list[tuple[str, int, int, int]]:
+        """Append blobs to the tail segment, rolling over when it is full. Caller holds the write lock."""
+        segment = conn.execute("SELECT MAX(segment) FROM blobs").fetchone()[0] or 1
+        rows = []
+        f = open(self._segment_path(segment), "ab")
+        try:
+            for digest, data in new.items():
+                offset = f.tell()  # The real end of file, including bytes a crashed writer left unindexed
+                if offset and offset + len(data) > self.segment_max_bytes:
+                    self._sync(f)
+                    f.close()
+                    segment += 1
+                    f = open(self._segment_path(segment), "ab")
+                    offset = f.tell()
+                f.write(data)
+                rows.append((digest, segment, offset, len(data)))
+                self._bytes_written.inc(len(data))
+            self._sync(f)
+        finally:
+            f.close()
+        return rows
+
+    def _sync(self, f):
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    # --- Reads ---
+    def _map(self, segment: int, end: int) -> mmap.mmap:
+        with self._maps_lock:
+            mapped = self._maps.get(segment)
+            if mapped is None or len(mapped) < end:
+                # Older mappings are left to the garbage collector: another thread may still be reading one
+                with open(self._segment_path(segment), "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[segment] = mapped
+            return mapped
+
+    def _get_many(self, digests: list[str]) -> dict[str, bytes]:
+        blobs = {}
+        for digest, (segment, offset, length) in self._lookup(self._connect(), list(set(digests))).items():
+            blobs[digest] = self._map(segment, offset + length)[offset:offset + length] if length else b""
+        return blobs
+
+    # --- Async interface ---
+    async def put_many(self, blobs: list[bytes]) -> list[str]:
+        """Store each blob (once per distinct content) and return their digests, in order."""
+        return await asyncio.to_thread(self._put_many, blobs)
+
+    async def put(self, data: bytes) -> str:
+        """
+        Store one blob. Puts that arrive while a write is in progress are
+        combined into the next put_many(), so concurrent senders share one
+        append, fsync and index transaction instead of queueing for the lock.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append((data, future))
+        if self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not asyncio.get_running_loop():
+            self._flusher = asyncio.create_task(self._flush_waiting())
+        return await future
+
+    async def _flush_waiting(self):
+        while self._waiting:
+            batch, self._waiting = self._waiting, []
+            try:
+                digests = await self.put_many([data for data, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), digest in zip(batch, digests):
+                if not future.done():
+                    future.set_result(digest)
+
+    async def get_many(self, digests: Iterable[str]) -> dict[str, bytes]:
+        """Content for the digests that are stored; unknown digests are left out."""
+        return await asyncio.to_thread(self._get_many, list(digests))
+
+    async def get(self, digest: str) -> Optional[bytes]:
+        return (await self.get_many([digest])).get(digest)
+
+def build_blob_store(name: str):
+    if name == "segments":
+        return SegmentBlobStore(Config.BLOB_STORE_DIR, Config.BLOB_STORE_SEGMENT_MAX_BYTES, fsync=Config.BLOB_STORE_FSYNC)
+    raise ValueError(f"Unknown BLOB_STORE_BACKEND '{name}', expected 'segments'")
+
+blob_store = build_blob_store(Config.BLOB_STORE_BACKEND)
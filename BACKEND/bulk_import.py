@@ -0,0 +1,249 @@
+import csv
+import json
+import asyncio
+import logging
+from typing import AsyncIterator, Optional
+
+from fastapi import HTTPException
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from config import Config
+from database import AsyncSessionLocal
+from metrics import metrics
+from models import School, CounselorUser
+from auth import get_password_hash_async, password_pool
+from principals import taken_principals, principal_exists, counselor_id_base
+from qr_cache import qr_cache
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# --- Parsing ---
+# Both readers yield (record, error) pairs, one per input line after the CSV header.
+async def iter_csv_records(lines: AsyncIterator[str]) -> AsyncIterator[tuple[Optional[dict], Optional[str]]]:
+    """CSV with a header row; empty cells count as missing. Quoted cells can't contain line breaks."""
+    header = None
+    async for line in lines:
+        try:
+            cells = next(csv.reader([line.rstrip("\r")]))
+        except csv.Error as e:
+            yield None, f"Invalid CSV line: {e}"
+            continue
+        if header is None:
+            header = [cell.strip().lstrip("\ufeff").lower() for cell in cells]
+            continue
+        yield {key: value.strip() for key, value in zip(header, cells) if value.strip()}, None
+
+async def iter_json_records(lines: AsyncIterator[str]) -> AsyncIterator[tuple[Optional[dict], Optional[str]]]:
+    async for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield None, f"Invalid JSON: {e}"
+            continue
+        if isinstance(record, dict):
+            yield record, None
+        else:
+            yield None, "Each line must be a JSON object"
+
+def parse_record(record: dict, row_models: dict[str, type[BaseModel]]) -> tuple[Optional[str], Optional[BaseModel], Optional[str]]:
+    """Pick the row model from the record's "type" and validate the rest of it."""
+    row_type = str(record.get("type", "")).strip().lower()
+    model = row_models.get(row_type)
+    if model is None:
+        return None, None, f"Unknown row type '{row_type}', expected one of {sorted(row_models)}"
+    try:
+        return row_type, model.model_validate({key: value for key, value in record.items() if key != "type"}), None
+    except ValidationError as e:
+        error = e.errors(include_url=False)[0]
+        return row_type, None, f"Invalid row: {error['msg']} at {list(error['loc'])}"
+
+# --- Import ---
+class BulkImporter:
+    """
+    Imports a stream of school and counselor rows in chunks of `batch_size`.
+
+    For each chunk, the importer:
+    - validates the rows against the database with a few set-based queries;
+    - hashes the remaining counselor passwords in parallel on the bcrypt pool;
+    - inserts everything in one transaction.
+
+    A row that fails only produces an error line for that row. If the chunk's
+    commit fails (e.g. a concurrent create, or the database is locked), the
+    chunk is retried row by row; a database error is reported on the rows it
+    hit, so the stream always ends with its summary line. QR codes are
+    refreshed once per affected school after the last chunk.
+    """
+    def __init__(self, session_factory: async_sessionmaker, batch_size: int):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self._created = metrics.counter("bulk_import.rows_created")
+        self._failed = metrics.counter("bulk_import.rows_failed")
+
+    async def stream(self, records: AsyncIterator[tuple[Optional[dict], Optional[str]]], row_models: dict[str, type[BaseModel]]) -> AsyncIterator[str]:
+        """Yield one NDJSON result line per input row, in order, then a summary line."""
+        chunk = []
+        affected_schools = set()
+        created = failed = 0
+        index = 0
+        async for record, error in records:
+            row_type, item = None, None
+            if error is None:
+                row_type, item, error = parse_record(record, row_models)
+            chunk.append({"index": index, "type": row_type, "item": item, "error": error})
+            index += 1
+            if len(chunk) < self.batch_size:
+                continue
+            affected_schools |= await self.import_chunk(chunk)
+            lines, chunk_created = self._result_lines(chunk)
+            created, failed, chunk = created + chunk_created, failed + len(chunk) - chunk_created, []
+            yield lines
+
+        if chunk:
+            affected_schools |= await self.import_chunk(chunk)
+            lines, chunk_created = self._result_lines(chunk)
+            created, failed = created + chunk_created, failed + len(chunk) - chunk_created
+            yield lines
+
+        for school_id in sorted(affected_schools):
+            try:
+                await qr_cache.get(school_id)
+            except Exception as e:
+                logging.error(f"Bulk import: QR refresh for school {school_id} failed: {e}")
+        logging.info(f"Bulk import finished: {created} rows created, {failed} failed, {len(affected_schools)} schools updated")
+        yield json.dumps({"done": True, "created": created, "failed": failed, "schools_updated": len(affected_schools)}) + "\n"
+
+    def _result_lines(self, chunk: list[dict]) -> tuple[str, int]:
+        lines = []
+        created = 0
+        for row in chunk:
+            if row["error"]:
+                lines.append(json.dumps({"index": row["index"], "error": row["error"]}))
+            else:
+                lines.append(json.dumps({"index": row["index"], "type": row["type"], "status": "created", **row["result"]}))
+                created += 1
+        self._created.inc(created)
+        self._failed.inc(len(chunk) - created)
+        return "\n".join(lines) + "\n", created
+
+    async def import_chunk(self, chunk: list[dict]) -> set[str]:
+        """Insert a chunk's valid rows, setting each row's "result" or "error". Returns the affected school IDs."""
+        schools = [row for row in chunk if not row["error"] and row["type"] == "school"]
+        counselors = [row for row in chunk if not row["error"] and row["type"] == "counselor"]
+
+        # Validate in a short read-only session. Hashing takes seconds, and
+        # holding a read transaction that long would go stale before we write.
+        try:
+            async with self.session_factory() as db:
+                await self._check_schools(db, schools)
+                await self._check_counselors(db, counselors, {row["item"].school_id for row in schools if not row["error"]})
+        except SQLAlchemyError as e:
+            logging.error(f"Bulk import: validating a chunk failed: {e}")
+            for row in schools + counselors:
+                row["error"] = row["error"] or f"Database error: {getattr(e, 'orig', None) or e}"
+            return set()
+        await self._hash_passwords([row for row in counselors if not row["error"]])
+
+        rows = [row for row in chunk if not row["error"] and row["type"] in ("school", "counselor")]
+        for row in rows:
+            row["object"] = self._build(row)
+        async with self.session_factory() as db:
+            db.add_all([row["object"] for row in rows])
+            try:
+                await db.commit()
+            except SQLAlchemyError as e:
+                logging.warning(f"Bulk import: chunk commit failed, retrying row by row: {e}")
+                await db.rollback()
+                await self._commit_one_by_one(db, rows)
+
+        affected = set()
+        for row in rows:
+            del row["object"]  # Expired by any rollback; report from the validated row instead
+            if row["error"]:
+                continue
+            item = row["item"]
+            if row["type"] == "school":
+                row["result"] = {"school_id": item.school_id, "name": item.name}
+                affected.add(item.school_id)
+            else:
+                row["result"] = {"user_id": row["user_id"], "name": item.name, "email": item.email, "campus_id": item.campus_id}
+                affected.add(item.campus_id)
+        return affected
+
+    async def _check_schools(self, db: AsyncSession, rows: list[dict]):
+        school_ids = {row["item"].school_id for row in rows}
+        taken = set((await db.scalars(select(School.id).where(School.id.in_(school_ids)))).all())
+        for row in rows:
+            school_id = row["item"].school_id
+            if school_id in taken:
+                row["error"] = f"School with ID '{school_id}' already exists"
+            taken.add(school_id)  # Later rows in this import with the same ID fail too
+
+    async def _check_counselors(self, db: AsyncSession, rows: list[dict], new_school_ids: set[str]):
+        campus_ids = {row["item"].campus_id for row in rows}
+        known_campuses = set((await db.scalars(select(School.id).where(School.id.in_(campus_ids)))).all()) | new_school_ids
+        emails = {row["item"].email for row in rows}
+        used_emails = set((await db.scalars(select(CounselorUser.email).where(CounselorUser.email.in_(emails)))).all())
+        taken_ids = await taken_principals(db, {counselor_id_base(row["item"].name) for row in rows})
+
+        for row in rows:
+            item = row["item"]
+            if item.campus_id not in known_campuses:
+                row["error"] = f"School with ID '{item.campus_id}' not found"
+            elif item.email in used_emails:
+                row["error"] = f"Email '{item.email}' is already in use by another counselor"
+            else:
+                used_emails.add(item.email)
+                row["user_id"] = await self._unique_counselor_id(db, counselor_id_base(item.name), taken_ids)
+                taken_ids.add(row["user_id"])
+
+    async def _unique_counselor_id(self, db: AsyncSession, base: str, taken_ids: set[str]) -> str:
+        """Same scheme as /admin/counselors/create; only colliding names cost extra queries."""
+        user_id, count = base, 1
+        while user_id in taken_ids or (user_id != base and await principal_exists(db, user_id)):
+            user_id = f"{base}_{count}"
+            count += 1
+        return user_id
+
+    async def _hash_passwords(self, rows: list[dict]):
+        # Never more jobs than bcrypt threads, so the pool's queue stays free for logins
+        limit = asyncio.Semaphore(password_pool.workers)
+
+        async def hash_one(row):
+            async with limit:
+                try:
+                    row["password_hash"] = await get_password_hash_async(row["item"].password)
+                except HTTPException as e:
+                    row["error"] = f"Password hashing failed: {e.detail}"
+
+        await asyncio.gather(*(hash_one(row) for row in rows))
+
+    def _build(self, row: dict):
+        item = row["item"]
+        if row["type"] == "school":
+            return School(id=item.school_id, name=item.name, location=item.location)
+        return CounselorUser(
+            id=row["user_id"],
+            name=item.name,
+            email=item.email,
+            password_hash=row["password_hash"],
+            campus_id=item.campus_id,
+            cardano_did=None
+        )
+
+    async def _commit_one_by_one(self, db: AsyncSession, rows: list[dict]):
+        """Fallback when a chunk's commit fails, e.g. on rows written since it was validated."""
+        for row in rows:
+            db.add(row["object"])
+            try:
+                await db.commit()
+            except IntegrityError as e:
+                await db.rollback()
+                row["error"] = f"Conflicts with an existing record: {e.orig}"
+            except SQLAlchemyError as e:
+                await db.rollback()
+                row["error"] = f"Database error: {getattr(e, 'orig', None) or e}"
+
+bulk_importer = BulkImporter(AsyncSessionLocal, batch_size=Config.BULK_IMPORT_BATCH_SIZE)
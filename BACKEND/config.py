@@ -21,6 +21,16 @@ class Config:
         "*"                       # Allow all origins (only for development!)
     ]
     DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./app_data.db")
+    ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL")  # Derived from DATABASE_URL when unset (sqlite -> sqlite+aiosqlite)
+
+    # --- SQLite Profile ---
+    # "production" enables WAL, busy_timeout, a bigger page cache, mmap reads and a sized connection pool
+    SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "default")
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+    SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))  # 64 MiB page cache per connection
+    SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))  # Bytes of the DB file to memory-map
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
 
     # --- Oracle Private Keys ---
     _campus_oracle_private_key = None
@@ -80,9 +90,88 @@ class Config:
 
     # --- NLP Danger Detection Settings ---
     NLP_DANGER_KEYWORDS = [k.strip() for k in os.getenv("NLP_DANGER_KEYWORDS", "").split(',') if k.strip()]
+    NLP_PATTERNS_FILE = os.getenv("NLP_PATTERNS_FILE", "nlp_patterns.json")  # Reloadable via /admin/nlp/patterns/reload
+    NLP_PATTERNS_CHECK_SECONDS = float(os.getenv("NLP_PATTERNS_CHECK_SECONDS", "5"))  # How often each worker checks the file for changes (0 = never)
     EMERGENCY_CONTACT_PHONE = os.getenv("EMERGENCY_CONTACT_PHONE", "+233551234567")
     EMERGENCY_CONTACT_EMAIL = os.getenv("EMERGENCY_CONTACT_EMAIL", "security@campus.edu")
 
+    # --- NLP Batch Scanning Settings ---
+    NLP_BATCH_MAX_ITEMS = int(os.getenv("NLP_BATCH_MAX_ITEMS", "10000"))  # Max messages per JSON batch request
+    NLP_BATCH_PARALLEL_THRESHOLD = int(os.getenv("NLP_BATCH_PARALLEL_THRESHOLD", "2000"))  # Smaller batches are scanned inline
+    NLP_BATCH_CHUNK_SIZE = int(os.getenv("NLP_BATCH_CHUNK_SIZE", "500"))  # Messages per worker task
+    NLP_BATCH_WORKERS = int(os.getenv("NLP_BATCH_WORKERS", "0"))  # 0 = one per CPU core
+    NLP_BATCH_MAX_IN_FLIGHT = int(os.getenv("NLP_BATCH_MAX_IN_FLIGHT", "8"))  # Chunks buffered by NDJSON streams
+
+    # --- WebSocket Message Screening Settings ---
+    SCREENING_WORKERS = int(os.getenv("SCREENING_WORKERS", "4"))  # Lanes / worker threads
+    SCREENING_QUEUE_DEPTH = int(os.getenv("SCREENING_QUEUE_DEPTH", "100"))  # Pending messages per lane
+    SCREENING_ENQUEUE_TIMEOUT = float(os.getenv("SCREENING_ENQUEUE_TIMEOUT", "2.0"))  # Seconds a sender waits on a full lane
+
+    # --- WebSocket Send Queues ---
+    WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))  # Outbound messages buffered per connection
+    WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "drop_oldest")  # "drop_oldest" (non-critical only) or "disconnect"
+    WS_BATCH_MAX_MESSAGES = int(os.getenv("WS_BATCH_MAX_MESSAGES", "32"))  # Messages per frame for batching protocols (msgpack)
+
+    # --- Delivery Receipt Coalescing (clients opt in with ?receipts=batched) ---
+    RECEIPT_COALESCE_MS = int(os.getenv("RECEIPT_COALESCE_MS", "50"))  # Window receipts are buffered for
+    RECEIPT_COALESCE_MAX = int(os.getenv("RECEIPT_COALESCE_MAX", "50"))  # Send early once this many are waiting
+
+    # --- Broadcast Fan-out ---
+    FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "256"))  # Sends in flight per broadcast
+    FANOUT_SEND_TIMEOUT = float(os.getenv("FANOUT_SEND_TIMEOUT", "5.0"))  # Seconds before a slow socket counts as failed
+
+    # --- Persistent Message Writes ---
+    CHAT_BATCH_MAX_ITEMS = int(os.getenv("CHAT_BATCH_MAX_ITEMS", "500"))  # Messages per /chat/send-persistent/batch request
+    GROUP_COMMIT_WINDOW_MS = float(os.getenv("GROUP_COMMIT_WINDOW_MS", "5"))  # How long single sends wait to share a commit
+    GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "256"))  # Rows per group commit
+
+    # --- School Directory ---
+    SCHOOL_DIRECTORY_TTL_SECONDS = float(os.getenv("SCHOOL_DIRECTORY_TTL_SECONDS", "30"))  # Bounds staleness across workers; local writes invalidate at once
+    SCHOOL_DATA_MAX_AGE = int(os.getenv("SCHOOL_DATA_MAX_AGE", "0"))  # Cache-Control max-age for /api/school/{school_id}; clients revalidate with If-None-Match
+
+    # --- Bulk Import ---
+    BULK_IMPORT_BATCH_SIZE = int(os.getenv("BULK_IMPORT_BATCH_SIZE", "200"))  # Rows per transaction in /admin/schools/import
+
+    # --- QR Codes ---
+    QR_CACHE_MAX_ENTRIES = int(os.getenv("QR_CACHE_MAX_ENTRIES", "1024"))  # Rendered school QR PNGs kept in memory
+
+    # --- Message Content Blob Store ---
+    BLOB_STORE_BACKEND = os.getenv("BLOB_STORE_BACKEND", "segments")  # Content-addressed storage for persistent message bodies
+    BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR", "blobs")  # Segment files plus their index.db
+    BLOB_STORE_SEGMENT_MAX_BYTES = int(os.getenv("BLOB_STORE_SEGMENT_MAX_BYTES", str(64 * 1024 * 1024)))  # Roll over to a new segment past this size
+    BLOB_STORE_FSYNC = os.getenv("BLOB_STORE_FSYNC", "true").lower() == "true"  # fsync segments before indexing (before acknowledging)
+
+    # --- Conversation History ---
+    HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "200"))  # Upper bound for ?limit= on /chat/history
+
+    # --- Offline Delivery Queue ---
+    OFFLINE_QUEUE_MAX_PER_RECIPIENT = int(os.getenv("OFFLINE_QUEUE_MAX_PER_RECIPIENT", "500"))  # Oldest are dropped beyond this
+    OFFLINE_QUEUE_TTL_HOURS = float(os.getenv("OFFLINE_QUEUE_TTL_HOURS", "72"))  # Undelivered messages expire after this
+    OFFLINE_QUEUE_FLUSH_BATCH = int(os.getenv("OFFLINE_QUEUE_FLUSH_BATCH", "100"))  # Rows read/deleted per batch on reconnect
+
+    # --- Cross-worker WebSocket Backplane ---
+    BACKPLANE_TRANSPORT = os.getenv("BACKPLANE_TRANSPORT", "local")  # "local" (single worker) or "unix" (one worker per core)
+    BACKPLANE_SOCKET_DIR = os.getenv("BACKPLANE_SOCKET_DIR", "/tmp/bridging-barz-backplane")  # Shared by all workers on the host
+    BACKPLANE_OUTBOX_SIZE = int(os.getenv("BACKPLANE_OUTBOX_SIZE", "10000"))  # Frames queued for other workers
+
+    ROUTING_CACHE_MAX_RECIPIENTS = int(os.getenv("ROUTING_CACHE_MAX_RECIPIENTS", "10000"))  # Cached (campus, recipient) checks
+    ROUTING_CACHE_TTL_SECONDS = float(os.getenv("ROUTING_CACHE_TTL_SECONDS", "30"))  # Bounds staleness across workers; local writes invalidate at once
+    ROUTING_CACHE_NEGATIVE_TTL_SECONDS = float(os.getenv("ROUTING_CACHE_NEGATIVE_TTL_SECONDS", "2"))  # Unknown senders and invalid recipients
+
+    # --- Password Hashing Pool ---
+    PASSWORD_POOL_WORKERS = int(os.getenv("PASSWORD_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+    PASSWORD_POOL_MAX_QUEUE = int(os.getenv("PASSWORD_POOL_MAX_QUEUE", "32"))  # Waiting jobs before logins get a 503
+
+    # --- Rate Limiting ---
+    RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # "memory" (per process) or "sqlite" (shared by all workers on the host)
+    RATE_LIMIT_SQLITE_PATH = os.getenv("RATE_LIMIT_SQLITE_PATH", "rate_limits.db")
+    RATE_LIMIT_DEFAULT = os.getenv("RATE_LIMIT_DEFAULT", "5/10s")  # Burst/refill window for rate-limited routes
+    RATE_LIMIT_ROUTES = os.getenv("RATE_LIMIT_ROUTES", "")  # Per-route overrides, e.g. "/api/school/{school_id}=30/1m"
+    RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))  # Memory backend LRU bound
+
+    # --- Verified JWT Cache ---
+    TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))  # Verified JWT payloads kept in memory (0 = off)
+
     # --- Admin Panel Settings ---
     ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "admin")
     ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "supersecretpassword") # Default for dev if not set
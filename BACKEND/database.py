@@ -0,0 +1,83 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession, AsyncEngine
+
+from config import Config
+
+# Async drivers for the sync URLs we accept in DATABASE_URL
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
+
+def to_async_url(url: str) -> str:
+    """Map a sync database URL (e.g. sqlite:///./app_data.db) to its asyncio driver."""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if "+" in parsed.drivername and parsed.drivername.split("+", 1)[1] in ("aiosqlite", "asyncpg", "aiomysql"):
+        return url
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for database backend '{backend}'. Set ASYNC_DATABASE_URL.")
+    return parsed.set(drivername=ASYNC_DRIVERS[backend]).render_as_string(hide_password=False)
+
+def _is_file_sqlite(url: str) -> bool:
+    parsed = make_url(url)
+    return parsed.get_backend_name() == "sqlite" and parsed.database not in (None, "", ":memory:")
+
+def _engine_args(url: str, profile: str, pool_class) -> dict:
+    args = {}
+    if make_url(url).get_backend_name() == "sqlite":
+        args["connect_args"] = {"check_same_thread": False}
+    if profile == "production" and _is_file_sqlite(url):
+        # A sized pool of long-lived connections, so pragmas and the page cache are kept
+        args.update(poolclass=pool_class, pool_size=Config.DB_POOL_SIZE, max_overflow=Config.DB_MAX_OVERFLOW, pool_pre_ping=False)
+    return args
+
+def apply_sqlite_profile(engine: Engine, url: str, profile: str):
+    """
+    Apply the SQLite production pragmas to every new connection:
+    WAL so readers don't block the writer, NORMAL sync (durable in WAL mode
+    except on power loss), a busy timeout instead of immediate 'database is
+    locked' errors, a larger page cache and memory-mapped reads.
+    """
+    if profile != "production" or not _is_file_sqlite(url):
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={Config.SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA cache_size=-{Config.SQLITE_CACHE_SIZE_KB}")  # Negative = size in KiB
+        cursor.execute(f"PRAGMA mmap_size={Config.SQLITE_MMAP_SIZE}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+def build_engine(url: str, profile: str) -> Engine:
+    engine = create_engine(url, **_engine_args(url, profile, QueuePool))
+    apply_sqlite_profile(engine, url, profile)
+    return engine
+
+def build_async_engine(url: str, profile: str) -> AsyncEngine:
+    engine = create_async_engine(url, **_engine_args(url, profile, AsyncAdaptedQueuePool))
+    apply_sqlite_profile(engine.sync_engine, url, profile)
+    return engine
+
+# --- Sync engine ---
+# Used for schema creation at startup and by code that must run in a worker thread.
+engine = build_engine(Config.DATABASE_URL, Config.SQLITE_PROFILE)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# --- Async engine ---
+# Used by every FastAPI route and the WebSocket loop so DB I/O never blocks the event loop.
+ASYNC_DATABASE_URL = Config.ASYNC_DATABASE_URL or to_async_url(Config.DATABASE_URL)
+async_engine = build_async_engine(ASYNC_DATABASE_URL, Config.SQLITE_PROFILE)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
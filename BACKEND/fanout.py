@@ -0,0 +1,66 @@
+import json
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Iterable, Optional, Union
+
+from fastapi import WebSocket
+
+from config import Config
+from metrics import metrics
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+@dataclass
+class FanoutResult:
+    sent: int = 0
+    failed: list[str] = field(default_factory=list)  # Keys whose send raised or timed out
+
+def encode_frame(message: Union[str, dict, list]) -> dict:
+    """Build the ASGI send event once; every recipient is handed the same object."""
+    text = message if isinstance(message, str) else json.dumps(message)
+    return {"type": "websocket.send", "text": text}
+
+async def fan_out(
+    targets: Iterable[tuple[str, WebSocket]],
+    message: Union[str, dict, list],
+    concurrency: Optional[int] = None,
+    send_timeout: Optional[float] = None,
+) -> FanoutResult:
+    """
+    Send one message to many sockets concurrently.
+
+    The frame is serialized once. Up to `concurrency` workers (never more than
+    there are recipients) pull from a shared iterator, so at most that many sends
+    are in flight and a slow client only holds up its own worker, for at most
+    `send_timeout` seconds. A failed or timed-out socket is reported in the
+    result and does not stop the others.
+    """
+    concurrency = concurrency or Config.FANOUT_CONCURRENCY
+    send_timeout = send_timeout or Config.FANOUT_SEND_TIMEOUT
+    frame = encode_frame(message)
+    snapshot = list(targets)  # Connections may come and go while we send
+    targets = iter(snapshot)
+    workers = min(concurrency, len(snapshot))  # No idle workers for short lists
+    result = FanoutResult()
+
+    async def worker():
+        for key, websocket in targets:
+            try:
+                await asyncio.wait_for(websocket.send(frame), timeout=send_timeout)
+                result.sent += 1
+            except Exception as e:
+                logging.warning(f"Broadcast to {key} failed: {e!r}")
+                result.failed.append(key)
+
+    started = asyncio.get_running_loop().time()
+    if workers == 1:
+        await worker()
+    elif workers:
+        await asyncio.gather(*(worker() for _ in range(workers)))
+    _fanout_seconds.observe(asyncio.get_running_loop().time() - started)
+    _fanout_failures.inc(len(result.failed))
+    return result
+
+_fanout_seconds = metrics.histogram("fanout.broadcast_seconds")
+_fanout_failures = metrics.counter("fanout.failed_sends")
@@ -0,0 +1,131 @@
+import time
+import asyncio
+import logging
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from config import Config
+from database import AsyncSessionLocal
+from metrics import metrics
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+class GroupCommitWriter:
+    """
+    Collects ORM inserts from concurrent requests and commits them together.
+
+    submit() queues a new row (submit_many() several, always committed
+    together) and waits until the transaction containing it has committed, so
+    callers still acknowledge each message only once it is durable. A single
+    writer task takes the first waiting submission, gathers whatever else
+    arrives within `window` seconds (up to `max_batch` submissions) and commits
+    them in one transaction, turning N commits (N fsyncs on SQLite) into one.
+    If the commit fails, each submission is retried in its own transaction so
+    only the ones that still fail get the exception.
+
+    Rows commit in the order they were submitted, so rows timestamped just
+    before submission never commit after rows with a later timestamp.
+    """
+    def __init__(self, session_factory: async_sessionmaker, window: float, max_batch: int):
+        self.session_factory = session_factory
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._batch_sizes = metrics.histogram("group_commit.batch_size", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+        self._commit_time = metrics.histogram("group_commit.commit_seconds")
+
+    def _ensure_started(self):
+        # Restart if the writer belongs to another (possibly closed) event loop,
+        # e.g. under TestClient, which runs each request on its own loop.
+        if self._task is None or self._task.done() or self._task.get_loop() is not asyncio.get_running_loop():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, row):
+        """Insert `row` (an ORM object) and return it once committed."""
+        return (await self.submit_many([row]))[0]
+
+    async def submit_many(self, rows: list) -> list:
+        """Insert `rows` in the same transaction and return them once committed."""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((rows, future))
+        return await future
+
+    async def _collect(self) -> list:
+        """Wait for a submission, then gather more for up to `window` seconds. A None entry (shutdown) ends the batch."""
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.window
+        while len(batch) < self.max_batch and batch[-1] is not None:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            batch = await self._collect()
+            if batch[-1] is None:
+                batch.pop()
+                stopping = True
+            if not batch:
+                continue
+            started = time.perf_counter()
+            try:
+                await self._commit([row for rows, _ in batch for row in rows])
+            except Exception as e:
+                if len(batch) == 1:
+                    self._settle(batch[0], e)
+                    continue
+                # Don't fail everyone for one bad row: retry each submission on its own
+                logging.warning(f"Group commit of {sum(len(rows) for rows, _ in batch)} rows failed, retrying one by one: {e}")
+                for submission in batch:
+                    try:
+                        await self._commit(submission[0])
+                    except Exception as e:
+                        self._settle(submission, e)
+                    else:
+                        self._settle(submission)
+                continue
+            self._commit_time.observe(time.perf_counter() - started)
+            self._batch_sizes.observe(sum(len(rows) for rows, _ in batch))
+            for submission in batch:
+                self._settle(submission)
+
+    async def _commit(self, rows: list):
+        # A failed transaction rolls back and leaves its rows transient, so they can be added again
+        async with self.session_factory() as db:
+            db.add_all(rows)
+            await db.commit()
+
+    def _settle(self, submission: tuple, error: Optional[Exception] = None):
+        rows, future = submission
+        if future.done():  # The request may have been cancelled meanwhile
+            return
+        if error is None:
+            future.set_result(rows)
+        else:
+            logging.error(f"Group commit of {len(rows)} rows failed: {error}")
+            future.set_exception(error)
+
+    async def shutdown(self):
+        """Commit whatever is still queued, then stop."""
+        if self._task is None or self._task.get_loop() is not asyncio.get_running_loop():
+            self._task = None
+            return
+        await self._queue.put(None)
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+chat_message_writer = GroupCommitWriter(
+    AsyncSessionLocal,
+    window=Config.GROUP_COMMIT_WINDOW_MS / 1000,
+    max_batch=Config.GROUP_COMMIT_MAX_BATCH,
+)
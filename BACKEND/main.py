@@ -10,16 +10,16 @@ import jwt
 from datetime import datetime, timedelta
 from io import BytesIO
 from PIL import Image
-import qrcode
 from typing import List, Optional, Dict
 import time
 import random
+from functools import partial
 
 from fastapi import FastAPI, HTTPException, Depends, status, WebSocket, WebSocketDisconnect, Form, Request, Response, Security, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
+from fastapi.responses import HTMLResponse, RedirectResponse
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 from passlib.context import CryptContext
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import ec
@@ -27,13 +27,30 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 from config import Config
-from models import Base, StudentUser, CounselorUser, School, ChatMessage
-from nlp_lite import detect_danger_intent, detect_counselor_misconduct # Import your lightweight NLP
+from models import Base, StudentUser, CounselorUser, School, ChatMessage, OfflineMessage
+from database import engine, AsyncSessionLocal, get_db
+from nlp_lite import registry as pattern_registry, scan_danger, detect_counselor_misconduct # Import your lightweight NLP
+from nlp_batch import (
+    run_batch, stream_scan, iter_ndjson_lines, shutdown_process_pool, NDJSONStreamingResponse,
+    scan_emergency_chunk, scan_misconduct_chunk
+)
 from signaling_manager import manager, test_manager # Import your WebSocket managers
+from screening import screening_pipeline
+from metrics import metrics
+from routing_cache import routing_cache, MISSING
+from offline_queue import offline_queue
+from receipts import receipt_coalescer, send_receipt
+from group_commit import chat_message_writer
+from blob_store import blob_store
+from school_directory import school_directory
+from qr_cache import qr_cache
+from bulk_import import bulk_importer, iter_csv_records, iter_json_records
+import wire
+from principals import backfill_principals, principal_exists, get_account, counselor_id_base
 from auth import (
     UserLogin, UserCreate, CounselorCreate, UserRegistration, 
     CampusAffiliation, CounselorAffiliationUpdate,
-    get_password_hash, create_jwt_token, verify_jwt_token,
+    get_password_hash_async, password_pool, create_jwt_token, verify_jwt_token,
     get_current_user, check_rate_limit,
     universal_login as login, register_user, get_available_animals, logout,
     student_login, counselor_login, create_student_account,
@@ -62,17 +79,9 @@ app.add_middleware(
 )
 
 # --- Database Setup (Single DB for Monolith) ---
-engine = create_engine(Config.DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Routes get an AsyncSession from get_db; the sync engine is only used for schema creation
 Base.metadata.create_all(bind=engine) # Create all tables if they don't exist
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 # --- Pydantic Models ---
 from pydantic import BaseModel
 
@@ -97,6 +106,7 @@ class EmergencyDetectionResponse(BaseModel):
     reason: str
     original_message: str
     triggered_actions: list[str] = []
+    pattern_version: Optional[str] = None
 
 # School Models
 class SchoolCreate(BaseModel):
@@ -128,19 +138,59 @@ class CounselorMisconductResponse(BaseModel):
     misconduct_type: Optional[str] = None
     original_message: str
     triggered_actions: list[str] = []
+    pattern_version: Optional[str] = None
+
+class BatchMessageAnalysisRequest(BaseModel):
+    messages: List[MessageAnalysisRequest]
+
+class BatchEmergencyDetectionResponse(BaseModel):
+    results: List[EmergencyDetectionResponse]
+
+class BatchCounselorMessageAnalysisRequest(BaseModel):
+    messages: List[CounselorMessageAnalysisRequest]
+
+class BatchCounselorMisconductResponse(BaseModel):
+    results: List[CounselorMisconductResponse]
 
 # ADDED: Pydantic model for persistent chat messages
 class PersistentMessageCreate(BaseModel):
     recipient_id: str
     message_content: str
 
+class PersistentMessageBatch(BaseModel):
+    messages: List[PersistentMessageCreate]
+
+class PersistentMessageResult(BaseModel):
+    message_id: str
+    recipient_id: str
+    ipfs_hash: str
+    timestamp: datetime
+
+class PersistentBatchResponse(BaseModel):
+    message: str
+    results: List[PersistentMessageResult]  # Same order as the request
+
+class HistoryMessage(BaseModel):
+    message_id: str
+    sender_id: str
+    recipient_id: str
+    ipfs_hash: str
+    timestamp: datetime
+    message_content: Optional[str] = None  # None if the content hash is not in the blob store (e.g. older messages)
+
+class HistoryPage(BaseModel):
+    conversation_id: str
+    messages: List[HistoryMessage]
+    next_cursor: Optional[str] = None  # Pass back as `before` (older pages) or `since` (newer messages)
+    has_more: bool = False
+
 # --- Helper Function for Emergency Alert Trigger ---
 async def trigger_emergency_alert(analysis_result: EmergencyDetectionResponse, request_data: MessageAnalysisRequest):
     logging.error(f"--- !!! EMERGENCY ALERT DETECTED !!! ---")
     logging.error(f"  Sender: {request_data.sender_user_id}")
     logging.error(f"  Recipient: {request_data.recipient_user_id}")
     logging.error(f"  Campus: {request_data.campus_id}")
-    logging.error(f"  Reason: {analysis_result.reason}")
+    logging.error(f"  Reason: {analysis_result.reason} (patterns {analysis_result.pattern_version})")
     logging.error(f"  Message: '{analysis_result.original_message}'")
     logging.error(f"--- !!! END EMERGENCY ALERT !!! ---")
 
@@ -156,51 +206,6 @@ async def trigger_emergency_alert(analysis_result: EmergencyDetectionResponse, r
 # Security setup for JWT tokens
 security = HTTPBearer()
 
-# Simple rate limiting in-memory storage
-# For production, this should be replaced with Redis or similar distributed cache
-rate_limit_store: Dict[str, Dict[str, int]] = {}
-# Limits: 5 requests per 10 seconds per user
-RATE_LIMIT = 5
-RATE_LIMIT_WINDOW = 10  # seconds
-
-# JWT validation dependency
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Security(security)):
-    token = credentials.credentials
-    payload = verify_jwt_token(token)
-    if payload is None:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid authentication token or token has expired",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-    return payload["sub"]  # Return the username from the token
-
-# Rate limiting dependency
-async def check_rate_limit(user_id: str = Depends(get_current_user)):
-    current_time = int(time.time())
-    
-    # Initialize rate limiting for user if not exists
-    if user_id not in rate_limit_store:
-        rate_limit_store[user_id] = {"count": 0, "reset_at": current_time + RATE_LIMIT_WINDOW}
-    
-    # Check if window has expired and reset if needed
-    if current_time > rate_limit_store[user_id]["reset_at"]:
-        rate_limit_store[user_id] = {"count": 0, "reset_at": current_time + RATE_LIMIT_WINDOW}
-    
-    # Increment request count
-    rate_limit_store[user_id]["count"] += 1
-    
-    # Check if limit exceeded
-    if rate_limit_store[user_id]["count"] > RATE_LIMIT:
-        wait_time = rate_limit_store[user_id]["reset_at"] - current_time
-        raise HTTPException(
-            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-            detail=f"Rate limit exceeded. Try again in {wait_time} seconds.",
-            headers={"Retry-After": str(wait_time)},
-        )
-    
-    return user_id
-
 # ADDED: Dependency to check for paid user status from JWT
 async def get_current_paid_user(credentials: HTTPAuthorizationCredentials = Security(security)):
     token = credentials.credentials
@@ -222,20 +227,20 @@ async def get_current_paid_user(credentials: HTTPAuthorizationCredentials = Secu
 
 # --- Campus Auth & Student Oracle Routes ---
 @app.post("/auth/student/create-account", summary="Create a new student account")
-async def create_student_account_route(user_data: UserCreate, db: Session = Depends(get_db)):
+async def create_student_account_route(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
     return await create_student_account(user_data, db)
 
 @app.post("/auth/student/login", summary="Login a student")
-async def student_login_route(user_data: UserLogin, db: Session = Depends(get_db)):
+async def student_login_route(user_data: UserLogin, db: AsyncSession = Depends(get_db)):
     return await student_login(user_data, db)
 
 @app.post("/auth/student/affiliate", summary="Affiliate student account with a campus")
-async def affiliate_student_account_route(affiliation_data: CampusAffiliation, db: Session = Depends(get_db)):
+async def affiliate_student_account_route(affiliation_data: CampusAffiliation, db: AsyncSession = Depends(get_db)):
     return await affiliate_student_account(affiliation_data, db)
 
 @app.post("/oracle/student/attest", response_model=SignedAttestationResponse, summary="Get signed attestation for a student")
-async def get_student_attestation(request: AttestationRequest, db: Session = Depends(get_db)):
-    db_user = db.query(StudentUser).filter(StudentUser.id == request.user_id).first()
+async def get_student_attestation(request: AttestationRequest, db: AsyncSession = Depends(get_db)):
+    db_user = await db.scalar(select(StudentUser).where(StudentUser.id == request.user_id))
     if not db_user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     if db_user.cardano_did != request.cardano_did:
@@ -263,9 +268,9 @@ async def get_student_attestation(request: AttestationRequest, db: Session = Dep
 
 # --- My Company Backend & Counselor Oracle Routes ---
 @app.post("/admin/counselors/create", summary="Admin: Create a new counselor account")
-async def create_counselor_account(counselor_data: CounselorCreateAdmin, db: Session = Depends(get_db)):
+async def create_counselor_account(counselor_data: CounselorCreateAdmin, db: AsyncSession = Depends(get_db)):
     # Check if school exists
-    school = db.query(School).filter(School.id == counselor_data.campus_id).first()
+    school = await db.scalar(select(School).where(School.id == counselor_data.campus_id))
     if not school:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, 
@@ -273,7 +278,7 @@ async def create_counselor_account(counselor_data: CounselorCreateAdmin, db: Ses
         )
     
     # Check if email is already in use
-    existing_counselor = db.query(CounselorUser).filter(CounselorUser.email == counselor_data.email).first()
+    existing_counselor = await db.scalar(select(CounselorUser).where(CounselorUser.email == counselor_data.email))
     if existing_counselor:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -281,17 +286,16 @@ async def create_counselor_account(counselor_data: CounselorCreateAdmin, db: Ses
         )
     
     # Generate ID from name (replace spaces with underscores and add prefix)
-    formatted_name = counselor_data.name.replace(" ", "_").upper()
-    generated_user_id = f"COUNSELOR_{formatted_name}"
+    generated_user_id = counselor_id_base(counselor_data.name)
     
     # Check if ID already exists and make it unique if needed
     count = 1
     original_id = generated_user_id
-    while db.query(CounselorUser).filter(CounselorUser.id == generated_user_id).first():
+    while await principal_exists(db, generated_user_id):
         generated_user_id = f"{original_id}_{count}"
         count += 1
     
-    hashed_password = get_password_hash(counselor_data.password)
+    hashed_password = await get_password_hash_async(counselor_data.password)
 
     db_counselor = CounselorUser(
         id=generated_user_id,
@@ -304,11 +308,11 @@ async def create_counselor_account(counselor_data: CounselorCreateAdmin, db: Ses
     
     db.add(db_counselor)
     try:
-        db.commit()
-        db.refresh(db_counselor)
+        await db.commit()
+        await db.refresh(db_counselor)
         
         # Update school QR code with new counselor
-        update_school_qr(counselor_data.campus_id, db)
+        await update_school_qr(counselor_data.campus_id)
         
         # Here you would send an email with login credentials
         # This is a placeholder for the email sending functionality
@@ -322,7 +326,7 @@ async def create_counselor_account(counselor_data: CounselorCreateAdmin, db: Ses
             "message": "Counselor account created successfully. Login credentials have been sent to the provided email."
         }
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
             detail=f"Counselor creation failed: {e}"
@@ -332,7 +336,7 @@ async def create_counselor_account(counselor_data: CounselorCreateAdmin, db: Ses
 async def api_counselor_email_login(
     login_data: CounselorEmailLogin, 
     response: Response,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Authenticate a counselor using email and password and return a JWT token
@@ -340,12 +344,12 @@ async def api_counselor_email_login(
     return await counselor_email_login(login_data, response, db)
 
 @app.post("/auth/counselor/update-did", summary="Update counselor's Cardano DID after first app login")
-async def update_counselor_did_route(update_data: CounselorAffiliationUpdate, db: Session = Depends(get_db)):
+async def update_counselor_did_route(update_data: CounselorAffiliationUpdate, db: AsyncSession = Depends(get_db)):
     return await update_counselor_did(update_data, db)
 
 @app.post("/oracle/counselor/attest", response_model=SignedAttestationResponse, summary="Get signed attestation for a counselor")
-async def get_counselor_attestation(request: AttestationRequest, db: Session = Depends(get_db)):
-    db_counselor = db.query(CounselorUser).filter(CounselorUser.id == request.user_id).first()
+async def get_counselor_attestation(request: AttestationRequest, db: AsyncSession = Depends(get_db)):
+    db_counselor = await db.scalar(select(CounselorUser).where(CounselorUser.id == request.user_id))
     if not db_counselor:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Counselor user not found")
     if db_counselor.cardano_did != request.cardano_did:
@@ -372,14 +376,13 @@ async def get_counselor_attestation(request: AttestationRequest, db: Session = D
     )
 
 # --- NLP Danger Detection Route ---
-@app.post("/nlp/detect-emergency", response_model=EmergencyDetectionResponse, summary="Analyze chat message for emergency intent")
-async def analyze_message_for_emergency(request: MessageAnalysisRequest):
-    is_emergency_detected = detect_danger_intent(request.chat_message)
-    
+async def build_emergency_response(request: MessageAnalysisRequest, danger_result: dict) -> EmergencyDetectionResponse:
+    is_emergency_detected = danger_result["detected"]
     response_details = EmergencyDetectionResponse(
         is_emergency=is_emergency_detected,
-        reason="Danger keywords/phrases detected." if is_emergency_detected else "No danger indicators.",
-        original_message=request.chat_message
+        reason=f"Danger keywords/phrases detected ({danger_result['category']})." if is_emergency_detected else "No danger indicators.",
+        original_message=request.chat_message,
+        pattern_version=danger_result["version"]
     )
 
     if is_emergency_detected:
@@ -388,6 +391,34 @@ async def analyze_message_for_emergency(request: MessageAnalysisRequest):
 
     return response_details
 
+@app.post("/nlp/detect-emergency", response_model=EmergencyDetectionResponse, summary="Analyze chat message for emergency intent")
+async def analyze_message_for_emergency(request: MessageAnalysisRequest):
+    danger_result = scan_danger(request.chat_message)
+    return await build_emergency_response(request, danger_result)
+
+def check_batch_size(messages: list):
+    if len(messages) > Config.NLP_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Batch too large ({len(messages)} messages). Send at most {Config.NLP_BATCH_MAX_ITEMS} or use the NDJSON stream endpoint."
+        )
+
+@app.post("/nlp/detect-emergency/batch", response_model=BatchEmergencyDetectionResponse, summary="Analyze many chat messages for emergency intent")
+async def analyze_messages_for_emergency(batch: BatchMessageAnalysisRequest):
+    check_batch_size(batch.messages)
+    detections = await run_batch(scan_emergency_chunk, [m.chat_message for m in batch.messages])
+    results = [await build_emergency_response(m, detection) for m, detection in zip(batch.messages, detections)]
+    return BatchEmergencyDetectionResponse(results=results)
+
+@app.post("/nlp/detect-emergency/stream", summary="Analyze an NDJSON stream of chat messages for emergency intent")
+async def stream_messages_for_emergency(request: Request):
+    """
+    Body: one MessageAnalysisRequest JSON object per line (application/x-ndjson).
+    Response: one JSON result per line, tagged with the zero-based input line index.
+    """
+    results = stream_scan(iter_ndjson_lines(request.stream()), MessageAnalysisRequest, scan_emergency_chunk, build_emergency_response)
+    return NDJSONStreamingResponse(results)
+
 # --- WebRTC Signaling Route ---
 @app.websocket("/ws/test/{client_id}")
 async def websocket_test_endpoint(websocket: WebSocket, client_id: str):
@@ -403,141 +434,288 @@ async def websocket_test_endpoint(websocket: WebSocket, client_id: str):
         test_manager.disconnect(client_id)
         await test_manager.broadcast(f"Client '{client_id}' left the chat.", sender_id=client_id)
 
+async def load_sender_identity(user_id: str) -> Optional[dict]:
+    """Look up a WebSocket user's role, campus and display name (None if unknown)."""
+    async with AsyncSessionLocal() as db:
+        account = await get_account(db, user_id)
+    if isinstance(account, CounselorUser):
+        return {"is_counselor": True, "campus_id": account.campus_id, "name": account.name or user_id}
+    if isinstance(account, StudentUser):
+        return {"is_counselor": False, "campus_id": account.campus_id, "name": user_id}
+    return None
+
+async def is_valid_recipient(identity: dict, recipient_user_id: str) -> bool:
+    """Check (through the routing cache) that the recipient is on the sender's campus with the opposite role."""
+    campus_id = identity["campus_id"]
+    recipient_role = "Student" if identity["is_counselor"] else "Counselor"
+    valid = routing_cache.get_recipient(campus_id, recipient_role, recipient_user_id)
+    if valid is not MISSING:
+        return valid
+
+    async with AsyncSessionLocal() as db:
+        if identity["is_counselor"]:
+            # Counselors can only message students from their campus
+            recipient = await db.scalar(select(StudentUser.id).where(
+                StudentUser.id == recipient_user_id,
+                StudentUser.campus_id == campus_id
+            ))
+        else:
+            # Students can only message counselors from their campus
+            recipient = await db.scalar(select(CounselorUser.id).where(
+                CounselorUser.id == recipient_user_id,
+                CounselorUser.campus_id == campus_id
+            ))
+
+    valid = recipient is not None
+    routing_cache.set_recipient(campus_id, recipient_role, recipient_user_id, valid)
+    return valid
+
+def screen_content(user_id: str, recipient_user_id: str, is_counselor: bool, message: dict):
+    """Run the NLP checks for a chat frame and set its flags. Blocking; runs on a screening worker thread."""
+    chat_message = message.get("message", "")
+
+    # Process message content based on sender type
+    if is_counselor:
+        # Check counselor messages for inappropriate content
+        misconduct_result = detect_counselor_misconduct(chat_message)
+        if misconduct_result["detected"]:
+            # Log the misconduct
+            logging.error(f"COUNSELOR MISCONDUCT: {user_id} to {recipient_user_id}: {misconduct_result['type']}")
+
+            # Flag message but still deliver it
+            message["flagged"] = True
+            message["misconduct_type"] = misconduct_result["type"]
+            message["pattern_version"] = misconduct_result["version"]
+
+            # In a production system, you might also notify admins here
+    else:
+        # Check student messages for danger signals
+        danger_result = scan_danger(chat_message)
+        if danger_result["detected"]:
+            # Log the emergency
+            logging.error(f"STUDENT EMERGENCY: {user_id} to {recipient_user_id}: {danger_result['category']} (patterns {danger_result['version']})")
+
+            # Flag message as emergency
+            message["emergency"] = True
+            message["pattern_version"] = danger_result["version"]
+
+async def screen_message(user_id: str, message: dict) -> dict:
+    """
+    Screen one chat frame: check the recipient, run the NLP checks and build
+    the outgoing message. Sender identity and recipient checks come from the
+    routing cache, so the steady-state path does not touch the database; the
+    NLP checks run on the screening thread pool.
+    Returns {"error": ...} or {"final_message": ...}.
+    """
+    # Required fields for proper message routing
+    recipient_user_id = message.get("recipient_user_id")
+    chat_message = message.get("message", "")
+    message_id = message.get("message_id", str(uuid.uuid4()))
+    timestamp = message.get("timestamp", datetime.utcnow().isoformat())
+    message_type = message.get("type", "text")
+
+    # Identity is resolved at connect; re-resolve only after it was invalidated or expired
+    identity = routing_cache.get_identity(user_id)
+    if identity is MISSING:
+        identity = await load_sender_identity(user_id)
+        routing_cache.set_identity(user_id, identity)
+
+    if not identity:
+        logging.warning(f"Unknown user {user_id} attempting to send messages")
+        return {"error": "User not recognized", "message_id": message_id}
+
+    # Verify the recipient exists and is valid for this sender
+    if not await is_valid_recipient(identity, recipient_user_id):
+        logging.warning(f"Invalid recipient {recipient_user_id} for user {user_id}")
+        return {"error": "Invalid recipient", "message_id": message_id}
+
+    is_counselor = identity["is_counselor"]
+    campus_id = identity["campus_id"]
+    sender_name = identity["name"]
+
+    await screening_pipeline.run_blocking(screen_content, user_id, recipient_user_id, is_counselor, message)
+
+    # Construct final message with all necessary metadata
+    final_message = {
+        "message_id": message_id,
+        "sender_user_id": user_id,
+        "sender_name": sender_name,
+        "recipient_user_id": recipient_user_id,
+        "campus_id": campus_id,
+        "timestamp": timestamp,
+        "message": chat_message,
+        "type": message_type,
+        "sender_role": "Counselor" if is_counselor else "Student"
+    }
+
+    # Add any flags from processing
+    if message.get("flagged"):
+        final_message["flagged"] = True
+        final_message["misconduct_type"] = message.get("misconduct_type")
+
+    if message.get("emergency"):
+        final_message["emergency"] = True
+
+    if message.get("pattern_version"):
+        final_message["pattern_version"] = message["pattern_version"]
+
+    return {"final_message": final_message}
+
+async def relay_screened_message(user_id: str, result: dict):
+    """Deliver a screened message (or its screening error) back on the event loop."""
+    if "error" in result:
+        await manager.send_personal_message(result, user_id)
+        return
+
+    final_message = result["final_message"]
+    message_id = final_message["message_id"]
+    recipient_user_id = final_message["recipient_user_id"]
+
+    # Send the message to the recipient if they're online. The sender's receipt
+    # goes out once the message is queued on the recipient's socket (here or on
+    # the worker that owns it); if it can't be, the message is stored instead.
+    # Emergency messages are never dropped by a full send queue.
+    if manager.is_connected(recipient_user_id) and await manager.send_personal_message(
+        final_message, recipient_user_id,
+        critical=bool(final_message.get("emergency")),
+        on_sent=partial(send_delivered_receipt, user_id, message_id),
+    ):
+        logging.info(f"Relayed message from {user_id} to {recipient_user_id}")
+    else:
+        # Store the message until the recipient connects
+        await offline_queue.enqueue(recipient_user_id, user_id, message_id, json.dumps(final_message))
+        logging.info(f"Recipient {recipient_user_id} not connected, queued message {message_id}")
+        await send_receipt(user_id, {
+            "type": "delivery_receipt",
+            "message_id": message_id,
+            "status": "pending",
+            "error": "Recipient not currently connected",
+            "queued": True,
+            "timestamp": datetime.utcnow().isoformat()
+        })
+        await deliver_if_reconnected(recipient_user_id)
+
+async def send_delivered_receipt(user_id: str, message_id: str):
+    await send_receipt(user_id, {
+        "type": "delivery_receipt",
+        "message_id": message_id,
+        "status": "delivered",
+        "timestamp": datetime.utcnow().isoformat()
+    })
+
+async def deliver_if_reconnected(recipient_user_id: str):
+    """
+    After an enqueue has committed: if the recipient connected in the meantime,
+    their connect-time flush may already have read the queue, so flush it again.
+    A recipient on another worker is flushed by that worker, through its own connection.
+    """
+    if recipient_user_id not in manager.active_connections:
+        if manager.backplane is not None:
+            manager.backplane.request_flush(recipient_user_id)
+        return
+
+    async def send(payload: str):
+        if not await manager.send_personal_message(payload, recipient_user_id):
+            raise ConnectionError(f"{recipient_user_id} disconnected during the flush")
+
+    try:
+        await offline_queue.flush(recipient_user_id, send, send_queued_receipt, wait=False)  # A flush already running here picks the row up
+    except ConnectionError:
+        pass  # The unsent rows stay queued for the next connection
+
+def reports_delivery(data: dict) -> bool:
+    """True for a receipt frame (single or coalesced) that tells a sender a message was delivered."""
+    if data.get("type") == "delivery_receipt":
+        return data.get("status") == "delivered"
+    if data.get("type") == "delivery_receipts":
+        return any(receipt.get("status") == "delivered" for receipt in data.get("receipts", []))
+    return False
+
+async def store_undelivered(recipient_user_id: str, message, critical: bool):
+    """
+    Move chat messages and delivered receipts that didn't reach their user (left
+    in a closed connection's send queue, or not forwarded to another worker) to
+    the offline queue. Other frames, such as pending receipts and errors, are dropped.
+    """
+    data = json.loads(message) if isinstance(message, str) else message
+    if "sender_user_id" in data:
+        await offline_queue.enqueue(recipient_user_id, data["sender_user_id"], data["message_id"], json.dumps(data))
+    elif reports_delivery(data):
+        message_id = data.get("message_id") or data["receipts"][0]["message_id"]
+        await offline_queue.enqueue(recipient_user_id, recipient_user_id, message_id, json.dumps(data))
+    else:
+        return
+    await deliver_if_reconnected(recipient_user_id)
+
+manager.on_undelivered = store_undelivered
+manager.on_flush_request = deliver_if_reconnected
+
+async def send_queued_receipt(queued: OfflineMessage):
+    """Tell the original sender that a queued message has now been delivered, storing the receipt if they are offline."""
+    if reports_delivery(json.loads(queued.payload)):
+        return  # A stored receipt, not a message: nobody to confirm it to
+    receipt = {
+        "type": "delivery_receipt",
+        "message_id": queued.message_id,
+        "status": "delivered",
+        "queued": True,
+        "timestamp": datetime.utcnow().isoformat()
+    }
+    if not (manager.is_connected(queued.sender_id) and await send_receipt(queued.sender_id, receipt)):
+        await offline_queue.enqueue(queued.sender_id, queued.recipient_id, queued.message_id, json.dumps(receipt))
+        await deliver_if_reconnected(queued.sender_id)
+
 @app.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: str, db: Session = Depends(get_db)):
-    await manager.connect(websocket, user_id)
+async def websocket_endpoint(websocket: WebSocket, user_id: str):
+    # JSON by default; clients may opt in to the batched msgpack protocol
+    codec, subprotocol = wire.negotiate(websocket)
+    # Live messages wait in the send queue until the offline backlog has gone out
+    await manager.connect(websocket, user_id, codec, subprotocol, hold=True)
+    if websocket.query_params.get("receipts") == "batched":
+        receipt_coalescer.enable(user_id)  # Opt-in: one delivery_receipts frame per coalescing window
+    else:
+        receipt_coalescer.disable(user_id)  # A replaced connection's opt-in doesn't carry over
     try:
+        # Resolve the sender's role and campus once for the whole connection
+        routing_cache.set_identity(user_id, await load_sender_identity(user_id))
+        try:
+            # Deliver anything that arrived while the user was offline
+            await offline_queue.flush(user_id, partial(wire.send_direct, websocket, codec), send_queued_receipt)
+        finally:
+            manager.release(user_id, websocket)
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
-            
-            # Required fields for proper message routing
-            recipient_user_id = message.get("recipient_user_id")
-            chat_message = message.get("message", "")
-            message_id = message.get("message_id", str(uuid.uuid4()))
-            timestamp = message.get("timestamp", datetime.utcnow().isoformat())
-            message_type = message.get("type", "text")
-            
-            # Get campus_id for the sender
-            sender = None
-            is_counselor = False
-            campus_id = None
-            
-            # Try to find the user in the counselor table
-            sender = db.query(CounselorUser).filter(CounselorUser.id == user_id).first()
-            if sender:
-                is_counselor = True
-                campus_id = sender.campus_id
-            else:
-                # If not a counselor, check if it's a student
-                sender = db.query(StudentUser).filter(StudentUser.id == user_id).first()
-                if sender:
-                    campus_id = sender.campus_id
-            
-            if not sender:
-                logging.warning(f"Unknown user {user_id} attempting to send messages")
-                await manager.send_personal_message(json.dumps({
-                    "error": "User not recognized",
-                    "message_id": message_id
-                }), user_id)
-                continue
-            
-            # Verify the recipient exists and is valid for this sender
-            recipient = None
-            if is_counselor:
-                # Counselors can only message students from their campus
-                recipient = db.query(StudentUser).filter(
-                    StudentUser.id == recipient_user_id,
-                    StudentUser.campus_id == campus_id
-                ).first()
-            else:
-                # Students can only message counselors from their campus
-                recipient = db.query(CounselorUser).filter(
-                    CounselorUser.id == recipient_user_id,
-                    CounselorUser.campus_id == campus_id
-                ).first()
-            
-            if not recipient:
-                logging.warning(f"Invalid recipient {recipient_user_id} for user {user_id}")
-                await manager.send_personal_message(json.dumps({
-                    "error": "Invalid recipient",
-                    "message_id": message_id
-                }), user_id)
-                continue
-                
-            # Process message content based on sender type
-            if is_counselor:
-                # Check counselor messages for inappropriate content
-                misconduct_result = detect_counselor_misconduct(chat_message)
-                if misconduct_result["detected"]:
-                    # Log the misconduct
-                    logging.error(f"COUNSELOR MISCONDUCT: {user_id} to {recipient_user_id}: {misconduct_result['type']}")
-                    
-                    # Flag message but still deliver it
-                    message["flagged"] = True
-                    message["misconduct_type"] = misconduct_result["type"]
-                    
-                    # In a production system, you might also notify admins here
-            else:
-                # Check student messages for danger signals
-                is_emergency = detect_danger_intent(chat_message)
-                if is_emergency:
-                    # Log the emergency
-                    logging.error(f"STUDENT EMERGENCY: {user_id} to {recipient_user_id}")
-                    
-                    # Flag message as emergency
-                    message["emergency"] = True
-
-            # Construct final message with all necessary metadata
-            final_message = {
-                "message_id": message_id,
-                "sender_user_id": user_id,
-                "sender_name": sender.name if hasattr(sender, "name") and sender.name else user_id,
-                "recipient_user_id": recipient_user_id,
-                "campus_id": campus_id,
-                "timestamp": timestamp,
-                "message": chat_message,
-                "type": message_type,
-                "sender_role": "Counselor" if is_counselor else "Student"
-            }
-            
-            # Add any flags from processing
-            if message.get("flagged"):
-                final_message["flagged"] = True
-                final_message["misconduct_type"] = message.get("misconduct_type")
-            
-            if message.get("emergency"):
-                final_message["emergency"] = True
-            
-            # Send the message to the recipient if they're online
-            if recipient_user_id in manager.active_connections:
-                await manager.send_personal_message(json.dumps(final_message), recipient_user_id)
-                logging.info(f"Relayed message from {user_id} to {recipient_user_id}")
-                
-                # Send delivery confirmation to sender
-                await manager.send_personal_message(json.dumps({
-                    "type": "delivery_receipt",
-                    "message_id": message_id,
-                    "status": "delivered",
-                    "timestamp": datetime.utcnow().isoformat()
-                }), user_id)
-            else:
-                logging.warning(f"Recipient {recipient_user_id} not connected.")
-                # Send failed delivery notification to sender
-                await manager.send_personal_message(json.dumps({
-                    "type": "delivery_receipt",
-                    "message_id": message_id,
-                    "status": "pending",
-                    "error": "Recipient not currently connected",
-                    "timestamp": datetime.utcnow().isoformat()
-                }), user_id)
+            # One frame may carry several messages (msgpack batches)
+            for message in await wire.receive_messages(websocket, codec):
+                if "message_id" not in message:
+                    message["message_id"] = str(uuid.uuid4())
+
+                # Screening runs on the worker pool; messages in the same conversation stay in order
+                conversation_key = "|".join(sorted([user_id, str(message.get("recipient_user_id"))]))
+                accepted = await screening_pipeline.submit(
+                    conversation_key,
+                    partial(screen_message, user_id, message),
+                    partial(relay_screened_message, user_id),
+                )
+                if not accepted:
+                    # Backpressure: the screening queue stayed full, ask the client to retry
+                    await manager.send_personal_message({
+                        "error": "Server busy, please retry",
+                        "message_id": message["message_id"]
+                    }, user_id)
 
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
+        end_connection(user_id, websocket)
         logging.info(f"User {user_id} disconnected")
     except Exception as e:
         logging.error(f"Error for user {user_id}: {e}")
-        manager.disconnect(user_id)
+        end_connection(user_id, websocket)
+
+def end_connection(user_id: str, websocket: WebSocket):
+    manager.disconnect(user_id, websocket)
+    # A reconnect may have replaced this socket; its batching opt-in and identity belong to the new one
+    if user_id not in manager.active_connections:
+        receipt_coalescer.disable(user_id)
+        routing_cache.forget_identity(user_id)
 
 
 ADMIN_SESSIONS = {} # Simple in-memory session store
@@ -558,6 +736,18 @@ async def admin_login(response: Response, username: str = Form(...), password: s
         return {"message": "Login successful", "token": jwt_token}
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid admin credentials.")
 
+async def require_admin(request: Request):
+    """Allow the admin panel session cookie or an Admin JWT."""
+    session_token = request.cookies.get("admin_session_token")
+    if session_token and session_token in ADMIN_SESSIONS.values():
+        return
+    authorization = request.headers.get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        payload = verify_jwt_token(authorization[len("Bearer "):])
+        if payload and payload.get("role") == "Admin":
+            return
+    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Admin authentication required.")
+
 @app.get("/admin", response_class=HTMLResponse)
 async def serve_admin_panel(request: Request):
     # First check for cookie-based authentication
@@ -582,9 +772,9 @@ async def get_admin_login_page():
         raise HTTPException(status_code=404, detail="Admin login page not found.")
 
 @app.post("/admin/schools/create", summary="Admin: Create a new school")
-async def create_school(school_data: SchoolCreate, db: Session = Depends(get_db)):
+async def create_school(school_data: SchoolCreate, db: AsyncSession = Depends(get_db)):
     # Check if school already exists
-    existing_school = db.query(School).filter(School.id == school_data.school_id).first()
+    existing_school = await db.scalar(select(School).where(School.id == school_data.school_id))
     if existing_school:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, 
@@ -600,16 +790,11 @@ async def create_school(school_data: SchoolCreate, db: Session = Depends(get_db)
     
     db.add(new_school)
     try:
-        db.commit()
-        db.refresh(new_school)
+        await db.commit()
+        await db.refresh(new_school)
         
         # Generate and save QR code
-        qr_data = {
-            "name": new_school.name,
-            "school_id": new_school.id,
-            "counselors": []
-        }
-        generate_and_save_qr(new_school.id, json.dumps(qr_data))
+        await qr_cache.get(new_school.id)
         
         return {
             "school_id": new_school.id,
@@ -618,144 +803,125 @@ async def create_school(school_data: SchoolCreate, db: Session = Depends(get_db)
             "message": "School created successfully."
         }
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
             detail=f"School creation failed: {e}"
         )
 
+@app.post("/admin/schools/import", summary="Admin: Bulk import schools and counselors from a CSV or NDJSON stream", dependencies=[Depends(require_admin)])
+async def bulk_import_schools(request: Request, format: Optional[str] = None):
+    """
+    Body: one row per line, as CSV with a header row (text/csv or ?format=csv)
+    or as NDJSON objects (the default). Every row has a "type" of "school"
+    (school_id, name, location) or "counselor" (name, email, password, campus_id).
+
+    Response: one JSON line per row, tagged with the zero-based row index and
+    either the created record or an error, then a {"done": true, ...} summary.
+    Failed rows don't abort the import.
+    """
+    format = format or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="format must be 'csv' or 'ndjson'.")
+    lines = iter_ndjson_lines(request.stream())
+    records = iter_csv_records(lines) if format == "csv" else iter_json_records(lines)
+    return NDJSONStreamingResponse(bulk_importer.stream(records, {"school": SchoolCreate, "counselor": CounselorCreateAdmin}))
+
 @app.get("/admin/schools/list", response_model=dict, summary="Admin: List all schools with counselors")
-async def list_schools(db: Session = Depends(get_db)):
-    schools = db.query(School).all()
+async def list_schools():
+    directory = await school_directory.snapshot()
     result = []
     
-    for school in schools:
-        counselors_data = []
-        counselors = db.query(CounselorUser).filter(CounselorUser.campus_id == school.id).all()
-        
-        for counselor in counselors:
-            counselors_data.append({
-                "user_id": counselor.id,
-                "name": counselor.name,
-                "campus_id": counselor.campus_id
-            })
+    for school in directory.schools.values():
+        counselors_data = [
+            {"user_id": c.user_id, "name": c.name, "campus_id": c.campus_id}
+            for c in school.counselors
+        ]
         
         result.append({
             "name": school.name,
-            "school_id": school.id,
+            "school_id": school.school_id,
             "location": school.location,
             "counselors": counselors_data
         })
     
     return {"schools": result}
 
-@app.get("/admin/schools/{school_id}/qrcode", summary="Get QR code for a school")
-async def get_school_qrcode(school_id: str, db: Session = Depends(get_db)):
-    # Check if school exists
-    school = db.query(School).filter(School.id == school_id).first()
+async def get_directory_school(school_id: str):
+    school = await school_directory.get(school_id)
     if not school:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, 
             detail=f"School with ID '{school_id}' not found"
         )
+    return school
+
+@app.get("/admin/schools/{school_id}/qrcode", summary="Get QR code for a school")
+async def get_school_qrcode(school_id: str):
+    school = await get_directory_school(school_id)
+    qr_data = school.qr_data()
     
-    # Get counselors for this school
-    counselors = db.query(CounselorUser).filter(CounselorUser.campus_id == school_id).all()
-    counselor_data = [{"id": c.id, "name": c.name} for c in counselors]
-    
-    # Generate QR code data
-    qr_data = {
-        "name": school.name,
-        "school_id": school.id,
-        "counselors": counselor_data
-    }
-    
-    # Always generate a fresh QR code with current data
-    qr_path = generate_and_save_qr(school_id, json.dumps(qr_data))
+    # Rendered only when the encoded URL or render settings changed
+    await qr_cache.get(school_id)
     
     return {"qr_url": f"/static/qrcodes/school_{school_id}.png", "data": qr_data}
 
 @app.get("/admin/schools/{school_id}/qrcode/download", summary="Download QR code for a school")
-async def download_school_qrcode(school_id: str, db: Session = Depends(get_db)):
-    # Check if school exists
-    school = db.query(School).filter(School.id == school_id).first()
-    if not school:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, 
-            detail=f"School with ID '{school_id}' not found"
-        )
-    
-    # Get counselors for this school
-    counselors = db.query(CounselorUser).filter(CounselorUser.campus_id == school_id).all()
-    counselor_data = [{"id": c.id, "name": c.name} for c in counselors]
+async def download_school_qrcode(school_id: str, request: Request):
+    await get_directory_school(school_id)
+    rendered = await qr_cache.get(school_id)
     
-    # Generate QR code data
-    qr_data = {
-        "name": school.name,
-        "school_id": school.id,
-        "counselors": counselor_data
+    headers = {
+        "ETag": rendered.etag,
+        "Cache-Control": "private, no-cache",
+        "Content-Disposition": f'attachment; filename="school_{school_id}.png"',
     }
+    if etag_matches(request.headers.get("if-none-match"), rendered.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
     
-    # Ensure QR code is generated
-    qr_path = f"static/qrcodes/school_{school_id}.png"
-    if not os.path.exists(qr_path):
-        generate_and_save_qr(school_id, json.dumps(qr_data))
-    
-    # Return file for download with appropriate filename
-    return FileResponse(
-        path=qr_path, 
-        media_type="image/png",
-        filename=f"school_{school_id}.png"
-    )
-
-# Helper function to generate and save QR codes
-def generate_and_save_qr(school_id: str, data: str):
-    # Create directory if it doesn't exist
-    os.makedirs("static/qrcodes", exist_ok=True)
-    
-    # Instead of encoding all the data, create a URL to the API endpoint with auth info
-    api_url = f"{Config.API_BASE_URL}/api/school/{school_id}"
-    
-    # Generate QR code
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(api_url)
-    qr.make(fit=True)
-    
-    # Create an image from the QR Code
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    # Save the image
-    img.save(f"static/qrcodes/school_{school_id}.png")
-    
-    return f"static/qrcodes/school_{school_id}.png"
+    # Served from memory with an appropriate filename
+    return Response(content=rendered.png, media_type="image/png", headers=headers)
 
 # Helper function to update school QR code when counselors change
-def update_school_qr(school_id: str, db: Session):
-    school = db.query(School).filter(School.id == school_id).first()
-    if not school:
-        return
-    
-    counselors = db.query(CounselorUser).filter(CounselorUser.campus_id == school_id).all()
-    counselor_data = [{"id": c.id, "name": c.name} for c in counselors]
-    
-    qr_data = {
-        "name": school.name,
-        "school_id": school.id,
-        "counselors": counselor_data
+async def update_school_qr(school_id: str):
+    # The QR code only encodes the school's API URL, so this re-renders nothing
+    # unless API_BASE_URL or the render settings changed
+    await qr_cache.get(school_id)
+
+@app.get("/admin/nlp/patterns", summary="Admin: Show the active NLP pattern registry", dependencies=[Depends(require_admin)])
+async def get_nlp_patterns():
+    snapshot = pattern_registry.current
+    return {"version": snapshot.version, "danger": snapshot.spec["danger"], "misconduct": snapshot.spec["misconduct"]}
+
+@app.post("/admin/nlp/patterns/reload", summary="Admin: Reload NLP patterns without a restart", dependencies=[Depends(require_admin)])
+async def reload_nlp_patterns():
+    previous_version = (pattern_registry.loaded or pattern_registry.current).version
+    try:
+        snapshot = await asyncio.to_thread(pattern_registry.reload)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Pattern reload failed, keeping version {previous_version}: {e}")
+    return {
+        "previous_version": previous_version,
+        "version": snapshot.version,
+        "danger_patterns": len(snapshot.spec["danger"]),
+        "misconduct_patterns": len(snapshot.spec["misconduct"]),
+        "worker_pid": os.getpid(),
+        "message": "Pattern registry reloaded in this worker; " + (
+            # Other workers notice the changed file on their own next check
+            f"other workers load the file within {Config.NLP_PATTERNS_CHECK_SECONDS:g} seconds."
+            if Config.NLP_PATTERNS_CHECK_SECONDS else "other workers keep their patterns until restarted."
+        )
     }
-    
-    generate_and_save_qr(school_id, json.dumps(qr_data))
+
+@app.get("/admin/metrics", summary="Admin: Process-local performance metrics", dependencies=[Depends(require_admin)])
+async def get_metrics():
+    return metrics.snapshot()
 
 # Add endpoint to get schools for dropdown
 @app.get("/admin/schools/options", summary="Get schools for dropdown selection")
-async def get_school_options(db: Session = Depends(get_db)):
-    schools = db.query(School).all()
-    options = [{"id": school.id, "name": school.name} for school in schools]
+async def get_school_options():
+    directory = await school_directory.snapshot()
+    options = [{"id": school.school_id, "name": school.name} for school in directory.schools.values()]
     return {"schools": options}
 
 # After the engine and SessionLocal setup, add this to ensure the DB is recreated
@@ -767,12 +933,25 @@ def init_db():
     # Only create tables if they don't exist
     # Remove the drop_all line to preserve existing data
     Base.metadata.create_all(bind=engine)
+    # create_all skips indexes added to tables that already exist
+    for index in ChatMessage.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+    backfill_principals(engine)
     
     print("Database initialized - existing tables preserved")
 
 # Call this function at startup
 init_db()
 
+@app.on_event("shutdown")
+async def shutdown_workers():
+    shutdown_process_pool()
+    await screening_pipeline.shutdown()
+    if manager.backplane is not None:
+        await manager.backplane.stop()
+    password_pool.shutdown()
+    await chat_message_writer.shutdown()
+
 # --- Main execution block for development ---
 if __name__ == "__main__":
     print(f"Cardano Chat Monolith Backend starting. Database: {Config.DATABASE_URL}")
@@ -783,60 +962,82 @@ if __name__ == "__main__":
 @app.get("/api/school/{school_id}", summary="Get real-time school data (authenticated)")
 async def get_school_data(
     school_id: str, 
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
     user_id: str = Depends(check_rate_limit)  # This combines authentication and rate limiting
 ):
-    # Check if school exists
-    school = db.query(School).filter(School.id == school_id).first()
-    if not school:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, 
-            detail=f"School with ID '{school_id}' not found"
-        )
+    """
+    Served from the school directory, which is reloaded whenever a school or
+    counselor changes. Responses carry an ETag; a client that sends it back in
+    If-None-Match gets an empty 304 until the school's data changes.
+    """
+    school = await get_directory_school(school_id)
     
     # Log access for auditing
     logging.info(f"User {user_id} accessed school data for {school_id}")
     
-    # Get counselors for this school - always gets fresh data
-    counselors = db.query(CounselorUser).filter(CounselorUser.campus_id == school_id).all()
-    counselor_data = [{"id": c.id, "name": c.name} for c in counselors]
-    
-    # Return real-time data about the school
-    return {
-        "name": school.name,
-        "school_id": school.id,
-        "location": school.location,
-        "counselors": counselor_data
+    cache_headers = {
+        "ETag": school.etag,
+        "Cache-Control": f"private, max-age={Config.SCHOOL_DATA_MAX_AGE}, must-revalidate",
     }
+    if etag_matches(request.headers.get("if-none-match"), school.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers)
+    
+    response.headers.update(cache_headers)
+    return school.api_data()
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match check: a list of (possibly weak) tags or "*"."""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or any(tag.removeprefix("W/") == etag for tag in candidates)
 
 @app.get("/auth/animals", summary="Get available animals for registration")
 async def animals_route():
     return await get_available_animals()
 
 @app.post("/auth/login", summary="Universal login for all users")
-async def login_route(user_data: UserLogin, response: Response, db: Session = Depends(get_db)):
+async def login_route(user_data: UserLogin, response: Response, db: AsyncSession = Depends(get_db)):
     return await login(user_data, response, db)
 
 @app.post("/auth/register", response_model=TokenResponse, summary="Register a new user with animal-based ID")
-async def register_route(user_data: UserRegistration, response: Response, db: Session = Depends(get_db)):
+async def register_route(user_data: UserRegistration, response: Response, db: AsyncSession = Depends(get_db)):
     return await register_user(user_data, db, response)
 
 @app.post("/auth/logout", summary="Logout and clear session")
-async def logout_route(response: Response):
-    return await logout(response)
+async def logout_route(request: Request, response: Response):
+    return await logout(response, request)
 
 # Add this new endpoint
 @app.post("/nlp/detect-counselor-misconduct", response_model=CounselorMisconductResponse, summary="Analyze counselor messages for inappropriate content")
 async def analyze_counselor_message(request: CounselorMessageAnalysisRequest):
-    from nlp_lite import detect_counselor_misconduct
-    
     # Analyze the message
     misconduct_result = detect_counselor_misconduct(request.chat_message)
-    
+    return await build_misconduct_response(request, misconduct_result)
+
+@app.post("/nlp/detect-counselor-misconduct/batch", response_model=BatchCounselorMisconductResponse, summary="Analyze many counselor messages for inappropriate content")
+async def analyze_counselor_messages(batch: BatchCounselorMessageAnalysisRequest):
+    check_batch_size(batch.messages)
+    misconduct_results = await run_batch(scan_misconduct_chunk, [m.chat_message for m in batch.messages])
+    results = [await build_misconduct_response(m, result) for m, result in zip(batch.messages, misconduct_results)]
+    return BatchCounselorMisconductResponse(results=results)
+
+@app.post("/nlp/detect-counselor-misconduct/stream", summary="Analyze an NDJSON stream of counselor messages for inappropriate content")
+async def stream_counselor_messages(request: Request):
+    """
+    Body: one CounselorMessageAnalysisRequest JSON object per line (application/x-ndjson).
+    Response: one JSON result per line, tagged with the zero-based input line index.
+    """
+    results = stream_scan(iter_ndjson_lines(request.stream()), CounselorMessageAnalysisRequest, scan_misconduct_chunk, build_misconduct_response)
+    return NDJSONStreamingResponse(results)
+
+async def build_misconduct_response(request: CounselorMessageAnalysisRequest, misconduct_result: dict) -> CounselorMisconductResponse:
     response_details = CounselorMisconductResponse(
         is_misconduct=misconduct_result["detected"],
         misconduct_type=misconduct_result.get("type", None),
-        original_message=request.chat_message
+        original_message=request.chat_message,
+        pattern_version=misconduct_result.get("version")
     )
 
     if misconduct_result["detected"]:
@@ -846,7 +1047,7 @@ async def analyze_counselor_message(request: CounselorMessageAnalysisRequest):
         logging.error(f"  Student: {request.student_id}")
         logging.error(f"  Campus: {request.campus_id}")
         logging.error(f"  Type: {misconduct_result.get('type')}")
-        logging.error(f"  Pattern: {misconduct_result.get('pattern')}")
+        logging.error(f"  Pattern: {misconduct_result.get('pattern')} (patterns {misconduct_result.get('version')})")
         logging.error(f"  Message: '{request.chat_message}'")
         logging.error(f"--- !!! END COUNSELOR MISCONDUCT ALERT !!! ---")
         
@@ -858,39 +1059,35 @@ async def analyze_counselor_message(request: CounselorMessageAnalysisRequest):
 
     return response_details
 
+def build_persistent_message(sender_id: str, message_data: PersistentMessageCreate, content_hash: str) -> ChatMessage:
+    # The content itself lives in the blob store under its hash
+    # Create the message metadata with a consistent conversation ID for easy retrieval of message history
+    return ChatMessage(
+        message_id=str(uuid.uuid4()),
+        sender_id=sender_id,
+        recipient_id=message_data.recipient_id,
+        ipfs_hash=content_hash,
+        conversation_id=conversation_id_for(sender_id, message_data.recipient_id),
+        timestamp=datetime.utcnow()
+    )
+
 # ADDED: New endpoint for persistent messaging for paid users
 @app.post("/chat/send-persistent", summary="Send a persistent message (Paid Subscription Required)")
 async def send_persistent_message(
     message_data: PersistentMessageCreate,
-    db: Session = Depends(get_db),
     sender_id: str = Depends(get_current_paid_user)
 ):
     """
-    Stores a message by saving its IPFS hash to the database.
+    Stores the message content in the blob store and its content hash in the database.
     This endpoint is only accessible to users with a paid subscription.
+    The insert is group-committed with concurrent requests; the response is
+    only sent once the message's transaction has committed.
     """
-    # In a real application, this is where you would upload message_data.message_content to IPFS
-    # and get back a real hash. For this example, we'll simulate it.
-    fake_ipfs_hash = f"Qm_fake_hash_for_testing_{uuid.uuid4()}"
-    
-    # Generate a consistent conversation ID for easy retrieval of message history
-    user_ids = sorted([sender_id, message_data.recipient_id])
-    conversation_id = f"conv_{user_ids[0]}_{user_ids[1]}"
-    
-    # Create and store the message metadata in the database
-    new_message = ChatMessage(
-        sender_id=sender_id,
-        recipient_id=message_data.recipient_id,
-        ipfs_hash=fake_ipfs_hash,
-        conversation_id=conversation_id,
-        timestamp=datetime.utcnow()
-    )
-    
-    db.add(new_message)
     try:
-        db.commit()
-        db.refresh(new_message)
-        logging.info(f"Stored persistent message from {sender_id} to {message_data.recipient_id} with IPFS hash {fake_ipfs_hash}")
+        content_hash = await blob_store.put(message_data.message_content.encode("utf-8"))
+        new_message = build_persistent_message(sender_id, message_data, content_hash)
+        await chat_message_writer.submit(new_message)
+        logging.info(f"Stored persistent message from {sender_id} to {message_data.recipient_id} with content hash {new_message.ipfs_hash}")
         
         return {
             "message": "Message stored successfully.",
@@ -899,9 +1096,130 @@ async def send_persistent_message(
             "timestamp": new_message.timestamp
         }
     except Exception as e:
-        db.rollback()
         logging.error(f"Failed to store persistent message: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to store message: {e}"
-        )
\ No newline at end of file
+        )
+
+@app.post("/chat/send-persistent/batch", response_model=PersistentBatchResponse, summary="Send many persistent messages in one request (Paid Subscription Required)")
+async def send_persistent_messages_batch(
+    batch: PersistentMessageBatch,
+    sender_id: str = Depends(get_current_paid_user)
+):
+    """
+    Stores up to CHAT_BATCH_MAX_ITEMS messages in a single transaction: all are stored or none are.
+    The rows go through the same group-commit writer as /chat/send-persistent, so
+    they commit in timestamp order with single messages and history cursors don't skip them.
+    """
+    if not batch.messages:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No messages provided.")
+    if len(batch.messages) > Config.CHAT_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Batch too large: {len(batch.messages)} messages (max {Config.CHAT_BATCH_MAX_ITEMS})."
+        )
+
+    try:
+        content_hashes = await blob_store.put_many([message_data.message_content.encode("utf-8") for message_data in batch.messages])
+        new_messages = [
+            build_persistent_message(sender_id, message_data, content_hash)
+            for message_data, content_hash in zip(batch.messages, content_hashes)
+        ]
+        await chat_message_writer.submit_many(new_messages)
+    except Exception as e:
+        logging.error(f"Failed to store persistent message batch: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to store messages: {e}"
+        )
+    logging.info(f"Stored {len(new_messages)} persistent messages from {sender_id}")
+
+    return PersistentBatchResponse(
+        message=f"{len(new_messages)} messages stored successfully.",
+        results=[
+            PersistentMessageResult(
+                message_id=message.message_id,
+                recipient_id=message.recipient_id,
+                ipfs_hash=message.ipfs_hash,
+                timestamp=message.timestamp,
+            )
+            for message in new_messages
+        ],
+    )
+
+# --- Conversation History (keyset pagination) ---
+def conversation_id_for(user_a: str, user_b: str) -> str:
+    user_ids = sorted([user_a, user_b])
+    return f"conv_{user_ids[0]}_{user_ids[1]}"
+
+def encode_history_cursor(message: ChatMessage) -> str:
+    """Opaque cursor for a message's position: (timestamp, id)."""
+    raw = json.dumps([message.timestamp.isoformat(), message.id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def decode_history_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        timestamp, message_pk = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(timestamp), int(message_pk)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid history cursor.")
+
+@app.get("/chat/history/{peer_id}", response_model=HistoryPage, summary="Page through a conversation's stored messages (Paid Subscription Required)")
+async def get_conversation_history(
+    peer_id: str,
+    before: Optional[str] = None,
+    since: Optional[str] = None,
+    limit: int = 50,
+    db: AsyncSession = Depends(get_db),
+    user_id: str = Depends(get_current_paid_user)
+):
+    """
+    Without a cursor, returns the newest `limit` messages, newest first; pass
+    `next_cursor` back as `before` for the next (older) page.
+
+    With `since`, returns messages stored after that cursor, oldest first, so a
+    reconnecting client fetches only what it missed; keep passing `next_cursor`
+    as `since` while `has_more` is true.
+
+    Pages seek on the (conversation_id, timestamp, id) index instead of using
+    OFFSET, so every page costs the same however long the conversation is.
+    """
+    if before and since:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Use either 'before' or 'since', not both.")
+    limit = max(1, min(limit, Config.HISTORY_MAX_PAGE_SIZE))
+    conversation_id = conversation_id_for(user_id, peer_id)
+    position = tuple_(ChatMessage.timestamp, ChatMessage.id)
+
+    query = select(ChatMessage).where(ChatMessage.conversation_id == conversation_id)
+    if since:
+        query = query.where(position > tuple_(*decode_history_cursor(since))).order_by(ChatMessage.timestamp, ChatMessage.id)
+    else:
+        if before:
+            query = query.where(position < tuple_(*decode_history_cursor(before)))
+        query = query.order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc())
+
+    rows = (await db.scalars(query.limit(limit + 1))).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if since:
+        # Even when caught up, hand back a cursor so the next poll starts from here
+        next_cursor = encode_history_cursor(rows[-1]) if rows else since
+    else:
+        next_cursor = encode_history_cursor(rows[-1]) if rows and has_more else None
+
+    contents = await blob_store.get_many(row.ipfs_hash for row in rows)
+    messages = []
+    for row in rows:
+        message = HistoryMessage.model_validate(row, from_attributes=True)
+        if row.ipfs_hash in contents:
+            message.message_content = contents[row.ipfs_hash].decode("utf-8")
+        messages.append(message)
+
+    return HistoryPage(
+        conversation_id=conversation_id,
+        messages=messages,
+        next_cursor=next_cursor,
+        has_more=has_more,
+    )
@@ -0,0 +1,83 @@
+import threading
+from typing import Callable
+
+class Counter:
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self._value += amount
+
+    def snapshot(self):
+        return self._value
+
+class Histogram:
+    """Tracks count, sum, max and cumulative bucket counts of observed values (e.g. seconds)."""
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._counts = [0] * len(buckets)
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self._count += 1
+            self._sum += value
+            self._max = max(self._max, value)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "count": self._count,
+                "sum": round(self._sum, 6),
+                "avg": round(self._sum / self._count, 6) if self._count else 0.0,
+                "max": round(self._max, 6),
+                "buckets": {f"le_{bound}": count for bound, count in zip(self.buckets, self._counts)},
+            }
+
+class Gauge:
+    """A value read from a callback when metrics are collected."""
+    def __init__(self, read: Callable[[], object]):
+        self._read = read
+
+    def snapshot(self):
+        return self._read()
+
+class MetricsRegistry:
+    """Process-local metrics, exposed as JSON by /admin/metrics."""
+    def __init__(self):
+        self._metrics: dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, name: str, factory):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = factory()
+            return self._metrics[name]
+
+    def counter(self, name: str) -> Counter:
+        return self._get_or_create(name, Counter)
+
+    def histogram(self, name: str, buckets: tuple = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(name, lambda: Histogram(buckets))
+
+    def gauge(self, name: str, read: Callable[[], object]) -> Gauge:
+        with self._lock:
+            self._metrics[name] = Gauge(read)
+            return self._metrics[name]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+        return {name: metric.snapshot() for name, metric in sorted(metrics.items())}
+
+metrics = MetricsRegistry()
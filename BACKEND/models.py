@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, ForeignKey, Integer, Boolean, DateTime
+from sqlalchemy import Column, String, ForeignKey, Integer, Boolean, DateTime, Text, Index
 from sqlalchemy.orm import declarative_base, relationship
 import uuid
 from datetime import datetime
@@ -49,4 +49,39 @@ class ChatMessage(Base):
     sender_id = Column(String, nullable=False, index=True)
     recipient_id = Column(String, nullable=False, index=True)
     ipfs_hash = Column(String, nullable=False)
-    timestamp = Column(DateTime, nullable=False, default=datetime.utcnow)
\ No newline at end of file
+    timestamp = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    # Keyset pagination of a conversation's history, see /chat/history
+    __table_args__ = (Index("ix_chat_messages_conversation_timestamp_id", "conversation_id", "timestamp", "id"),)
+
+class Principal(Base):
+    """
+    One row per user ID across student_users and counselor_users, so logins and
+    ID-collision checks need a single indexed lookup. Kept in sync by principals.py.
+    """
+    __tablename__ = "principals"
+    user_id = Column(String, primary_key=True)
+    role = Column(String, nullable=False)
+    user_table = Column(String, nullable=False)  # "student_users" or "counselor_users"
+    campus_id = Column(String, nullable=True, index=True)
+    is_paid = Column(Boolean, default=False, nullable=False)
+
+class IdCounter(Base):
+    """Last suffix handed out for each (animal, year) user-ID prefix; see auth.allocate_user_id."""
+    __tablename__ = "id_counters"
+    animal = Column(String, primary_key=True)
+    year = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+class OfflineMessage(Base):
+    """A relayed message waiting for its recipient to connect; see offline_queue.py."""
+    __tablename__ = "offline_messages"
+    id = Column(Integer, primary_key=True, autoincrement=True)  # Append order = delivery order
+    recipient_id = Column(String, nullable=False)
+    sender_id = Column(String, nullable=False)
+    message_id = Column(String, nullable=False)
+    payload = Column(Text, nullable=False)  # The JSON frame exactly as it would have been relayed
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    __table_args__ = (Index("ix_offline_messages_recipient_id_id", "recipient_id", "id"),)
@@ -0,0 +1,153 @@
+import os
+import json
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Awaitable, Callable, Optional
+from pydantic import BaseModel, ValidationError
+from fastapi.responses import StreamingResponse
+
+from config import Config
+from nlp_lite import registry, scan_danger, scan_misconduct
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# --- Chunk scanners ---
+# These run inside worker processes, so they must be top-level (picklable) functions.
+# The pattern spec travels with each chunk so workers scan with the same registry
+# version as the process that submitted it, even right after a reload.
+# They skip the per-message logging of detect_* so a backfill doesn't flood the logs;
+# the results have the same shape as scan_danger / scan_misconduct.
+
+def scan_emergency_chunk(messages: list[str], spec: dict) -> list[dict]:
+    snapshot = registry.snapshot_for(spec)
+    return [scan_danger(message, snapshot) for message in messages]
+
+def scan_misconduct_chunk(messages: list[str], spec: dict) -> list[dict]:
+    snapshot = registry.snapshot_for(spec)
+    return [scan_misconduct(message, snapshot) for message in messages]
+
+# --- Process pool ---
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        workers = Config.NLP_BATCH_WORKERS or os.cpu_count() or 1
+        _process_pool = ProcessPoolExecutor(max_workers=workers)
+        logging.info(f"Started NLP batch process pool with {workers} workers")
+    return _process_pool
+
+def shutdown_process_pool():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+async def run_batch(scan_chunk: Callable[[list[str], dict], list], messages: list[str]) -> list:
+    """
+    Scan a list of messages and return one result per message, in order.
+    Small batches are scanned inline; large ones are split into chunks and
+    spread across the process pool.
+    """
+    spec = registry.current.spec
+    if len(messages) < Config.NLP_BATCH_PARALLEL_THRESHOLD:
+        return scan_chunk(messages, spec)
+
+    loop = asyncio.get_running_loop()
+    pool = get_process_pool()
+    chunk_size = Config.NLP_BATCH_CHUNK_SIZE
+    futures = [
+        loop.run_in_executor(pool, scan_chunk, messages[i:i + chunk_size], spec)
+        for i in range(0, len(messages), chunk_size)
+    ]
+    results = []
+    for chunk_results in await asyncio.gather(*futures):
+        results.extend(chunk_results)
+    return results
+
+# --- NDJSON streaming ---
+async def iter_ndjson_lines(stream: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Split a byte stream into lines without buffering more than one partial line."""
+    pending = b""
+    async for chunk in stream:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line.decode("utf-8", errors="replace")
+    if pending.strip():
+        yield pending.decode("utf-8", errors="replace")
+
+class NDJSONStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that does not listen for client disconnects while streaming.
+    The stock class reads receive() to spot disconnects, which would swallow the
+    request body chunks the endpoint is still consuming; a disconnect surfaces as
+    ClientDisconnect from request.stream() instead.
+    """
+    media_type = "application/x-ndjson"
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+async def stream_scan(
+    lines: AsyncIterator[str],
+    model: type[BaseModel],
+    scan_chunk: Callable[[list[str], dict], list],
+    build_result: Callable[[BaseModel, object], Awaitable[BaseModel]],
+) -> AsyncIterator[str]:
+    """
+    Scan an NDJSON stream of request objects (validated with `model`) and yield
+    one NDJSON result line per input line, in input order. Lines that fail to
+    parse get an {"index", "error"} line instead of aborting the stream.
+
+    At most NLP_BATCH_MAX_IN_FLIGHT chunks are buffered at once, so memory stays
+    constant regardless of how many lines the client sends.
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_process_pool()
+    chunk_size = Config.NLP_BATCH_CHUNK_SIZE
+    spec = registry.current.spec  # One registry version for the whole stream
+    in_flight = deque()
+
+    async def drain_oldest():
+        items, future = in_flight.popleft()
+        scan_results = await future
+        scan_iter = iter(scan_results)
+        output = []
+        for index, item, error in items:
+            if error:
+                output.append(json.dumps({"index": index, "error": error}))
+            else:
+                result = await build_result(item, next(scan_iter))
+                output.append(json.dumps({"index": index, **result.model_dump()}))
+        return "\n".join(output) + "\n"
+
+    def submit(items):
+        texts = [item.chat_message for _, item, error in items if not error]
+        in_flight.append((items, loop.run_in_executor(pool, scan_chunk, texts, spec)))
+
+    items = []
+    index = 0
+    async for line in lines:
+        try:
+            items.append((index, model.model_validate_json(line), None))
+        except ValidationError as e:
+            error = e.errors(include_url=False)[0]
+            items.append((index, None, f"Invalid line: {error['msg']} at {list(error['loc'])}"))
+        index += 1
+
+        if len(items) >= chunk_size:
+            submit(items)
+            items = []
+            if len(in_flight) >= Config.NLP_BATCH_MAX_IN_FLIGHT:
+                yield await drain_oldest()
+
+    if items:
+        submit(items)
+    while in_flight:
+        yield await drain_oldest()
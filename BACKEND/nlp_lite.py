@@ -1,34 +1,285 @@
+import os
 import re
+import json
+import time
+import hashlib
 import logging
+import threading
+from typing import Optional
 from config import Config
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Built-in patterns, used when the pattern file (Config.NLP_PATTERNS_FILE) is missing.
+# Define the danger patterns (keywords and simple regexes) as (category, pattern) pairs.
+# Order matters: when several patterns hit, the earliest one in the list is reported.
+# Using regex word boundaries (\b) helps match whole words.
+DANGER_PATTERNS = [
+    ("sexual_assault", r"\b(raped|sexual assault|molested)\b"), # Specific "rape" comments
+    ("vision_loss", r"\b(can't see|cannot see)\b"),          # "I can't see"
+    ("overdose", r"\b(overdose|od|taken too much|too many pills|pills taken)\b"), # Overdose related
+    ("distress", r"\b(help|urgent|emergency|crisis|danger|unsafe|pain|bleeding)\b"), # General distress
+    ("medical_emergency", r"\b(dying|unconscious|choking|can't breathe|breathing difficulty)\b"), # Medical emergency
+    ("self_harm", r"\b(suicide|kill myself|ending it|end my life|can't go on|want to die)\b"), # Self-harm/suicide ideation
+    ("violence", r"\b(attacked|assaulted|stabbed|shot|injured|hurt bad)\b"), # Violence
+    ("held_against_will", r"\b(trap|stuck|kidnapped|abducted)\b") # Being held against will
+]
+
+# Counselor misconduct patterns, checked in order: meeting suggestions,
+# substance encouragement, then personal information requests.
+MISCONDUCT_PATTERNS = [
+    # Inappropriate meeting suggestions
+    ("inappropriate_meeting", r"\b(meet up|meet in person|get together|hang out|meet somewhere|coffee|outside school|my house|my place)\b"),
+    ("inappropriate_meeting", r"\b(give me your address|where do you live|your home|come over|visit me)\b"),
+    ("inappropriate_meeting", r"\b(private meeting|secret meeting|don't tell anyone|keep this between us)\b"),
+    # Encouragement of drug/alcohol use
+    ("substance_encouragement", r"\b(try drugs|take drugs|use drugs|should drink|try drinking|get high|get drunk)\b"),
+    ("substance_encouragement", r"\b(alcohol helps|drugs help|weed|marijuana|cocaine|pills will help|it's just alcohol)\b"),
+    ("substance_encouragement", r"\b(drinking age|smoking age|won't hurt you|makes you feel better|no one will know)\b"),
+    # Inappropriate personal information requests
+    ("personal_info_request", r"\b(send photo|send picture|send selfie|picture of you|photo of you|selfie of you)\b"),
+    ("personal_info_request", r"\b(what are you wearing|describe yourself|how do you look|your body)\b"),
+    ("personal_info_request", r"\b(social media|instagram|snapchat|tiktok account|follow me|my account)\b"),
+    ("personal_info_request", r"\b(phone number|address|where exactly|personal email|private contact)\b")
+]
+
+MISCONDUCT_LOG_MESSAGES = {
+    "inappropriate_meeting": "Potential grooming detected",
+    "substance_encouragement": "Substance encouragement detected",
+    "personal_info_request": "Inappropriate personal info request detected"
+}
+
+def _word_group_body(pattern: str) -> Optional[str]:
+    r"""Return the body of a \b(...)\b pattern, or None if the pattern has another shape."""
+    if not (pattern.startswith(r"\b(") and pattern.endswith(r")\b")):
+        return None
+    body = pattern[3:-3]
+    depth = 0
+    escaped = False
+    for char in body:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth < 0:
+                return None  # The leading "(" closes before the end, e.g. r"\b(a)|(b)\b"
+    return body if depth == 0 else None
+
+class PatternMatcher:
+    """
+    Compiles an ordered list of (category, pattern) pairs into a single regex
+    so a message is scanned once instead of once per pattern.
+
+    Results are identical to running re.search for each pattern in order and
+    stopping at the first hit.
+    """
+    def __init__(self, patterns: list[tuple[str, str]]):
+        self.patterns = list(patterns)
+        inner = [_word_group_body(pattern) for _, pattern in self.patterns]
+        if all(body is not None for body in inner):
+            # Every pattern is r"\b(...)\b": hoist the word boundaries out of the alternation
+            # so positions that are not at a word boundary are rejected once, not per pattern.
+            groups = "|".join(f"(?P<p{i}>{body})" for i, body in enumerate(inner))
+            alternation = rf"\b(?:{groups})\b"
+        else:
+            alternation = "|".join(f"(?P<p{i}>{pattern})" for i, (_, pattern) in enumerate(self.patterns))
+        # Consuming form: finds the leftmost position where any pattern matches.
+        self._search_re = re.compile(alternation)
+        # Zero-width form: reports the first pattern (in list order) matching at every position,
+        # including positions inside an earlier match, so no higher-priority hit is hidden.
+        self._scan_re = re.compile(f"(?=(?:{alternation}))")
+
+    def _hit(self, index: int, match: re.Match) -> dict:
+        category, pattern = self.patterns[index]
+        return {"category": category, "pattern": pattern, "phrase": match.group(f"p{index}")}
+
+    def first(self, text_lower: str) -> Optional[dict]:
+        """Return the highest-priority hit as {category, pattern, phrase}, or None."""
+        match = self._search_re.search(text_lower)
+        if match is None:
+            return None
+
+        # Nothing matches before match.start(), so only scan from there on.
+        best_index, best_match = None, None
+        for candidate in self._scan_re.finditer(text_lower, match.start()):
+            index = int(candidate.lastgroup[1:])
+            if best_index is None or index < best_index:
+                best_index, best_match = index, candidate
+                if index == 0:
+                    break
+        return self._hit(best_index, best_match)
+
+    def scan(self, text_lower: str) -> dict:
+        """Return the highest-priority hit for every category present, keyed by category."""
+        hits = {}
+        best = {}
+        for candidate in self._scan_re.finditer(text_lower):
+            index = int(candidate.lastgroup[1:])
+            category = self.patterns[index][0]
+            if category not in best or index < best[category]:
+                best[category] = index
+                hits[category] = self._hit(index, candidate)
+        return hits
+
+class PatternSnapshot:
+    """An immutable, compiled version of the pattern registry."""
+    def __init__(self, spec: dict):
+        self.spec = spec
+        self.version = spec["version"]
+        self.danger = PatternMatcher([(p["category"], p["pattern"]) for p in spec["danger"]])
+        self.misconduct = PatternMatcher([(p["category"], p["pattern"]) for p in spec["misconduct"]])
+
+class PatternRegistry:
+    """
+    Loads the danger and misconduct phrase lists from a JSON file (falling back to
+    the built-in lists) and compiles them into a PatternSnapshot.
+
+    reload() compiles the new snapshot before swapping it in with a single
+    reference assignment, so scans already running keep the snapshot they
+    started with and are never blocked. Every snapshot carries a version.
+
+    A reload only affects this process. Every `check_interval` seconds `current`
+    also looks at the file's mtime and size and reloads it if they changed, so
+    the other worker processes pick up an edited file on their own.
+    """
+    def __init__(self, path: str, extra_danger_keywords: list[str], check_interval: float = 0):
+        self.path = path
+        self.extra_danger_keywords = extra_danger_keywords
+        self.check_interval = check_interval
+        self._lock = threading.Lock()  # Serializes reloads only; scans never take it
+        self._current: Optional[PatternSnapshot] = None
+        self._loaded_stamp: Optional[tuple[int, int]] = None  # File stamp of the last load attempt
+        self._next_check = 0.0
+        self._compiled: dict[str, PatternSnapshot] = {}  # Snapshots compiled from specs sent by other processes
+
+    @property
+    def current(self) -> PatternSnapshot:
+        if self._current is None:
+            try:
+                self.reload()
+            except ValueError as e:
+                # A bad file at startup must not break every scan: serve the built-in lists until a good reload
+                logging.error(f"{e}; using built-in patterns")
+                with self._lock:
+                    if self._current is None:
+                        self._current = PatternSnapshot(self._read_spec(builtin=True))
+            self._next_check = time.monotonic() + self.check_interval
+        elif self.check_interval and time.monotonic() >= self._next_check:
+            self._next_check = time.monotonic() + self.check_interval
+            if self._stamp() != self._loaded_stamp:
+                try:
+                    self.reload()
+                except ValueError as e:
+                    # Logged once per change of the file, not on every check
+                    logging.error(f"{e}; keeping version {self._current.version}")
+        return self._current
+
+    @property
+    def loaded(self) -> Optional[PatternSnapshot]:
+        """The snapshot in use, without loading or checking the file."""
+        return self._current
+
+    def _stamp(self) -> Optional[tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read_spec(self, builtin: bool = False) -> dict:
+        if not builtin and os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                raw = json.load(f)
+        else:
+            if not builtin:
+                logging.warning(f"Pattern file '{self.path}' not found, using built-in patterns")
+            raw = {
+                "danger": [{"category": c, "pattern": p} for c, p in DANGER_PATTERNS],
+                "misconduct": [{"category": c, "pattern": p} for c, p in MISCONDUCT_PATTERNS],
+            }
+
+        if not isinstance(raw, dict):
+            raise ValueError("Pattern file must contain a JSON object with 'danger' and 'misconduct' lists")
+        for key in ("danger", "misconduct"):
+            if not isinstance(raw.get(key, []), list):
+                raise ValueError(f"'{key}' must be a list of {{category, pattern}} objects")
+        danger = list(raw.get("danger", []))
+        misconduct = list(raw.get("misconduct", []))
+        if self.extra_danger_keywords:
+            # Keywords from NLP_DANGER_KEYWORDS are checked after the file's patterns
+            keywords = "|".join(re.escape(k.lower()) for k in self.extra_danger_keywords)
+            danger.append({"category": "configured_keyword", "pattern": rf"\b({keywords})\b"})
+
+        for entry in danger + misconduct:
+            if not isinstance(entry, dict) or not isinstance(entry.get("category"), str) or not isinstance(entry.get("pattern"), str):
+                raise ValueError(f"Invalid pattern entry: {entry}")
+            re.compile(entry["pattern"])  # Surface regex errors before anything is swapped
+
+        # The version changes whenever the effective pattern lists do
+        digest = hashlib.sha256(json.dumps([danger, misconduct], sort_keys=True).encode("utf-8")).hexdigest()
+        label = raw.get("version")
+        version = f"{label}-{digest[:8]}" if label else digest[:12]
+        return {"version": version, "danger": danger, "misconduct": misconduct}
+
+    def reload(self) -> PatternSnapshot:
+        """Re-read and compile the patterns. Raises ValueError and keeps the old snapshot on bad input."""
+        with self._lock:
+            self._loaded_stamp = self._stamp()
+            try:
+                snapshot = PatternSnapshot(self._read_spec())
+            except (OSError, ValueError, re.error, KeyError, TypeError, AttributeError) as e:
+                raise ValueError(f"Could not load patterns from '{self.path}': {e}") from e
+            self._current = snapshot
+        logging.info(f"Loaded NLP pattern registry version {snapshot.version} "
+                     f"({len(snapshot.spec['danger'])} danger, {len(snapshot.spec['misconduct'])} misconduct patterns)")
+        return snapshot
+
+    def snapshot_for(self, spec: dict) -> PatternSnapshot:
+        """Return a compiled snapshot for a spec, e.g. one shipped to a batch worker process."""
+        current = self.current
+        if spec["version"] == current.version:
+            return current
+        snapshot = self._compiled.get(spec["version"])
+        if snapshot is None:
+            snapshot = PatternSnapshot(spec)
+            self._compiled = {spec["version"]: snapshot}  # Keep only the latest foreign version
+        return snapshot
+
+registry = PatternRegistry(Config.NLP_PATTERNS_FILE, Config.NLP_DANGER_KEYWORDS, check_interval=Config.NLP_PATTERNS_CHECK_SECONDS)
+
+def scan_danger(text: str, snapshot: Optional[PatternSnapshot] = None) -> dict:
+    """
+    Scan for danger intent. Returns {"detected", "version"} plus
+    "category", "pattern" and "phrase" of the first hit when detected.
+    """
+    snapshot = snapshot or registry.current
+    hit = snapshot.danger.first(text.lower())
+    if hit:
+        return {"detected": True, "version": snapshot.version, **hit}
+    return {"detected": False, "version": snapshot.version}
+
+def scan_misconduct(text: str, snapshot: Optional[PatternSnapshot] = None) -> dict:
+    """Scan counselor text for misconduct. Same shape as detect_counselor_misconduct, without logging."""
+    snapshot = snapshot or registry.current
+    hit = snapshot.misconduct.first(text.lower())
+    if hit:
+        return {"detected": True, "type": hit["category"], "pattern": hit["pattern"], "version": snapshot.version}
+    return {"detected": False, "version": snapshot.version}
+
 def detect_danger_intent(text: str) -> bool:
     """
     Detects specific 'danger' intents using a keyword and regex-based approach.
     This is an extremely lightweight alternative to large NLP models.
     """
-    text_lower = text.lower()
-
-    # Define a list of danger patterns (keywords and simple regexes)
-    # Using regex word boundaries (\b) helps match whole words.
-    danger_patterns = [
-        r"\b(raped|sexual assault|molested)\b", # Specific "rape" comments
-        r"\b(can't see|cannot see)\b",          # "I can't see"
-        r"\b(overdose|od|taken too much|too many pills|pills taken)\b", # Overdose related
-        r"\b(help|urgent|emergency|crisis|danger|unsafe|pain|bleeding)\b", # General distress
-        r"\b(dying|unconscious|choking|can't breathe|breathing difficulty)\b", # Medical emergency
-        r"\b(suicide|kill myself|ending it|end my life|can't go on|want to die)\b", # Self-harm/suicide ideation
-        r"\b(attacked|assaulted|stabbed|shot|injured|hurt bad)\b", # Violence
-        r"\b(trap|stuck|kidnapped|abducted)\b" # Being held against will
-    ]
-
-    for pattern in danger_patterns:
-        if re.search(pattern, text_lower):
-            logging.info(f"Danger intent detected by pattern: '{pattern}' in text: '{text}'")
-            return True
-            
+    result = scan_danger(text)
+    if result["detected"]:
+        logging.info(f"Danger intent detected by pattern: '{result['pattern']}' (patterns {result['version']}) in text: '{text}'")
+        return True
+
     logging.info(f"No danger intent detected in text: '{text}'")
     return False
 
@@ -38,49 +289,13 @@ def detect_counselor_misconduct(text: str) -> dict:
     1. Suggesting in-person meetings (potential grooming)
     2. Encouraging drug or alcohol use
     3. Requesting excessive personal details
-    
-    Returns a dict with detection result and type of misconduct if found
+
+    Returns a dict with detection result, type of misconduct if found and the
+    pattern registry version that produced it
     """
-    text_lower = text.lower()
-    
-    # Patterns for detecting inappropriate meeting suggestions
-    meeting_patterns = [
-        r"\b(meet up|meet in person|get together|hang out|meet somewhere|coffee|outside school|my house|my place)\b",
-        r"\b(give me your address|where do you live|your home|come over|visit me)\b",
-        r"\b(private meeting|secret meeting|don't tell anyone|keep this between us)\b"
-    ]
-    
-    # Patterns for detecting encouragement of drug/alcohol use
-    substance_patterns = [
-        r"\b(try drugs|take drugs|use drugs|should drink|try drinking|get high|get drunk)\b",
-        r"\b(alcohol helps|drugs help|weed|marijuana|cocaine|pills will help|it's just alcohol)\b",
-        r"\b(drinking age|smoking age|won't hurt you|makes you feel better|no one will know)\b"
-    ]
-    
-    # Patterns for detecting inappropriate personal information requests
-    personal_info_patterns = [
-        r"\b(send photo|send picture|send selfie|picture of you|photo of you|selfie of you)\b",
-        r"\b(what are you wearing|describe yourself|how do you look|your body)\b",
-        r"\b(social media|instagram|snapchat|tiktok account|follow me|my account)\b",
-        r"\b(phone number|address|where exactly|personal email|private contact)\b"
-    ]
-    
-    # Check for meeting suggestions
-    for pattern in meeting_patterns:
-        if re.search(pattern, text_lower):
-            logging.warning(f"Potential grooming detected: '{pattern}' in text: '{text}'")
-            return {"detected": True, "type": "inappropriate_meeting", "pattern": pattern}
-    
-    # Check for substance encouragement
-    for pattern in substance_patterns:
-        if re.search(pattern, text_lower):
-            logging.warning(f"Substance encouragement detected: '{pattern}' in text: '{text}'")
-            return {"detected": True, "type": "substance_encouragement", "pattern": pattern}
-            
-    # Check for personal information requests
-    for pattern in personal_info_patterns:
-        if re.search(pattern, text_lower):
-            logging.warning(f"Inappropriate personal info request detected: '{pattern}' in text: '{text}'")
-            return {"detected": True, "type": "personal_info_request", "pattern": pattern}
-    
-    return {"detected": False}
\ No newline at end of file
+    result = scan_misconduct(text)
+    if result["detected"]:
+        log_message = MISCONDUCT_LOG_MESSAGES.get(result["type"], "Counselor misconduct detected")
+        logging.warning(f"{log_message}: '{result['pattern']}' (patterns {result['version']}) in text: '{text}'")
+
+    return result
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy import select, delete, func
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from config import Config
+from models import OfflineMessage
+from database import AsyncSessionLocal
+from metrics import metrics
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+class OfflineQueue:
+    """
+    Durable store-and-forward queue for messages whose recipient is offline.
+
+    enqueue() only appends. Messages are kept for at most `ttl` and at most
+    `max_per_recipient` per recipient (the oldest are dropped); both limits are
+    applied when the recipient's queue is flushed and by a sweep that runs every
+    SWEEP_EVERY enqueues. When the recipient connects, flush() sends the backlog
+    in order, `batch_size` rows at a time, deleting each batch once it has been
+    sent. Delivery is at least once: a connection that drops mid-batch keeps the
+    unsent rest.
+    """
+    SWEEP_EVERY = 500  # Enqueues between sweeps of expired and over-cap rows
+
+    def __init__(self, session_factory: async_sessionmaker, max_per_recipient: int, ttl: timedelta, batch_size: int):
+        self.session_factory = session_factory
+        self.max_per_recipient = max_per_recipient
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self._flushing: dict[str, asyncio.Event] = {}  # Recipients with a flush in progress in this worker, set when it ends
+        self._rerun: set[str] = set()  # Recipients whose running flush must look again before it ends
+        self._enqueues = 0
+        self._sweeper: Optional[asyncio.Task] = None
+        self._queued = metrics.counter("offline_queue.queued")
+        self._delivered = metrics.counter("offline_queue.delivered")
+        self._dropped = metrics.counter("offline_queue.dropped")
+
+    async def enqueue(self, recipient_id: str, sender_id: str, message_id: str, payload: str):
+        now = datetime.utcnow()
+        async with self.session_factory() as db:
+            db.add(OfflineMessage(
+                recipient_id=recipient_id,
+                sender_id=sender_id,
+                message_id=message_id,
+                payload=payload,
+                created_at=now,
+                expires_at=now + self.ttl,
+            ))
+            await db.commit()
+        self._queued.inc()
+
+        self._enqueues += 1
+        if self._enqueues % self.SWEEP_EVERY == 0 and (self._sweeper is None or self._sweeper.done()):
+            self._sweeper = asyncio.create_task(self.sweep())
+
+    async def _trim(self, db: AsyncSession, recipient_id: str) -> int:
+        """Delete the recipient's expired messages and the oldest beyond the cap. Returns the count over the cap."""
+        await db.execute(delete(OfflineMessage).where(
+            OfflineMessage.recipient_id == recipient_id, OfflineMessage.expires_at <= datetime.utcnow()
+        ))
+        waiting = await db.scalar(select(func.count()).where(OfflineMessage.recipient_id == recipient_id))
+        overflow = waiting - self.max_per_recipient
+        if overflow > 0:
+            oldest = select(OfflineMessage.id).where(OfflineMessage.recipient_id == recipient_id).order_by(OfflineMessage.id).limit(overflow)
+            await db.execute(delete(OfflineMessage).where(OfflineMessage.id.in_(oldest)))
+            self._dropped.inc(overflow)
+            logging.warning(f"Offline queue for {recipient_id} full, dropped {overflow} oldest messages")
+        return max(overflow, 0)
+
+    async def sweep(self):
+        """Apply the TTL to every queue and the cap to every recipient over it."""
+        try:
+            async with self.session_factory() as db:
+                await db.execute(delete(OfflineMessage).where(OfflineMessage.expires_at <= datetime.utcnow()))
+                over_cap = (await db.scalars(
+                    select(OfflineMessage.recipient_id)
+                    .group_by(OfflineMessage.recipient_id)
+                    .having(func.count() > self.max_per_recipient)
+                )).all()
+                for recipient_id in over_cap:
+                    await self._trim(db, recipient_id)
+                await db.commit()
+        except Exception as e:
+            logging.error(f"Offline queue sweep failed: {e}")
+
+    async def flush(
+        self,
+        recipient_id: str,
+        send: Callable[[str], Awaitable[None]],
+        on_delivered: Callable[[OfflineMessage], Awaitable[None]],
+        wait: bool = True,
+    ) -> int:
+        """
+        Send the recipient's backlog through `send`, then await `on_delivered` per
+        message. Returns the count sent.
+
+        If a flush for the recipient is already running in this worker, this call
+        waits for it and then flushes whatever is left. With `wait=False` it
+        returns 0 at once instead, and the running flush looks for new rows once
+        more before it ends.
+        """
+        while (running := self._flushing.get(recipient_id)) is not None:
+            if not wait:
+                self._rerun.add(recipient_id)
+                return 0
+            await running.wait()
+        done = self._flushing[recipient_id] = asyncio.Event()
+        sent_total = 0
+        try:
+            async with self.session_factory() as db:
+                await self._trim(db, recipient_id)
+                await db.commit()
+
+                while True:
+                    # Sent rows are deleted, so the oldest remaining rows are always next.
+                    # Rows committed while we run are picked up the same way.
+                    batch = (await db.scalars(
+                        select(OfflineMessage)
+                        .where(OfflineMessage.recipient_id == recipient_id)
+                        .order_by(OfflineMessage.id)
+                        .limit(self.batch_size)
+                    )).all()
+                    if not batch:
+                        if recipient_id in self._rerun:
+                            self._rerun.discard(recipient_id)
+                            await db.commit()  # End the read so the next one sees the new rows
+                            continue
+                        # No await between the last empty read and here, so a concurrent
+                        # caller either sees this flush running or starts its own
+                        del self._flushing[recipient_id]
+                        break
+
+                    sent = []
+                    try:
+                        for queued in batch:
+                            await send(queued.payload)
+                            sent.append(queued)
+                    finally:
+                        # Only forget what actually went out. Shielded: a connection that
+                        # closes mid-flush cancels us, but the bookkeeping must still finish.
+                        if sent:
+                            await asyncio.shield(self._mark_delivered(sent, on_delivered))
+                    sent_total += len(sent)
+        finally:
+            if self._flushing.get(recipient_id) is done:
+                del self._flushing[recipient_id]
+                self._rerun.discard(recipient_id)
+            done.set()
+
+        if sent_total:
+            logging.info(f"Delivered {sent_total} queued messages to {recipient_id}")
+        return sent_total
+
+    async def _mark_delivered(self, sent: list[OfflineMessage], on_delivered: Callable[[OfflineMessage], Awaitable[None]]):
+        async with self.session_factory() as db:
+            await db.execute(delete(OfflineMessage).where(OfflineMessage.id.in_([m.id for m in sent])))
+            await db.commit()
+        self._delivered.inc(len(sent))
+        for queued in sent:
+            await on_delivered(queued)
+
+    async def pending_count(self, recipient_id: str) -> int:
+        async with self.session_factory() as db:
+            return await db.scalar(select(func.count()).where(OfflineMessage.recipient_id == recipient_id))
+
+offline_queue = OfflineQueue(
+    AsyncSessionLocal,
+    max_per_recipient=Config.OFFLINE_QUEUE_MAX_PER_RECIPIENT,
+    ttl=timedelta(hours=Config.OFFLINE_QUEUE_TTL_HOURS),
+    batch_size=Config.OFFLINE_QUEUE_FLUSH_BATCH,
+)
@@ -0,0 +1,83 @@
+import logging
+from typing import Iterable, Optional, Union
+
+from sqlalchemy import event, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Principal, StudentUser, CounselorUser
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# --- Keeping the index in sync ---
+# Every flush that creates, changes or deletes a student or counselor updates its
+# principals row in the same transaction, so the index can't drift from the tables.
+def _principal_fields(user: Union[StudentUser, CounselorUser]) -> dict:
+    is_student = isinstance(user, StudentUser)
+    return {
+        "role": user.role or ("Student" if is_student else "Counselor"),
+        "user_table": StudentUser.__tablename__ if is_student else CounselorUser.__tablename__,
+        "campus_id": user.campus_id,
+        "is_paid": bool(user.is_paid) if is_student else False,
+    }
+
+@event.listens_for(Session, "before_flush")
+def _sync_principals(session, flush_context, instances):
+    for user in list(session.new) + list(session.dirty):
+        if not isinstance(user, (StudentUser, CounselorUser)):
+            continue
+        principal = session.get(Principal, user.id)
+        if principal is None:
+            session.add(Principal(user_id=user.id, **_principal_fields(user)))
+        else:
+            for field, value in _principal_fields(user).items():
+                setattr(principal, field, value)
+
+    for user in list(session.deleted):
+        if isinstance(user, (StudentUser, CounselorUser)):
+            principal = session.get(Principal, user.id)
+            if principal is not None:
+                session.delete(principal)
+
+def backfill_principals(engine: Engine):
+    """Index users created before the principals table existed (runs at startup)."""
+    indexed = select(Principal.user_id)
+    with Session(engine) as db:
+        added = 0
+        for model in (StudentUser, CounselorUser):
+            for user in db.scalars(select(model).where(model.id.not_in(indexed))).all():
+                db.add(Principal(user_id=user.id, **_principal_fields(user)))
+                added += 1
+        db.commit()
+    if added:
+        logging.info(f"Backfilled {added} users into the principals index")
+
+# --- Lookups ---
+async def principal_exists(db: AsyncSession, user_id: str) -> bool:
+    """ID-collision check across both user tables."""
+    return await db.scalar(select(Principal.user_id).where(Principal.user_id == user_id)) is not None
+
+async def taken_principals(db: AsyncSession, user_ids: Iterable[str]) -> set[str]:
+    """Which of `user_ids` already exist, in one query."""
+    return set((await db.scalars(select(Principal.user_id).where(Principal.user_id.in_(list(user_ids))))).all())
+
+def counselor_id_base(name: str) -> str:
+    """Counselor IDs derive from the name; a _1, _2... suffix is added on collision."""
+    return f"COUNSELOR_{name.replace(' ', '_').upper()}"
+
+async def get_account(db: AsyncSession, user_id: str) -> Optional[Union[StudentUser, CounselorUser]]:
+    """
+    Resolve a user ID to its StudentUser or CounselorUser row in one statement:
+    the principals row picks the table, and only that table is joined.
+    """
+    row = (await db.execute(
+        select(StudentUser, CounselorUser)
+        .select_from(Principal)
+        .outerjoin(StudentUser, (Principal.user_table == StudentUser.__tablename__) & (StudentUser.id == Principal.user_id))
+        .outerjoin(CounselorUser, (Principal.user_table == CounselorUser.__tablename__) & (CounselorUser.id == Principal.user_id))
+        .where(Principal.user_id == user_id)
+    )).first()
+    if row is None:
+        return None
+    return row[0] if row[0] is not None else row[1]
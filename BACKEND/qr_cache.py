@@ -0,0 +1,132 @@
+import io
+import os
+import json
+import asyncio
+import hashlib
+import logging
+import tempfile
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import qrcode
+
+from config import Config
+from metrics import metrics
+from nlp_batch import get_process_pool
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Everything that affects the rendered image besides the encoded text
+QR_RENDER_SETTINGS = {
+    "version": 1,
+    "error_correction": "L",
+    "box_size": 10,
+    "border": 4,
+    "fill_color": "black",
+    "back_color": "white",
+}
+
+ERROR_CORRECTION_LEVELS = {
+    "L": qrcode.constants.ERROR_CORRECT_L,
+    "M": qrcode.constants.ERROR_CORRECT_M,
+    "Q": qrcode.constants.ERROR_CORRECT_Q,
+    "H": qrcode.constants.ERROR_CORRECT_H,
+}
+
+def school_qr_payload(school_id: str) -> str:
+    # The QR code encodes a URL to the (authenticated) API endpoint rather than the school data itself
+    return f"{Config.API_BASE_URL}/api/school/{school_id}"
+
+def render_key(payload: str, settings: dict) -> str:
+    return hashlib.sha256(json.dumps([payload, settings], sort_keys=True).encode("utf-8")).hexdigest()
+
+def render_qr_png(payload: str, settings: dict) -> bytes:
+    """Render a QR code to PNG bytes. Runs in a worker process."""
+    qr = qrcode.QRCode(
+        version=settings["version"],
+        error_correction=ERROR_CORRECTION_LEVELS[settings["error_correction"]],
+        box_size=settings["box_size"],
+        border=settings["border"],
+    )
+    qr.add_data(payload)
+    qr.make(fit=True)
+    buffer = io.BytesIO()
+    qr.make_image(fill_color=settings["fill_color"], back_color=settings["back_color"]).save(buffer)
+    return buffer.getvalue()
+
+def write_file_atomically(path: str, data: bytes):
+    # A temp file of our own: other workers may be writing the same path right now
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=os.path.basename(path), suffix=".tmp", delete=False) as f:
+        f.write(data)
+    try:
+        os.chmod(f.name, 0o644)  # Served as a static file; temp files are created owner-only
+        os.replace(f.name, path)  # Readers of the static URL never see a half-written PNG
+    except OSError:
+        os.unlink(f.name)
+        raise
+
+@dataclass(frozen=True)
+class RenderedQR:
+    key: str  # render_key() of the payload and settings
+    png: bytes
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.key[:32]}"'
+
+class QRCodeCache:
+    """
+    Rendered school QR codes, keyed by a hash of the encoded payload and the
+    render settings, kept in memory as PNG bytes (bounded LRU).
+
+    A school's image is only rendered when that key is new to this process, on
+    the process pool so the event loop isn't blocked, and concurrent requests
+    for the same key share one render. The PNG is then also written to
+    `output_dir`/school_{id}.png for the existing /static URL.
+    """
+    def __init__(self, output_dir: str, max_entries: int, settings: dict = QR_RENDER_SETTINGS):
+        self.output_dir = output_dir
+        self.max_entries = max_entries
+        self.settings = settings
+        self._entries: OrderedDict[str, RenderedQR] = OrderedDict()
+        self._rendering: dict[str, asyncio.Task] = {}  # In-flight renders by key
+        self._hits = metrics.counter("qr_cache.hits")
+        self._renders = metrics.counter("qr_cache.renders")
+        self._render_time = metrics.histogram("qr_cache.render_seconds")
+
+    def path_for(self, school_id: str) -> str:
+        return os.path.join(self.output_dir, f"school_{school_id}.png")
+
+    async def get(self, school_id: str) -> RenderedQR:
+        """The school's current QR code, rendering (and saving) it only if its payload or settings changed."""
+        payload = school_qr_payload(school_id)
+        key = render_key(payload, self.settings)
+        rendered = self._entries.get(key)
+        if rendered is not None:
+            self._entries.move_to_end(key)
+            self._hits.inc()
+            return rendered
+
+        task = self._rendering.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = self._rendering[key] = asyncio.create_task(self._render(school_id, payload, key))
+            task.add_done_callback(lambda done: self._rendering.pop(key) if self._rendering.get(key) is done else None)
+        # A cancelled request must not cancel the render other requests are waiting for
+        return await asyncio.shield(task)
+
+    async def _render(self, school_id: str, payload: str, key: str) -> RenderedQR:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        png = await loop.run_in_executor(get_process_pool(), render_qr_png, payload, self.settings)
+        self._render_time.observe(loop.time() - started)
+        self._renders.inc()
+        os.makedirs(self.output_dir, exist_ok=True)
+        await asyncio.to_thread(write_file_atomically, self.path_for(school_id), png)
+
+        rendered = RenderedQR(key=key, png=png)
+        self._entries[key] = rendered
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return rendered
+
+qr_cache = QRCodeCache("static/qrcodes", max_entries=Config.QR_CACHE_MAX_ENTRIES)
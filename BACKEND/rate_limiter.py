@@ -0,0 +1,197 @@
+import os
+import math
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from config import Config
+from metrics import metrics
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+class RateLimit:
+    """
+    A token bucket: up to `capacity` requests in a burst, refilled continuously at
+    capacity / window_seconds tokens per second. Parsed from specs like "5/10s".
+    """
+    UNITS = {"s": 1, "m": 60, "h": 3600}
+
+    def __init__(self, capacity: int, window_seconds: float):
+        if capacity <= 0 or window_seconds <= 0:
+            raise ValueError("Rate limit capacity and window must be positive")
+        self.capacity = capacity
+        self.window_seconds = window_seconds
+        self.refill_rate = capacity / window_seconds
+
+    @classmethod
+    def parse(cls, spec: str) -> "RateLimit":
+        try:
+            count, window = spec.strip().split("/", 1)
+            window = window.strip().lower()
+            unit = window[-1] if window[-1] in cls.UNITS else "s"
+            amount = window[:-1] if window[-1] in cls.UNITS else window
+            return cls(int(count), float(amount or 1) * cls.UNITS[unit])
+        except (ValueError, IndexError):
+            raise ValueError(f"Invalid rate limit '{spec}', expected e.g. '5/10s' or '100/1m'")
+
+    def __repr__(self):
+        return f"RateLimit({self.capacity}/{self.window_seconds:g}s)"
+
+def _take_token(tokens: float, updated_at: float, limit: RateLimit, now: float) -> tuple[float, bool, float]:
+    """Refill a bucket up to `now` and try to take one token: (tokens left, allowed, retry after)."""
+    tokens = min(limit.capacity, tokens + (now - updated_at) * limit.refill_rate)
+    if tokens >= 1:
+        return tokens - 1, True, 0.0
+    return tokens, False, (1 - tokens) / limit.refill_rate
+
+# --- Backends ---
+# acquire(key, limit) -> (allowed, retry_after_seconds). A bucket that has been
+# idle long enough to refill completely is the same as no bucket, so backends
+# may drop it at any time after that (the TTL below).
+
+class MemoryBackend:
+    """Per-process buckets in a bounded LRU; idle buckets are dropped once they would be full again."""
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, tuple[float, float, float]] = OrderedDict()  # key -> (tokens, updated_at, expires_at)
+        self._lock = threading.Lock()
+
+    async def acquire(self, key: str, limit: RateLimit) -> tuple[bool, float]:
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            tokens, updated_at, _ = self._buckets.pop(key, (limit.capacity, now, now))
+            tokens, allowed, retry_after = _take_token(tokens, updated_at, limit, now)
+            self._buckets[key] = (tokens, now, now + (limit.capacity - tokens) / limit.refill_rate)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, retry_after
+
+    def _evict_idle(self, now: float):
+        # Least recently used first, so stop at the first bucket that is still refilling
+        while self._buckets:
+            key, (_, _, expires_at) = next(iter(self._buckets.items()))
+            if expires_at > now:
+                break
+            del self._buckets[key]
+
+    def size(self) -> int:
+        return len(self._buckets)
+
+class SQLiteBackend:
+    """
+    Buckets in a small SQLite file shared by every worker process on the host, so
+    a limit holds no matter which uvicorn worker serves the request. Each acquire
+    is one short IMMEDIATE transaction, run on a worker thread.
+    """
+    SWEEP_EVERY = 1000  # Acquires between deletions of expired buckets
+    SIZE_REFRESH_SECONDS = 5  # Max age of the bucket count reported by size()
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()  # Guards the counters below; acquires run on several threads
+        self._calls = 0
+        self._size = 0
+        self._size_counted_at = 0.0
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_buckets ("
+                "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_rate_buckets_expires_at ON rate_buckets (expires_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")  # Losing a few counts on power loss is acceptable
+            self._local.conn = conn
+        return conn
+
+    def _acquire(self, key: str, limit: RateLimit) -> tuple[bool, float]:
+        now = time.time()  # Wall clock: shared between processes
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated_at FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated_at = row if row else (limit.capacity, now)
+            tokens, allowed, retry_after = _take_token(tokens, updated_at, limit, now)
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_buckets (key, tokens, updated_at, expires_at) VALUES (?, ?, ?, ?)",
+                (key, tokens, now, now + (limit.capacity - tokens) / limit.refill_rate),
+            )
+            with self._lock:
+                self._calls += 1
+                sweep = self._calls % self.SWEEP_EVERY == 0
+                count = now - self._size_counted_at >= self.SIZE_REFRESH_SECONDS
+                if count:
+                    self._size_counted_at = now
+            if sweep:
+                conn.execute("DELETE FROM rate_buckets WHERE expires_at <= ?", (now,))
+            if count:
+                self._size = conn.execute("SELECT COUNT(*) FROM rate_buckets").fetchone()[0]
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed, retry_after
+
+    async def acquire(self, key: str, limit: RateLimit) -> tuple[bool, float]:
+        return await asyncio.to_thread(self._acquire, key, limit)
+
+    def size(self) -> int:
+        """Bucket count as of the last refresh; read by the metrics gauge, so it must not query on the event loop."""
+        return self._size
+
+def build_backend(name: str):
+    if name == "memory":
+        return MemoryBackend(max_keys=Config.RATE_LIMIT_MAX_KEYS)
+    if name == "sqlite":
+        os.makedirs(os.path.dirname(os.path.abspath(Config.RATE_LIMIT_SQLITE_PATH)), exist_ok=True)
+        return SQLiteBackend(Config.RATE_LIMIT_SQLITE_PATH)
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND '{name}', expected 'memory' or 'sqlite'")
+
+# --- Limiter ---
+class RateLimiter:
+    """Applies the limit configured for a route (or the default) to a caller."""
+    def __init__(self, backend, default: RateLimit, route_limits: dict[str, RateLimit]):
+        self.backend = backend
+        self.default = default
+        self.route_limits = route_limits
+        self._allowed = metrics.counter("rate_limiter.allowed")
+        self._rejected = metrics.counter("rate_limiter.rejected")
+        metrics.gauge("rate_limiter.keys", backend.size)
+
+    def limit_for(self, route_path: str) -> RateLimit:
+        return self.route_limits.get(route_path, self.default)
+
+    async def check(self, route_path: str, caller: str) -> Optional[int]:
+        """Take one request from the caller's bucket for this route; returns seconds to wait if limited."""
+        allowed, retry_after = await self.backend.acquire(f"{route_path}|{caller}", self.limit_for(route_path))
+        if allowed:
+            self._allowed.inc()
+            return None
+        self._rejected.inc()
+        return max(1, math.ceil(retry_after))
+
+def parse_route_limits(spec: str) -> dict[str, RateLimit]:
+    """Parse "path=limit,path=limit", e.g. "/api/school/{school_id}=5/10s"."""
+    limits = {}
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        path, _, limit = entry.rpartition("=")
+        if not path:
+            raise ValueError(f"Invalid RATE_LIMIT_ROUTES entry '{entry}', expected 'path=limit'")
+        limits[path.strip()] = RateLimit.parse(limit)
+    return limits
+
+rate_limiter = RateLimiter(
+    backend=build_backend(Config.RATE_LIMIT_BACKEND),
+    default=RateLimit.parse(Config.RATE_LIMIT_DEFAULT),
+    route_limits=parse_route_limits(Config.RATE_LIMIT_ROUTES),
+)
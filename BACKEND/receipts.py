@@ -0,0 +1,85 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable
+
+from config import Config
+from metrics import metrics
+from signaling_manager import manager
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+class ReceiptCoalescer:
+    """
+    Buffers delivery receipts per sender and sends them as one frame:
+
+        {"type": "delivery_receipts", "receipts": [{"message_id", "status", ...}, ...], "timestamp"}
+
+    The first receipt for a sender starts a `window`-second timer; everything
+    that arrives before it fires goes out together (or as soon as `max_batch`
+    are waiting). Only senders that opted in are coalesced, see enable().
+    """
+    def __init__(self, send: Callable[[dict, str], Awaitable[None]], window: float, max_batch: int):
+        self.send = send
+        self.window = window
+        self.max_batch = max_batch
+        self._enabled: set[str] = set()
+        self._buffers: dict[str, list[dict]] = {}
+        self._timers: dict[str, asyncio.Task] = {}
+        self._receipts = metrics.counter("receipts.coalesced_receipts")
+        self._frames = metrics.counter("receipts.coalesced_frames")
+
+    def enable(self, user_id: str):
+        self._enabled.add(user_id)
+
+    def disable(self, user_id: str):
+        """Forget a sender (on disconnect); receipts still buffered are dropped with the connection."""
+        self._enabled.discard(user_id)
+        self._buffers.pop(user_id, None)
+        timer = self._timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+
+    def is_enabled(self, user_id: str) -> bool:
+        return user_id in self._enabled
+
+    async def add(self, user_id: str, receipt: dict):
+        buffer = self._buffers.setdefault(user_id, [])
+        buffer.append({key: value for key, value in receipt.items() if key != "type"})
+        if len(buffer) >= self.max_batch:
+            await self.flush(user_id)
+        elif user_id not in self._timers:
+            self._timers[user_id] = asyncio.create_task(self._flush_later(user_id))
+
+    async def _flush_later(self, user_id: str):
+        await asyncio.sleep(self.window)
+        self._timers.pop(user_id, None)
+        await self.flush(user_id)
+
+    async def flush(self, user_id: str):
+        timer = self._timers.pop(user_id, None)
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        receipts = self._buffers.pop(user_id, None)
+        if not receipts:
+            return
+        self._receipts.inc(len(receipts))
+        self._frames.inc()
+        await self.send({
+            "type": "delivery_receipts",
+            "receipts": receipts,
+            "timestamp": datetime.utcnow().isoformat()
+        }, user_id)
+
+receipt_coalescer = ReceiptCoalescer(
+    manager.send_personal_message,
+    window=Config.RECEIPT_COALESCE_MS / 1000,
+    max_batch=Config.RECEIPT_COALESCE_MAX,
+)
+
+async def send_receipt(user_id: str, receipt: dict) -> bool:
+    """Send a delivery receipt to its sender, coalesced if the sender opted in. False if the sender can't be reached."""
+    if receipt_coalescer.is_enabled(user_id):
+        await receipt_coalescer.add(user_id, receipt)
+        return True
+    return await manager.send_personal_message(receipt, user_id)
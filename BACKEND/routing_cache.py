@@ -0,0 +1,139 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from config import Config
+from models import StudentUser, CounselorUser
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Marker for "not cached" (None is a valid cached value: an unknown sender)
+MISSING = object()
+
+class RoutingCache:
+    """
+    In-memory routing data for the /ws/{user_id} relay loop.
+
+    - identities: role, campus and display name of each connected sender,
+      resolved once at connect time.
+    - recipients: whether a recipient is valid for a (campus, role) pair, as a
+      bounded LRU that also remembers negative answers.
+
+    Both are invalidated per user whenever a StudentUser or CounselorUser row
+    is inserted, updated or deleted (see the session events below). Other
+    worker processes don't see that commit, so entries also expire: after `ttl`
+    seconds, or `negative_ttl` for unknown senders and invalid recipients. Access
+    is guarded by a lock because screening threads read and fill the cache.
+    """
+    def __init__(self, max_recipients: int, ttl: float, negative_ttl: float):
+        self.max_recipients = max_recipients
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._identities: dict[str, tuple[Optional[dict], float]] = {}  # user_id -> (identity, expires at)
+        self._recipients: OrderedDict[tuple[str, str, str], tuple[bool, float]] = OrderedDict()  # key -> (valid, expires at)
+        self._recipient_keys: dict[str, set] = {}  # recipient_id -> cache keys, for invalidation
+
+    def _expires_at(self, positive: bool) -> float:
+        return time.monotonic() + (self.ttl if positive else self.negative_ttl)
+
+    # --- Sender identities ---
+    def get_identity(self, user_id: str):
+        with self._lock:
+            identity, expires_at = self._identities.get(user_id, (MISSING, 0.0))
+            if identity is not MISSING and expires_at <= time.monotonic():
+                del self._identities[user_id]
+                return MISSING
+            return identity
+
+    def set_identity(self, user_id: str, identity: Optional[dict]):
+        with self._lock:
+            self._identities[user_id] = (identity, self._expires_at(identity is not None))
+
+    def forget_identity(self, user_id: str):
+        with self._lock:
+            self._identities.pop(user_id, None)
+
+    # --- Recipient validity ---
+    def get_recipient(self, campus_id: str, role: str, recipient_id: str):
+        key = (campus_id, role, recipient_id)
+        with self._lock:
+            valid, expires_at = self._recipients.get(key, (MISSING, 0.0))
+            if valid is MISSING:
+                return MISSING
+            if expires_at <= time.monotonic():
+                self._drop_recipient(key)
+                return MISSING
+            self._recipients.move_to_end(key)
+            return valid
+
+    def set_recipient(self, campus_id: str, role: str, recipient_id: str, valid: bool):
+        key = (campus_id, role, recipient_id)
+        with self._lock:
+            self._recipients[key] = (valid, self._expires_at(valid))
+            self._recipients.move_to_end(key)
+            self._recipient_keys.setdefault(recipient_id, set()).add(key)
+            while len(self._recipients) > self.max_recipients:
+                self._drop_recipient(next(iter(self._recipients)))
+
+    def _drop_recipient(self, key: tuple[str, str, str]):
+        """Remove one entry and its invalidation index. Caller holds the lock."""
+        del self._recipients[key]
+        keys = self._recipient_keys.get(key[2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._recipient_keys[key[2]]
+
+    # --- Invalidation ---
+    def invalidate_user(self, user_id: str):
+        with self._lock:
+            self._identities.pop(user_id, None)
+            for key in self._recipient_keys.pop(user_id, ()):
+                self._recipients.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._identities.clear()
+            self._recipients.clear()
+            self._recipient_keys.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"identities": len(self._identities), "recipients": len(self._recipients)}
+
+routing_cache = RoutingCache(
+    max_recipients=Config.ROUTING_CACHE_MAX_RECIPIENTS,
+    ttl=Config.ROUTING_CACHE_TTL_SECONDS,
+    negative_ttl=Config.ROUTING_CACHE_NEGATIVE_TTL_SECONDS,
+)
+
+# Invalidate cached routing data whenever a student or counselor row changes.
+# Entries are dropped at flush and again after commit, so a screening thread
+# that re-reads the old row between the two can't leave a stale entry behind.
+def _changed_user_ids(session: Session) -> set:
+    return {
+        obj.id for obj in (*session.new, *session.dirty, *session.deleted)
+        if isinstance(obj, (StudentUser, CounselorUser))
+    }
+
+@event.listens_for(Session, "before_flush")
+def _invalidate_on_flush(session, flush_context, instances):
+    user_ids = _changed_user_ids(session)
+    for user_id in user_ids:
+        routing_cache.invalidate_user(user_id)
+    session.info.setdefault("routing_invalidate", set()).update(user_ids)
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_on_commit(session):
+    for user_id in session.info.pop("routing_invalidate", ()):
+        routing_cache.invalidate_user(user_id)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_on_rollback(session):
+    session.info.pop("routing_invalidate", None)
@@ -0,0 +1,135 @@
+import json
+import time
+import hashlib
+import logging
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Optional
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from config import Config
+from database import AsyncSessionLocal
+from metrics import metrics
+from models import School, CounselorUser
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+@dataclass(frozen=True)
+class DirectoryCounselor:
+    user_id: str
+    name: Optional[str]
+    campus_id: str
+
+@dataclass(frozen=True)
+class DirectorySchool:
+    school_id: str
+    name: str
+    location: Optional[str]
+    counselors: tuple[DirectoryCounselor, ...]
+
+    def qr_data(self) -> dict:
+        """The payload behind a school's QR code and /api/school/{school_id}."""
+        return {
+            "name": self.name,
+            "school_id": self.school_id,
+            "counselors": [{"id": c.user_id, "name": c.name} for c in self.counselors]
+        }
+
+    def api_data(self) -> dict:
+        """The /api/school/{school_id} response body."""
+        return {
+            "name": self.name,
+            "school_id": self.school_id,
+            "location": self.location,
+            "counselors": self.qr_data()["counselors"]
+        }
+
+    @cached_property
+    def etag(self) -> str:
+        """Strong validator for api_data(); changes whenever the school or its counselors do."""
+        digest = hashlib.sha256(json.dumps(self.api_data(), sort_keys=True).encode("utf-8")).hexdigest()
+        return f'"{digest[:32]}"'
+
+@dataclass(frozen=True)
+class DirectorySnapshot:
+    version: int
+    loaded_at: float
+    schools: dict[str, DirectorySchool]  # By school ID, ordered by school ID
+
+class SchoolDirectory:
+    """
+    Every school with its counselors, loaded in one joined query and served
+    from an immutable in-memory snapshot.
+
+    Any commit that touches a School or CounselorUser row invalidates the
+    snapshot (see the session events below) and the next reader loads a new
+    one with a higher version. Other worker processes don't see that commit,
+    so snapshots also expire after `ttl` seconds.
+    """
+    def __init__(self, session_factory: async_sessionmaker, ttl: float):
+        self.session_factory = session_factory
+        self.ttl = ttl
+        self._snapshot: Optional[DirectorySnapshot] = None
+        self._version = 0  # Bumped on every invalidation
+        self._loads = metrics.counter("school_directory.loads")
+        metrics.gauge("school_directory.version", lambda: self._version)
+
+    def invalidate(self):
+        self._version += 1
+        self._snapshot = None
+
+    async def snapshot(self) -> DirectorySnapshot:
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - snapshot.loaded_at < self.ttl:
+            return snapshot
+        version = self._version
+        async with self.session_factory() as db:
+            schools = (await db.scalars(
+                select(School).options(joinedload(School.counselors)).order_by(School.id)
+            )).unique().all()
+            snapshot = DirectorySnapshot(
+                version=version,
+                loaded_at=time.monotonic(),
+                schools={
+                    school.id: DirectorySchool(
+                        school_id=school.id,
+                        name=school.name,
+                        location=school.location,
+                        counselors=tuple(
+                            DirectoryCounselor(user_id=c.id, name=c.name, campus_id=c.campus_id)
+                            for c in sorted(school.counselors, key=lambda c: c.id)
+                        ),
+                    )
+                    for school in schools
+                },
+            )
+        self._loads.inc()
+        if version == self._version:  # Don't install a snapshot an invalidation overtook mid-load
+            self._snapshot = snapshot
+        return snapshot
+
+    async def get(self, school_id: str) -> Optional[DirectorySchool]:
+        return (await self.snapshot()).schools.get(school_id)
+
+school_directory = SchoolDirectory(AsyncSessionLocal, ttl=Config.SCHOOL_DIRECTORY_TTL_SECONDS)
+
+# Drop the snapshot when a school or counselor changes: at flush, and again
+# when the transaction ends, so a snapshot loaded in between can't outlive it.
+@event.listens_for(Session, "before_flush")
+def _invalidate_on_flush(session, flush_context, instances):
+    if any(isinstance(obj, (School, CounselorUser)) for obj in (*session.new, *session.dirty, *session.deleted)):
+        school_directory.invalidate()
+        session.info["school_directory_invalidate"] = True
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_on_commit(session):
+    if session.info.pop("school_directory_invalidate", False):
+        school_directory.invalidate()
+
+@event.listens_for(Session, "after_rollback")
+def _discard_on_rollback(session):
+    if session.info.pop("school_directory_invalidate", False):
+        school_directory.invalidate()
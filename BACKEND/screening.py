@@ -0,0 +1,94 @@
+import zlib
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Optional
+
+from config import Config
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+class ScreeningPipeline:
+    """
+    Runs message-screening jobs through bounded, ordered lanes, with a thread pool
+    (run_blocking) for the blocking parts (NLP checks, logging) so they stay off
+    the event loop.
+
+    Jobs are split across `workers` lanes. Each lane has its own bounded queue and
+    handles one job at a time, and every job for a conversation hashes to the same
+    lane, so messages in a conversation are screened and relayed in the order they
+    were received. When a lane's queue is full, submit() waits (pausing only the
+    sender's receive loop) and gives up after `enqueue_timeout` seconds.
+    """
+    def __init__(self, workers: int, queue_depth: int, enqueue_timeout: float):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.enqueue_timeout = enqueue_timeout
+        self._queues: list[asyncio.Queue] = []
+        self._tasks: list[asyncio.Task] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _ensure_started(self):
+        # Restart the lanes if they belong to another (possibly closed) event loop,
+        # e.g. under TestClient, which runs each request on its own loop.
+        if self._tasks and self._tasks[0].get_loop() is asyncio.get_running_loop():
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="screening")
+        self._queues = [asyncio.Queue(maxsize=self.queue_depth) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._run_lane(queue)) for queue in self._queues]
+        logging.info(f"Screening pipeline started: {self.workers} lanes, queue depth {self.queue_depth}")
+
+    async def _run_lane(self, queue: asyncio.Queue):
+        while True:
+            job, on_done = await queue.get()
+            try:
+                result = await job()
+                await on_done(result)
+            except Exception as e:
+                logging.error(f"Screening job failed: {e}")
+            finally:
+                queue.task_done()
+
+    def _lane_for(self, conversation_key: str) -> asyncio.Queue:
+        return self._queues[zlib.crc32(conversation_key.encode("utf-8")) % self.workers]
+
+    async def submit(self, conversation_key: str, job: Callable[[], Awaitable[Any]], on_done: Callable[[Any], Awaitable[None]]) -> bool:
+        """
+        Queue `job` (a coroutine function) for the conversation's lane; `on_done` is
+        awaited with its result. Returns False if the lane stayed full for longer
+        than the enqueue timeout.
+        """
+        self._ensure_started()
+        queue = self._lane_for(conversation_key)
+        try:
+            await asyncio.wait_for(queue.put((job, on_done)), timeout=self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Screening lane full for conversation {conversation_key}, rejecting message")
+            return False
+        return True
+
+    async def run_blocking(self, func: Callable[..., Any], *args) -> Any:
+        """Run a blocking function on the screening thread pool."""
+        self._ensure_started()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def queue_depths(self) -> list[int]:
+        return [queue.qsize() for queue in self._queues]
+
+    async def shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks and self._tasks[0].get_loop() is asyncio.get_running_loop():
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queues = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+screening_pipeline = ScreeningPipeline(
+    workers=Config.SCREENING_WORKERS,
+    queue_depth=Config.SCREENING_QUEUE_DEPTH,
+    enqueue_timeout=Config.SCREENING_ENQUEUE_TIMEOUT,
+)
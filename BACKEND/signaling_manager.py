@@ -1,40 +1,261 @@
 import json
+import time
+import asyncio
 import logging
+from collections import deque
+from typing import Awaitable, Callable, Optional, Union
 from fastapi import WebSocket, WebSocketDisconnect
 
+from config import Config
+from backplane import Backplane, build_transport
+from metrics import metrics
+from fanout import fan_out, encode_frame
+import wire
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+Message = Union[str, dict]  # A dict, or JSON text that is already encoded
+
+class ConnectionWriter:
+    """
+    Outbound queue for one WebSocket, drained by its own writer task, so a slow
+    recipient only ever delays itself and never the sender's receive loop.
+
+    When more than `max_queue` messages are waiting the overflow policy applies:
+    "drop_oldest" discards the oldest non-critical message and "disconnect"
+    closes the connection. Critical (emergency) messages are never dropped; they
+    are queued even past the limit.
+
+    Messages are encoded with the connection's wire codec; codecs that batch
+    send everything waiting (up to `batch_max` messages) in one frame.
+
+    A writer created with `held=True` queues but sends nothing until release(),
+    so a backlog sent directly on the socket first stays ahead of live messages.
+    """
+    def __init__(self, websocket: WebSocket, user_id: str, max_queue: int, policy: str,
+                 on_overflow: Callable[["ConnectionWriter"], Awaitable[None]], codec=wire.JSON, batch_max: int = 32,
+                 held: bool = False):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.codec = codec
+        self.batch_max = batch_max
+        self.max_queue = max_queue
+        self.policy = policy
+        self._on_overflow = on_overflow
+        self._queue: deque[tuple[Message, bool]] = deque()  # (message, critical)
+        self._in_flight: list[tuple[Message, bool]] = []
+        self._overflowed = False
+        self._ready = asyncio.Event()
+        self._released = asyncio.Event()
+        if not held:
+            self._released.set()
+        self._task = asyncio.create_task(self._run())
+
+    def __len__(self):
+        return len(self._queue) + len(self._in_flight)
+
+    def put(self, message: Message, critical: bool = False):
+        if len(self._queue) >= self.max_queue and not critical and not self._overflowed:
+            if self.policy == "disconnect":
+                # Keep queueing; everything left is handed back by stop()
+                self._overflowed = True
+                _send_queue_overflows.inc()
+                logging.warning(f"Send queue for {self.user_id} full, disconnecting")
+                asyncio.create_task(self._on_overflow(self))
+            else:
+                # drop_oldest: the oldest non-critical message, or this one if everything queued is critical
+                _send_queue_dropped.inc()
+                for index, (_, queued_critical) in enumerate(self._queue):
+                    if not queued_critical:
+                        del self._queue[index]
+                        break
+                else:
+                    return
+        self._queue.append((message, critical))
+        self._ready.set()
+
+    def release(self):
+        self._released.set()
+
+    async def _run(self):
+        await self._released.wait()
+        while True:
+            while not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+            take = min(len(self._queue), self.batch_max) if self.codec.batches else 1
+            self._in_flight = [self._queue.popleft() for _ in range(take)]
+            try:
+                for event in self.codec.encode([message for message, _ in self._in_flight]):
+                    await self.websocket.send(event)
+            except Exception as e:
+                logging.warning(f"Send to {self.user_id} failed, stopping its writer: {e}")
+                return
+            self._in_flight = []
+
+    async def stop(self) -> list[tuple[Message, bool]]:
+        """Stop writing and hand back whatever was still queued (including messages cut off mid-send)."""
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        remaining = self._in_flight + list(self._queue)
+        self._in_flight = []
+        self._queue.clear()
+        return remaining
+
+_send_queue_dropped = metrics.counter("ws_send_queue.dropped")
+_send_queue_overflows = metrics.counter("ws_send_queue.overflow_disconnects")
+
 class ConnectionManager:
-    def __init__(self):
+    """
+    WebSocket connections of this worker. With a backplane, users connected to
+    other workers count as connected too, and messages for them are forwarded.
+
+    Sends never block the caller: each connection has a ConnectionWriter. Messages
+    still queued when a connection goes away, or that the backplane could not
+    forward, are passed to `on_undelivered` (user_id, message, critical) so the
+    caller can store them. Another worker can ask for a local user's stored
+    messages to be flushed; that calls `on_flush_request` (user_id).
+    """
+    def __init__(self, backplane: Optional[Backplane] = None, max_queue: int = 256, overflow_policy: str = "drop_oldest"):
+        if overflow_policy not in ("drop_oldest", "disconnect"):
+            raise ValueError(f"Unknown WS_OVERFLOW_POLICY '{overflow_policy}', expected 'drop_oldest' or 'disconnect'")
         self.active_connections: dict[str, WebSocket] = {}
+        self.connected_since: dict[str, float] = {}
+        self.writers: dict[str, ConnectionWriter] = {}
+        self.backplane = backplane
+        self.max_queue = max_queue
+        self.overflow_policy = overflow_policy
+        self.on_undelivered: Optional[Callable[[str, str, bool], Awaitable[None]]] = None
+        self.on_flush_request: Optional[Callable[[str], Awaitable[None]]] = None
+        metrics.gauge("ws_send_queue.total_depth", lambda: sum(len(w) for w in self.writers.values()))
+        metrics.gauge("ws_send_queue.max_depth", lambda: max((len(w) for w in self.writers.values()), default=0))
 
-    async def connect(self, websocket: WebSocket, user_id: str):
-        await websocket.accept()
+    async def connect(self, websocket: WebSocket, user_id: str, codec=wire.JSON, subprotocol: Optional[str] = None, hold: bool = False):
+        """Register the connection. With `hold`, messages for it are queued until release()."""
+        await websocket.accept(subprotocol=subprotocol)
+        carried_over = []
         if user_id in self.active_connections:
             logging.warning(f"User {user_id} reconnected, closing previous connection.")
+            # Messages still waiting for the old socket go out on the new one
+            carried_over = await self.writers.pop(user_id).stop()
             try:
                 await self.active_connections[user_id].close(code=1000)
             except RuntimeError: # Connection might already be closed
                 pass
         self.active_connections[user_id] = websocket
+        self.connected_since[user_id] = time.time()
+        self.writers[user_id] = ConnectionWriter(
+            websocket, user_id, self.max_queue, self.overflow_policy, self._overflowed, codec, Config.WS_BATCH_MAX_MESSAGES, held=hold
+        )
+        for message, critical in carried_over:
+            self.writers[user_id].put(message, critical)
         logging.info(f"User {user_id} connected. Total clients: {len(self.active_connections)}")
+        if self.backplane is not None:
+            await self.backplane.ensure_started(self)
+            self.backplane.publish_presence(user_id, True, self.connected_since[user_id])
+
+    def release(self, user_id: str, websocket: WebSocket):
+        """Start sending the messages held for a connection since connect(hold=True)."""
+        if self.active_connections.get(user_id) is websocket:
+            self.writers[user_id].release()
+
+    def _remove(self, user_id: str):
+        del self.active_connections[user_id]
+        self.connected_since.pop(user_id, None)
+        writer = self.writers.pop(user_id, None)
+        if writer is not None:
+            asyncio.create_task(self._retire(writer))
 
-    def disconnect(self, user_id: str):
+    async def _retire(self, writer: ConnectionWriter):
+        remaining = await writer.stop()
+        if remaining and self.on_undelivered is not None:
+            for message, critical in remaining:
+                try:
+                    await self.on_undelivered(writer.user_id, message, critical)
+                except Exception as e:
+                    logging.error(f"Could not store undelivered message for {writer.user_id}: {e}")
+
+    def disconnect(self, user_id: str, websocket: Optional[WebSocket] = None):
+        # Ignore a stale disconnect from a socket that has already been replaced
+        if websocket is not None and self.active_connections.get(user_id) is not websocket:
+            return
         if user_id in self.active_connections:
-            del self.active_connections[user_id]
+            self._remove(user_id)
             logging.info(f"User {user_id} disconnected. Total clients: {len(self.active_connections)}")
+            if self.backplane is not None:
+                self.backplane.publish_presence(user_id, False, time.time())
+
+    async def _overflowed(self, writer: ConnectionWriter):
+        """Overflow policy "disconnect": close a connection that can't keep up."""
+        if self.writers.get(writer.user_id) is not writer:
+            return
+        self.disconnect(writer.user_id)
+        try:
+            await writer.websocket.close(code=1013)  # Try again later
+        except RuntimeError:
+            pass
 
-    async def send_personal_message(self, message: str, user_id: str):
+    def is_connected(self, user_id: str) -> bool:
+        """True if the user is connected to this worker or (through the backplane) another one."""
         if user_id in self.active_connections:
-            await self.active_connections[user_id].send_text(message)
+            return True
+        return self.backplane is not None and self.backplane.owner_of(user_id) is not None
+
+    async def send_personal_message(self, message: Message, user_id: str, critical: bool = False,
+                                    on_sent: Optional[Callable[[], Awaitable[None]]] = None) -> bool:
+        """
+        Queue a message for the user's socket, here or (through the backplane) on
+        another worker. Returns False if it could not be. `on_sent` is awaited once
+        the message is queued here, or once the owning worker has received it.
+        """
+        if user_id in self.writers:
+            self.writers[user_id].put(message, critical)
+            if on_sent is not None:
+                await on_sent()
+            return True
+        if self.backplane is not None and self.backplane.deliver(user_id, message, critical, on_sent):
+            return True  # Forwarded to the worker that owns the connection
+        logging.warning(f"Attempted to send message to disconnected user: {user_id}")
+        return False
+
+    async def broadcast(self, message: Message):
+        # JSON is serialized once for every JSON client; batching codecs pack it with the rest of their frame
+        text = None
+        for writer in self.writers.values():
+            if writer.codec.batches:
+                writer.put(message)
+            else:
+                text = text or encode_frame(message)["text"]
+                writer.put(text)
+
+    # --- Called by the backplane ---
+    async def deliver_local(self, user_id: str, message: Message, critical: bool = False):
+        if user_id in self.writers:
+            self.writers[user_id].put(message, critical)
         else:
-            logging.warning(f"Attempted to send message to disconnected user: {user_id}")
+            logging.warning(f"Backplane message for {user_id}, who is no longer connected here")
+            if self.on_undelivered is not None:
+                await self.on_undelivered(user_id, message, critical)
+
+    def local_presence(self) -> list[tuple[str, float]]:
+        return list(self.connected_since.items())
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections.values():
-            await connection.send_text(message)
+    async def displace(self, user_id: str, since: float):
+        """Close our connection for a user who has since connected on another worker."""
+        if user_id in self.active_connections and self.connected_since.get(user_id, 0) < since:
+            logging.info(f"User {user_id} connected on another worker, closing connection here.")
+            websocket = self.active_connections[user_id]
+            self._remove(user_id)
+            try:
+                await websocket.close(code=1000)
+            except RuntimeError:
+                pass
 
-manager = ConnectionManager()
+manager = ConnectionManager(
+    backplane=Backplane(build_transport(Config.BACKPLANE_TRANSPORT)),
+    max_queue=Config.WS_SEND_QUEUE_SIZE,
+    overflow_policy=Config.WS_OVERFLOW_POLICY,
+)
 
 # --- ADDED: A separate manager for the open test endpoint ---
 class TestConnectionManager:
@@ -52,14 +273,11 @@ class TestConnectionManager:
             logging.info(f"Test client '{client_id}' disconnected. Total test clients: {len(self.active_connections)}")
 
     async def broadcast(self, message: str, sender_id: str = None):
-        # Broadcast to all clients, optionally excluding the sender
-        for client_id, connection in self.active_connections.items():
-            if sender_id and client_id == sender_id:
-                continue
-            try:
-                await connection.send_text(message)
-            except RuntimeError as e:
-                logging.warning(f"Could not send to test client {client_id}: {e}")
+        # Broadcast to all clients concurrently, optionally excluding the sender
+        targets = [(client_id, connection) for client_id, connection in self.active_connections.items() if client_id != sender_id]
+        result = await fan_out(targets, message)
+        for client_id in result.failed:
+            self.disconnect(client_id)
 
 # Instantiate the test manager
 test_manager = TestConnectionManager()
\ No newline at end of file
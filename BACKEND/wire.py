@@ -0,0 +1,80 @@
+import json
+import logging
+from typing import Optional, Union
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+try:
+    import msgpack  # Optional: only needed by clients that ask for the binary protocol
+except ImportError:
+    msgpack = None
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Wire protocols for /ws/{user_id}, chosen per connection at connect time.
+# Messages move through the server as dicts (or JSON text that is already
+# encoded); a codec turns a list of them into ASGI send events.
+
+MSGPACK_SUBPROTOCOL = "bb.msgpack.v1"
+
+class JsonCodec:
+    """The default: one JSON object per text frame."""
+    name = "json"
+    batches = False
+
+    def decode(self, data: Union[str, bytes]) -> list[dict]:
+        return [json.loads(data)]
+
+    def encode(self, items: list) -> list[dict]:
+        return [
+            {"type": "websocket.send", "text": item if isinstance(item, str) else json.dumps(item)}
+            for item in items
+        ]
+
+class MsgpackCodec:
+    """
+    Opt-in binary protocol: each binary frame is a MessagePack array of
+    messages, so several messages and receipts can share one frame. Clients may
+    send either a single map or an array of maps.
+    """
+    name = "msgpack"
+    batches = True
+
+    def decode(self, data: Union[str, bytes]) -> list[dict]:
+        decoded = json.loads(data) if isinstance(data, str) else msgpack.unpackb(data, raw=False)
+        return decoded if isinstance(decoded, list) else [decoded]
+
+    def encode(self, items: list) -> list[dict]:
+        messages = [json.loads(item) if isinstance(item, str) else item for item in items]
+        return [{"type": "websocket.send", "bytes": msgpack.packb(messages)}]
+
+JSON = JsonCodec()
+MSGPACK = MsgpackCodec() if msgpack is not None else None
+
+def negotiate(websocket: WebSocket) -> tuple[Union[JsonCodec, MsgpackCodec], Optional[str]]:
+    """
+    Pick the codec for a new connection and the subprotocol to accept with.
+    Clients opt in with the "bb.msgpack.v1" subprotocol or ?protocol=msgpack;
+    everyone else, and everyone when msgpack isn't installed, gets JSON.
+    """
+    offered = websocket.scope.get("subprotocols", [])
+    wants_msgpack = MSGPACK_SUBPROTOCOL in offered or websocket.query_params.get("protocol") == "msgpack"
+    if not wants_msgpack:
+        return JSON, None
+    if MSGPACK is None:
+        logging.warning("Client asked for msgpack but it is not installed, using JSON")
+        return JSON, None
+    return MSGPACK, MSGPACK_SUBPROTOCOL if MSGPACK_SUBPROTOCOL in offered else None
+
+async def receive_messages(websocket: WebSocket, codec) -> list[dict]:
+    """Read one frame (text or binary) and decode it into messages."""
+    event = await websocket.receive()
+    if event["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(event.get("code", 1000))
+    data = event.get("bytes") if event.get("bytes") is not None else event.get("text")
+    return codec.decode(data)
+
+async def send_direct(websocket: WebSocket, codec, item: Union[str, dict]):
+    """Send one message straight to the socket, bypassing the connection's send queue."""
+    for event in codec.encode([item]):
+        await websocket.send(event)